@@ -0,0 +1,126 @@
+"""
+Lid-driven cavity set up shared by the simulator tooling (benchmarks,
+profiling, steady state): build any of the NavierStokesSystem
+simulators with the boundary conditions of their __main__ scripts, and
+march one from a state with a common calling convention.
+
+The state is always (u, v, u1, v1, p), the current and previous
+velocity and the pressure. direct_fd does not use the previous
+velocity; it is carried along so every solver looks the same.
+"""
+import numpy as np
+
+SOLVERS = ['direct_fd', 'chorin_fd_explicit', 'chorin_fd', 'chorin_spectral']
+
+
+def cavity_boundary_conditions(nx, ny, lid=1.):
+    """u, v and p boundary conditions of the cavity: a moving lid on the 'right' side."""
+    from src.boundary import (DirichletBoundaryCondition,
+                              NeumannBoundaryCondition)
+
+    dx = 2. / (nx - 1.)
+    dy = 2. / (ny - 1.)
+
+    u_bc = [
+        DirichletBoundaryCondition(0, 'left', dx, dy),
+        DirichletBoundaryCondition(lid, 'right', dx, dy),
+        DirichletBoundaryCondition(0, 'top', dx, dy),
+        DirichletBoundaryCondition(0, 'bottom', dx, dy),
+    ]
+
+    v_bc = [
+        DirichletBoundaryCondition(0, 'left', dx, dy),
+        DirichletBoundaryCondition(0, 'right', dx, dy),
+        DirichletBoundaryCondition(0, 'top', dx, dy),
+        DirichletBoundaryCondition(0, 'bottom', dx, dy),
+    ]
+
+    p_bc = [
+        DirichletBoundaryCondition(0, 'top', dx, dy),
+        NeumannBoundaryCondition(0, 'bottom', dx, dy),
+        NeumannBoundaryCondition(0, 'left', dx, dy),
+        NeumannBoundaryCondition(0, 'right', dx, dy),
+    ]
+
+    return u_bc, v_bc, p_bc
+
+
+def cavity_system(solver, nx=51, ny=51, nt=200, dt=0.001, nit=None, rho=1, nu=0.1, **kwargs):
+    """
+    Build the cavity for one of the SOLVERS, starting at rest.
+
+    Args
+    ----
+    solver := string
+              direct_fd | chorin_fd_explicit | chorin_fd | chorin_spectral
+              (chorin_fd is the semi-implicit method)
+    nx, ny := integer (default: 51)
+              number of grid points
+    nt := integer (default: 200)
+          number of time steps for simulate()
+    dt := float (default: 0.001)
+    nit := integer (default: None)
+           pressure iterations; None keeps the __main__ script values
+           (50 for direct_fd, 200 for chorin_fd)
+    rho, nu := float (default: 1, 0.1)
+    kwargs := passed on to the NavierStokesSystem
+    """
+    u_ic = np.zeros((nx, ny))
+    v_ic = np.zeros((nx, ny))
+    p_ic = np.zeros((nx, ny))
+    u_bc, v_bc, p_bc = cavity_boundary_conditions(nx, ny)
+
+    if solver == 'direct_fd':
+        from src.direct_fd.simulate import NavierStokesSystem
+        return NavierStokesSystem(
+            u_ic, v_ic, p_ic, u_bc, v_bc, p_bc,
+            nt=nt, nit=50 if nit is None else nit, nx=nx, ny=ny, dt=dt,
+            rho=rho, nu=nu, **kwargs,
+        )
+    elif solver in ['chorin_fd', 'chorin_fd_explicit']:
+        from src.chorin_fd.simulate import NavierStokesSystem
+        method = 'explicit' if solver == 'chorin_fd_explicit' else 'semi_implicit'
+        return NavierStokesSystem(
+            u_ic, v_ic, p_ic, u_bc, v_bc, p_bc,
+            nt=nt, nit=200 if nit is None else nit, nx=nx, ny=ny, dt=dt,
+            rho=rho, nu=nu, method=method, **kwargs,
+        )
+    elif solver == 'chorin_spectral':
+        from src.chorin_spectral.simulate import NavierStokesSystem
+        return NavierStokesSystem(
+            u_ic, v_ic, p_ic, u_bc, v_bc,
+            nt=nt, nit=200 if nit is None else nit, nx=nx, ny=ny, dt=dt,
+            rho=rho, nu=nu, **kwargs,
+        )
+    raise ValueError('unknown solver {}'.format(solver))
+
+
+def initial_state(system):
+    """(u, v, u1, v1, p) at the start of simulate()."""
+    if hasattr(system, '_init_variables'):
+        u, v, p = system._init_variables()
+    else:  # direct_fd starts from the raw initial conditions
+        u, v, p = system.u_ic.copy(), system.v_ic.copy(), system.p_ic.copy()
+    return u, v, u.copy(), v.copy(), p
+
+
+def advance(system, state, n_steps=1):
+    """
+    March a state n_steps with system.step, the way simulate() does.
+    The arrays of the given state are never modified.
+    """
+    u, v, u1, v1, p = [x.copy() for x in state]
+    for _ in range(n_steps):
+        if is_direct(system):
+            # direct_fd updates its arguments in place
+            u1, v1 = u.copy(), v.copy()
+            u, v, p = system.step(u, v, p)
+        else:
+            _u, _v, p = system.step(u, v, u1, v1, p)
+            u1, v1 = u, v
+            u, v = _u, _v
+    return u, v, u1, v1, p
+
+
+def is_direct(system):
+    return system.__class__.__module__ == 'src.direct_fd.simulate'
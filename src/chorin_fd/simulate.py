@@ -6,6 +6,9 @@ import numpy as np
 from scipy.sparse import diags
 from tqdm import tqdm
 
+from src.profiling import NullProfiler
+from src.thread_pool import concurrent_map
+
 
 class NavierStokesSystem():
     """
@@ -46,11 +49,19 @@ class NavierStokesSystem():
              explicit will use Adam-Bashford for advection and diffusion terms
              semi_implicit will use Adam-Bashform for advection
                 and Crank-Nicholson for diffusion terms
+    profiler : object
+               instrumentation for the phases of step(), see src.profiling
+               (default: None, no instrumentation)
+    n_threads : integer
+                solve the independent u- and v-momentum systems of the
+                semi_implicit predictor on this many threads, see
+                src.thread_pool (default: 1)
     """
 
     def __init__(self, u_ic, v_ic, p_ic, u_bc, v_bc, p_bc,
                  nt=200, nit=50, nx=50, ny=50, dt=0.001, 
-                 rho=1, nu=1, beta=1.25, method='semi_implicit'):
+                 rho=1, nu=1, beta=1.25, method='semi_implicit', profiler=None,
+                 n_threads=1):
         self.u_ic, self.v_ic, self.p_ic = u_ic, v_ic, p_ic
         self.u_bc, self.v_bc, self.p_bc = u_bc, v_bc, p_bc
         self.nt, self.nit, self.dt, self.nx, self.ny = nt, nit, dt, nx, ny
@@ -59,6 +70,8 @@ class NavierStokesSystem():
         self.rho, self.nu, self.beta = rho, nu, beta
         assert method in ['semi_implicit', 'explicit']
         self.method = method
+        self.profiler = NullProfiler() if profiler is None else profiler
+        self.n_threads = n_threads
 
     def _explicit_predictor_step(self, u, v, u1, v1):
         dt, dx, dy = self.dt, self.dx, self.dy
@@ -95,76 +108,69 @@ class NavierStokesSystem():
         nu = self.nu
 
         # important to make copies
-        ut, vt = u.copy(), v.copy()
-        ui, vi = u.copy(), v.copy()  # intermediate fields
         un, vn = u.copy(), v.copy()
         un1, vn1 = u1.copy(), v1.copy()  # u^{n-1}, v^{n-1}
 
         # -- step 0 of crank-nicholson: constants
 
         A = diags(
-            np.array([
+            [
                 np.ones(self.nx-3) * -dt,
                 np.ones(self.nx-2) * (2 / nu * dx**2 + 2 * dt),
                 np.ones(self.nx-3) * -dt,
-            ]),
+            ],
             [-1, 0, 1],
         ).toarray()
 
         B = diags(
-            np.array([
+            [
                 np.ones(self.ny-3) * -dt,
                 np.ones(self.ny-2) * (2 / nu * dy**2 + 2 * dt),
                 np.ones(self.ny-3) * -dt,
-            ]),
+            ],
             [-1, 0, 1],
         ).toarray()
 
-        # -- step 1 of crank-nicholson: u-momentum --
-
-        # adams-bashford estimate for advection terms
-        uHn  = (un[1:-1, 1:-1] * (un[2:, 1:-1] - un[:-2, 1:-1]) / (2 * dx) +
-                vn[1:-1, 1:-1] * (un[1:-1, 2:] - un[1:-1, :-2]) / (2 * dy))
-        uHn1 = (un1[1:-1, 1:-1] * (un1[2:, 1:-1] - un1[:-2, 1:-1]) / (2 * dx) +
-                vn1[1:-1, 1:-1] * (un1[1:-1, 2:] - un1[1:-1, :-2]) / (2 * dy))
-        # build C vector
-        uC1 = dt / 2. * (3 * uHn - uHn1)
-        uC2 = dt * nu * ((un[2:, 1:-1] - 2 * un[1:-1, 1:-1] + un[:-2, 1:-1]) / dx**2 +
-                         (un[1:-1, 2:] - 2 * un[1:-1, 1:-1] + un[1:-1, :-2]) / dy**2)
-        uC  = 2 / nu * dx**2 * (uC1 + uC2)
+        # u- and v-momentum are independent: optionally solve them on two threads
+        ui, vi = concurrent_map(
+            self._crank_nicholson_solve,
+            [(un, un1, un, vn, un1, vn1, A, B), (vn, vn1, un, vn, un1, vn1, A, B)],
+            self.n_threads,
+        )
+        return ui, vi
 
-        # solve linear system
-        ut[1:-1, 1:-1] = np.linalg.solve(A, uC)
+    def _crank_nicholson_solve(self, qn, qn1, un, vn, un1, vn1, A, B):
+        """
+        Both steps of crank-nicholson for one momentum component q (u or v),
+        advected by (un, vn) and (un1, vn1). Returns the intermediate field.
+        """
+        dt, dx, dy = self.dt, self.dx, self.dy
+        nu = self.nu
+        qt, qi = qn.copy(), qn.copy()
 
-        # -- step 1 of crank-nicholson: v-momentum --
+        # -- step 1 of crank-nicholson --
 
         # adams-bashford estimate for advection terms
-        vHn  = (un[1:-1, 1:-1] * (vn[2:, 1:-1] - vn[:-2, 1:-1]) / (2 * dx) +
-                vn[1:-1, 1:-1] * (vn[1:-1, 2:] - vn[1:-1, :-2]) / (2 * dy))
-        vHn1 = (un1[1:-1, 1:-1] * (vn1[2:, 1:-1] - vn1[:-2, 1:-1]) / (2 * dx) +
-                vn1[1:-1, 1:-1] * (vn1[1:-1, 2:] - vn1[1:-1, :-2]) / (2 * dy))
+        Hn  = (un[1:-1, 1:-1] * (qn[2:, 1:-1] - qn[:-2, 1:-1]) / (2 * dx) +
+               vn[1:-1, 1:-1] * (qn[1:-1, 2:] - qn[1:-1, :-2]) / (2 * dy))
+        Hn1 = (un1[1:-1, 1:-1] * (qn1[2:, 1:-1] - qn1[:-2, 1:-1]) / (2 * dx) +
+               vn1[1:-1, 1:-1] * (qn1[1:-1, 2:] - qn1[1:-1, :-2]) / (2 * dy))
         # build C vector
-        vC1 = dt / 2. * (3 * vHn - vHn1)
-        vC2 = dt * nu * ((vn[2:, 1:-1] - 2 * vn[1:-1, 1:-1] + vn[:-2, 1:-1]) / dx**2 +
-                         (vn[1:-1, 2:] - 2 * vn[1:-1, 1:-1] + vn[1:-1, :-2]) / dy**2)
-        vC  = 2 / nu * dx**2 * (vC1 + vC2)
+        C1 = dt / 2. * (3 * Hn - Hn1)
+        C2 = dt * nu * ((qn[2:, 1:-1] - 2 * qn[1:-1, 1:-1] + qn[:-2, 1:-1]) / dx**2 +
+                        (qn[1:-1, 2:] - 2 * qn[1:-1, 1:-1] + qn[1:-1, :-2]) / dy**2)
+        C  = 2 / nu * dx**2 * (C1 + C2)
 
         # solve linear system
-        vt[1:-1, 1:-1] = np.linalg.solve(A, vC)
-
-        # -- step 2 of crank-nicholson: u-momentum --
+        qt[1:-1, 1:-1] = np.linalg.solve(A, C)
 
-        uS = (2 / nu * dy**2 * (ut[1:-1, 1:-1] + un[1:-1, 1:-1]) -
-                dt * (un[1:-1, 2:] - 2 * un[1:-1, 1:-1] + un[1:-1, :-2]))
-        ui[1:-1, 1:-1] = np.linalg.solve(B, uS)
+        # -- step 2 of crank-nicholson --
 
-        # -- step 2 of crank-nicholson: v-momentum --
+        S = (2 / nu * dy**2 * (qt[1:-1, 1:-1] + qn[1:-1, 1:-1]) -
+                dt * (qn[1:-1, 2:] - 2 * qn[1:-1, 1:-1] + qn[1:-1, :-2]))
+        qi[1:-1, 1:-1] = np.linalg.solve(B, S)
 
-        vS = (2 / nu * dy**2 * (vt[1:-1, 1:-1] + vn[1:-1, 1:-1]) -
-                dt * (vn[1:-1, 2:] - 2 * vn[1:-1, 1:-1] + vn[1:-1, :-2]))
-        vi[1:-1, 1:-1] = np.linalg.solve(B, vS)
-
-        return ui, vi
+        return qi
 
     def _get_pressure(self, ui, vi, p):
         """
@@ -183,9 +189,7 @@ class NavierStokesSystem():
         tol, err, it = 5e-6, 1, 1
         pPrev = p.copy()
 
-        dx2dy2C = np.zeros_like(ui)
-        dx2dy2C[1:-1, 1:-1] = ( dx * rho * dy**2 / dt * (ui[1:-1, 1:-1] - ui[:-2, 1:-1]) +
-                                dy * rho * dx**2 / dt * (vi[1:-1, 1:-1] - vi[1:-1, :-2]) )
+        dx2dy2C = self._pressure_rhs(ui, vi)
 
         while ((err > tol) and (it < self.nit)):
             for i in range(1, nx - 1):
@@ -199,8 +203,18 @@ class NavierStokesSystem():
             pPrev = p.copy()
             it = it + 1
 
+        self.profiler.count('pressure_iterations', it - 1)
         return p
 
+    def _pressure_rhs(self, ui, vi):
+        # dx^2 dy^2 times the right hand side of the pressure equation
+        dt, dx, dy = self.dt, self.dx, self.dy
+        rho = self.rho
+        dx2dy2C = np.zeros_like(ui)
+        dx2dy2C[1:-1, 1:-1] = ( dx * rho * dy**2 / dt * (ui[1:-1, 1:-1] - ui[:-2, 1:-1]) +
+                                dy * rho * dx**2 / dt * (vi[1:-1, 1:-1] - vi[1:-1, :-2]) )
+        return dx2dy2C
+
     def _correction_step(self, ui, vi, p):
         dt, dx, dy = self.dt, self.dx, self.dy
         un1, vn1 = ui.copy(), vi.copy()
@@ -210,27 +224,37 @@ class NavierStokesSystem():
         return un1, vn1
 
     def step(self, un, vn, un1, vn1, p):
-        if self.method == 'explicit':
-            ui, vi = self._explicit_predictor_step(un, vn, un1, vn1)
-        elif self.method == 'semi_implicit':
-            ui, vi = self._semi_implicit_predictor_step(un, vn, un1, vn1)
-        else:
-            raise Exception('method not recognized: {}'.format(self.method))
+        with self.profiler.phase('step'):
+            return self._step(un, vn, un1, vn1, p)
+
+    def _step(self, un, vn, un1, vn1, p):
+        profiler = self.profiler
+        with profiler.phase('predictor'):
+            if self.method == 'explicit':
+                ui, vi = self._explicit_predictor_step(un, vn, un1, vn1)
+            elif self.method == 'semi_implicit':
+                ui, vi = self._semi_implicit_predictor_step(un, vn, un1, vn1)
+            else:
+                raise Exception('method not recognized: {}'.format(self.method))
 
         # set boundary conditions
-        for bc in self.u_bc:
-            ui = bc.apply(ui)
+        with profiler.phase('boundary'):
+            for bc in self.u_bc:
+                ui = bc.apply(ui)
 
-        for bc in self.v_bc:
-            vi = bc.apply(vi)
+            for bc in self.v_bc:
+                vi = bc.apply(vi)
 
-        p = self._get_pressure(ui, vi, p)
+        with profiler.phase('pressure'):
+            p = self._get_pressure(ui, vi, p)
 
         # apply neumann boundary conditions
-        for bc in self.p_bc:
-            p = bc.apply(p)
-        
-        un1, vn1 = self._correction_step(ui, vi, p)
+        with profiler.phase('boundary'):
+            for bc in self.p_bc:
+                p = bc.apply(p)
+
+        with profiler.phase('correction'):
+            un1, vn1 = self._correction_step(ui, vi, p)
         return un1, vn1, p
 
     def _init_variables(self):
@@ -248,7 +272,13 @@ class NavierStokesSystem():
 
         return u, v, p
 
-    def simulate(self):
+    def simulate(self, tol=None):
+        """
+        March nt steps from the initial conditions and stack the fields
+        of every step. With tol, stop early once the largest change of
+        u or v over one step falls below tol (a steady state); fewer
+        than nt steps are returned then.
+        """
         # collect propagations for dataset
         u_list, v_list, p_list = [], [], []
 
@@ -264,6 +294,9 @@ class NavierStokesSystem():
             v_list.append(v.copy())
             p_list.append(p.copy())
 
+            if tol is not None and max(np.abs(u - u1).max(), np.abs(v - v1).max()) < tol:
+                break
+
         u_list = np.stack(u_list)
         v_list = np.stack(v_list)
         p_list = np.stack(p_list)
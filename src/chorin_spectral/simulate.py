@@ -6,6 +6,9 @@ import numpy as np
 from scipy.sparse import diags
 from tqdm import tqdm
 
+from src.profiling import NullProfiler
+from src.thread_pool import concurrent_map
+
 
 class NavierStokesSystem():
     """
@@ -37,9 +40,17 @@ class NavierStokesSystem():
          constant in the Navier Stokes equations
     beta : float
            constant in successive over-relaxation
+    profiler : object
+               instrumentation for the phases of step(), see src.profiling
+               (default: None, no instrumentation)
+    n_threads : integer
+                solve the independent u- and v-momentum systems (and
+                their boundary values) of the predictor on this many
+                threads, see src.thread_pool (default: 1)
     """
     def __init__(self, u_ic, v_ic, p_ic, u_bc, v_bc, nt=200, nit=50,
-                 nx=50, ny=50, dt=0.001, rho=1, nu=1, beta=1.25):
+                 nx=50, ny=50, dt=0.001, rho=1, nu=1, beta=1.25, profiler=None,
+                 n_threads=1):
         self.u_ic, self.v_ic, self.p_ic = u_ic, v_ic, p_ic
         self.u_bc, self.v_bc = u_bc, v_bc  # no BC needed for pressure
         # important to subtract 1 for numerical match-up
@@ -47,13 +58,19 @@ class NavierStokesSystem():
         # hard code to size of x over 2 (un-dimensionalize to [-1, 1])
         self.dx, self.dy = 2. / self.nx, 2. / self.ny
         self.rho, self.nu, self.beta = rho, nu, beta
+        self.profiler = NullProfiler() if profiler is None else profiler
+        self.n_threads = n_threads
 
         # initialize a bunch of matrices
         self._pseudospectral_setup()
 
     def step(self, un, vn, un1, vn1, p):
-        ui, vi = self._predictor_step(un, vn, un1, vn1)
-        un1, vn1, p = self._correction_step(ui, vi, p)
+        profiler = self.profiler
+        with profiler.phase('step'):
+            with profiler.phase('predictor'):
+                ui, vi = self._predictor_step(un, vn, un1, vn1)
+            with profiler.phase('correction'):
+                un1, vn1, p = self._correction_step(ui, vi, p)
         return un1, vn1, p
 
     def _pseudospectral_setup(self):
@@ -281,41 +298,46 @@ class NavierStokesSystem():
                 self.dt * (_un1 * _vn1_dx + _vn1 * _vn1_dy) + \
                 self.dt * (_vn_ddx + _vn_ddy)
 
-        # solve linear system for u first
-        u_H_tilde = self.u_Dx_P_inv @ u_F
-        u_H_hat   = u_H_tilde @ self.u_Dy_Q_inv.T
-        u_hat     = u_H_hat / ( 2. - self.dt * dup_vector_by_row(self.u_Dx_lambda, Nx - 2) -
-                                self.dt * dup_vector_by_col(self.u_Dy_lambda, Ny - 2) )
-        u_tilde   = u_hat @ self.u_Dy_Q.T
-        u_soln    = self.u_Dx_P @ u_tilde
-
-        # repeat for v -- 4 matrix multplications
-        v_H_tilde = self.v_Dx_P_inv @ v_F
-        v_H_hat   = v_H_tilde @ self.v_Dy_Q_inv.T
-        v_hat     = v_H_hat / ( 2. - self.dt * dup_vector_by_row(self.v_Dx_lambda, Nx - 2) -
-                                self.dt * dup_vector_by_col(self.v_Dy_lambda, Ny - 2) )
-        v_tilde   = v_hat @ self.v_Dy_Q.T
-        v_soln    = self.v_Dx_P @ v_tilde
+        def helmholtz_solve(F, P_inv, Q_inv, lambda_x, lambda_y, P, Q):
+            # 4 matrix multiplications
+            H_tilde = P_inv @ F
+            H_hat   = H_tilde @ Q_inv.T
+            hat     = H_hat / ( 2. - self.dt * dup_vector_by_row(lambda_x, Nx - 2) -
+                                self.dt * dup_vector_by_col(lambda_y, Ny - 2) )
+            tilde   = hat @ Q.T
+            return P @ tilde
+
+        # u and v are independent: optionally solve them on two threads
+        u_soln, v_soln = concurrent_map(helmholtz_solve, [
+            (u_F, self.u_Dx_P_inv, self.u_Dy_Q_inv, self.u_Dx_lambda, self.u_Dy_lambda,
+             self.u_Dx_P, self.u_Dy_Q),
+            (v_F, self.v_Dx_P_inv, self.v_Dy_Q_inv, self.v_Dx_lambda, self.v_Dy_lambda,
+             self.v_Dx_P, self.v_Dy_Q),
+        ], self.n_threads)
 
         # impose boundary conditions
-        u_soln_x0, u_soln_xN, u_soln_y0, u_soln_yN = \
-            get_boundary_values(
-                u_soln,
-                self.u_g_minus_x, self.u_g_plus_x, self.u_g_minus_y, self.u_g_plus_y,
-                self.u_e_x, self.u_c0_minus_x, self.u_c0_plus_x,
-                self.u_cN_minus_x, self.u_cN_plus_x, self.u_b0_x, self.u_bN_x,
-                self.u_e_y, self.u_c0_minus_y, self.u_c0_plus_y,
-                self.u_cN_minus_y, self.u_cN_plus_y, self.u_b0_y, self.u_bN_y,
-            )
-        v_soln_x0, v_soln_xN, v_soln_y0, v_soln_yN = \
-            get_boundary_values(
-                v_soln,
-                self.v_g_minus_x, self.v_g_plus_x, self.v_g_minus_y, self.v_g_plus_y,
-                self.v_e_x, self.v_c0_minus_x, self.v_c0_plus_x,
-                self.v_cN_minus_x, self.v_cN_plus_x, self.v_b0_x, self.v_bN_x,
-                self.v_e_y, self.v_c0_minus_y, self.v_c0_plus_y,
-                self.v_cN_minus_y, self.v_cN_plus_y, self.v_b0_y, self.v_bN_y,
-            )
+        with self.profiler.phase('boundary'):
+            (
+                (u_soln_x0, u_soln_xN, u_soln_y0, u_soln_yN),
+                (v_soln_x0, v_soln_xN, v_soln_y0, v_soln_yN),
+            ) = concurrent_map(get_boundary_values, [
+                (
+                    u_soln,
+                    self.u_g_minus_x, self.u_g_plus_x, self.u_g_minus_y, self.u_g_plus_y,
+                    self.u_e_x, self.u_c0_minus_x, self.u_c0_plus_x,
+                    self.u_cN_minus_x, self.u_cN_plus_x, self.u_b0_x, self.u_bN_x,
+                    self.u_e_y, self.u_c0_minus_y, self.u_c0_plus_y,
+                    self.u_cN_minus_y, self.u_cN_plus_y, self.u_b0_y, self.u_bN_y,
+                ),
+                (
+                    v_soln,
+                    self.v_g_minus_x, self.v_g_plus_x, self.v_g_minus_y, self.v_g_plus_y,
+                    self.v_e_x, self.v_c0_minus_x, self.v_c0_plus_x,
+                    self.v_cN_minus_x, self.v_cN_plus_x, self.v_b0_x, self.v_bN_x,
+                    self.v_e_y, self.v_c0_minus_y, self.v_c0_plus_y,
+                    self.v_cN_minus_y, self.v_cN_plus_y, self.v_b0_y, self.v_bN_y,
+                ),
+            ], self.n_threads)
 
         # put it all together
         # TODO: the corners are ignored... fix?
@@ -399,7 +421,7 @@ class NavierStokesSystem():
         return x_i
 
     def _get_T_matrix(self, N):
-        """
+        r"""
         Matrix to convert back and forth between spectral coefficients,
         \hat{u}_k, and the values at the collocation points, u_N(x_i).
         This is just a matrix multiplication.
@@ -419,7 +441,7 @@ class NavierStokesSystem():
         return np.stack(T)
 
     def _get_inv_T_matrix(self, N):
-        """
+        r"""
         \mathcal{T}^{-1} = [2(\cos \pi i / N)/(\bar{c}_k \bar{c}_i N)]
         \hat{\mathcal{U}} = \mathcal{T}\mathcal{U}
 
@@ -441,7 +463,7 @@ class NavierStokesSystem():
         return inv_T
 
     def _get_D_matrix(self, N):
-        """
+        r"""
         Matrix to compute derivative of coordinate values.
             \mathcal{D} = [d^{(1)}_{i,j}] for i,j=0...N
         where if 0 <= i,j <= N, i != j
@@ -481,7 +503,7 @@ class NavierStokesSystem():
         return D
 
     def _get_D_sqr_matrix(self, N):
-        """
+        r"""
         A second matrix to compute second derivatives of
         coordinate values. In practice, we can just square
         the first derivative matrix and apply some fixes.
@@ -544,7 +566,13 @@ class NavierStokesSystem():
 
         return u, v, p
 
-    def simulate(self):
+    def simulate(self, tol=None):
+        """
+        March nt steps from the initial conditions and stack the fields
+        of every step. With tol, stop early once the largest change of
+        u or v over one step falls below tol (a steady state); fewer
+        than nt steps are returned then.
+        """
         u_list, v_list, p_list = [], [], []
 
         u, v, p = self._init_variables()
@@ -561,6 +589,8 @@ class NavierStokesSystem():
             p_list.append(p.copy())
 
             pbar.update()
+            if tol is not None and max(np.abs(u - u1).max(), np.abs(v - v1).max()) < tol:
+                break
         pbar.close()
 
         u_list = np.stack(u_list)
@@ -0,0 +1,312 @@
+"""
+Domain-decomposed stepping of the finite difference simulators
+(direct_fd and chorin_fd) across processes on one machine. The fields
+live in multiprocessing.shared_memory. Every worker owns a strip of
+rows and updates only those. A stencil reads the one-row halo of its
+neighbours directly from shared memory, and a barrier between the
+phases of a step (and between pressure sweeps) makes sure the halo is
+up to date.
+
+    direct_fd   all phases on row strips; the Jacobi pressure sweeps
+                read the previous iterate, so the result matches the
+                serial step bit for bit
+    chorin_fd   the semi-implicit predictor solves tridiagonal systems
+                along the rows (axis 0) for every column, so it runs on
+                column strips; the rest runs on row strips. The
+                pressure solve replaces the lexicographic Gauss-Seidel
+                SOR of the serial code by red-black SOR (all red points
+                from the black ones, then all black from the red), which
+                parallelizes (and vectorizes). That is a different
+                iteration to the same solution, so the fields agree with
+                the serial step to within the accuracy of the pressure
+                solve, not bit for bit.
+
+Boundary conditions are applied by the owner of the rows they touch.
+The 'left' / 'right' sides (first / last row) belong to the first /
+last worker, which therefore own at least two rows.
+
+    python -m src.decomposed --solver direct_fd --nx 1025 --nt 10 --workers 4
+"""
+import time
+import multiprocessing as mp
+from multiprocessing import shared_memory
+
+import numpy as np
+
+from src.cavity import cavity_system, initial_state, advance, is_direct
+
+_STOP, _RUN = 0, 1
+
+
+def partition(n, n_parts):
+    """Split range(n) into n_parts contiguous (start, stop) blocks."""
+    bounds = np.linspace(0, n, n_parts + 1).round().astype(int)
+    return list(zip(bounds[:-1], bounds[1:]))
+
+
+def slab(lo, hi, n):
+    """
+    Rows [lo, hi) with their one-row halo: the slice to take from the
+    full array, and the slice of that slab which is [lo, hi).
+    """
+    s0, s1 = max(lo - 1, 0), min(hi + 1, n)
+    return slice(s0, s1), slice(lo - s0, hi - s0)
+
+
+def apply_boundary_rows(bcs, A, lo, hi):
+    """Apply boundary conditions to the rows [lo, hi) of A only, in order."""
+    n = A.shape[0]
+    for bc in bcs:
+        if bc.boundary == 'left':
+            if lo == 0:
+                bc.apply(A)  # writes row 0, reads row 1
+        elif bc.boundary == 'right':
+            if hi == n:
+                bc.apply(A)
+        else:
+            bc.apply(A[lo:hi])
+
+
+def red_black_sweep(system, p, C, color, i0):
+    """
+    SOR update of the interior points of slab p with (i + j) % 2 == color,
+    i being the row in the full array (i0 is the slab's first row).
+    """
+    dx, dy, beta = system.dx, system.dy, system.beta
+    new = (beta * (dy**2 * p[2:, 1:-1] + dy**2 * p[:-2, 1:-1] +
+                   dx**2 * p[1:-1, 2:] + dx**2 * p[1:-1, :-2] -
+                   C[1:-1, 1:-1]) / (2 * dx**2 + 2 * dy**2) +
+           (1 - beta) * p[1:-1, 1:-1])
+    i = np.arange(i0 + 1, i0 + p.shape[0] - 1)[:, np.newaxis]
+    j = np.arange(1, p.shape[1] - 1)[np.newaxis, :]
+    mask = (i + j) % 2 == color
+    p[1:-1, 1:-1][mask] = new[mask]
+
+
+def _attach(specs):
+    """Open the shared arrays (name -> (shm name, shape)) as numpy views."""
+    handles, arrays = [], {}
+    for key, (name, shape) in specs.items():
+        shm = shared_memory.SharedMemory(name=name)
+        handles.append(shm)
+        arrays[key] = np.ndarray(shape, dtype=np.float64, buffer=shm.buf)
+    return handles, arrays
+
+
+def _direct_step(system, a, rows, barrier):
+    lo, hi = rows
+    n = a['u'].shape[0]
+    rs, own = slab(lo, hi, n)
+    u, v, p = a['u'], a['v'], a['p']
+    un, vn, pn, b = a['u1'], a['v1'], a['pn'], a['b']
+
+    un[lo:hi], vn[lo:hi] = u[lo:hi], v[lo:hi]
+    barrier.wait()
+    b[lo:hi] = system._build_up_b(un[rs], vn[rs])[own]
+
+    for q in range(system.nit):
+        pn[lo:hi] = p[lo:hi]
+        barrier.wait()
+        system._pressure_sweep(p[rs], pn[rs], b[rs])
+        apply_boundary_rows(system.p_bc, p, lo, hi)
+        barrier.wait()
+
+    system._momentum_step(u[rs], v[rs], un[rs], vn[rs], p[rs])
+    apply_boundary_rows(system.u_bc, u, lo, hi)
+    apply_boundary_rows(system.v_bc, v, lo, hi)
+    barrier.wait()
+
+
+def _chorin_step(system, a, rows, cols, barrier, errors, n_workers, rank):
+    lo, hi = rows
+    n = a['u'].shape[0]
+    rs, own = slab(lo, hi, n)
+    u, v, u1, v1, p = a['u'], a['v'], a['u1'], a['v1'], a['p']
+    ui, vi, C, p_prev = a['ui'], a['vi'], a['C'], a['p_prev']
+
+    if system.method == 'semi_implicit':
+        # solves along axis 0: column strips
+        c0, c1 = cols
+        cs, cown = slab(c0, c1, u.shape[1])
+        _ui, _vi = system._semi_implicit_predictor_step(u[:, cs], v[:, cs], u1[:, cs], v1[:, cs])
+        ui[:, c0:c1], vi[:, c0:c1] = _ui[:, cown], _vi[:, cown]
+    else:
+        _ui, _vi = system._explicit_predictor_step(u[rs], v[rs], u1[rs], v1[rs])
+        ui[lo:hi], vi[lo:hi] = _ui[own], _vi[own]
+    barrier.wait()
+
+    apply_boundary_rows(system.u_bc, ui, lo, hi)
+    apply_boundary_rows(system.v_bc, vi, lo, hi)
+    barrier.wait()
+    C[lo:hi] = system._pressure_rhs(ui[rs], vi[rs])[own]
+
+    # red-black SOR with the serial loop's stopping rule
+    tol, err, it = 5e-6, 1, 1
+    p_prev[lo:hi] = p[lo:hi]
+    barrier.wait()
+    while err > tol and it < system.nit:
+        red_black_sweep(system, p[rs], C[rs], 0, rs.start)
+        barrier.wait()
+        red_black_sweep(system, p[rs], C[rs], 1, rs.start)
+        # alternate the error slots so nobody overwrites one still being read
+        errors[it % 2, rank] = np.max(np.abs(p[lo:hi] - p_prev[lo:hi]))
+        p_prev[lo:hi] = p[lo:hi]
+        barrier.wait()
+        err = errors[it % 2, :n_workers].max()
+        it = it + 1
+
+    apply_boundary_rows(system.p_bc, p, lo, hi)
+    barrier.wait()
+
+    _u, _v = system._correction_step(ui[rs], vi[rs], p[rs])
+    u1[lo:hi], v1[lo:hi] = u[lo:hi], v[lo:hi]
+    u[lo:hi], v[lo:hi] = _u[own], _v[own]
+    barrier.wait()
+
+
+def _worker(rank, n_workers, system, specs, rows, cols, control_barrier, barrier):
+    handles, a = _attach(specs)
+    control, errors = a['control'], a['errors']
+    direct = is_direct(system)
+    try:
+        while True:
+            control_barrier.wait()
+            if control[0] == _STOP:
+                break
+            for _ in range(int(control[1])):
+                if direct:
+                    _direct_step(system, a, rows[rank], barrier)
+                else:
+                    _chorin_step(system, a, rows[rank], cols[rank], barrier,
+                                 errors, n_workers, rank)
+            control_barrier.wait()
+    finally:
+        del a, control, errors
+        for shm in handles:
+            shm.close()
+
+
+class DecomposedSystem(object):
+    """
+    Steps a direct_fd or chorin_fd NavierStokesSystem with n_workers
+    processes on row strips of shared memory fields. The workers live
+    until close() (or the end of a with block).
+
+    Args
+    ----
+    system := NavierStokesSystem
+              direct_fd or chorin_fd; sent to every worker once
+    n_workers := integer (default: 2)
+                 number of processes, at most (nx - 2) / 2
+    """
+
+    def __init__(self, system, n_workers=2):
+        assert not hasattr(system, 'x_i'), 'chorin_spectral is not a finite difference grid'
+        self.system, self.n_workers = system, n_workers
+        nx, ny = system.nx, system.ny
+        assert nx >= 2 * n_workers and ny >= 2 * n_workers, 'strips need at least two rows'
+
+        names = ['u', 'v', 'u1', 'v1', 'p']
+        names += ['pn', 'b'] if is_direct(system) else ['ui', 'vi', 'C', 'p_prev']
+        shapes = {name: (nx, ny) for name in names}
+        shapes['control'] = (2,)
+        shapes['errors'] = (2, n_workers)
+
+        self._shm, self.arrays, specs = [], {}, {}
+        for name, shape in shapes.items():
+            shm = shared_memory.SharedMemory(create=True, size=int(np.prod(shape)) * 8)
+            self._shm.append(shm)
+            self.arrays[name] = np.ndarray(shape, dtype=np.float64, buffer=shm.buf)
+            self.arrays[name][...] = 0.
+            specs[name] = (shm.name, shape)
+
+        rows = partition(nx, n_workers)
+        cols = partition(ny, n_workers)
+        self._control_barrier = mp.Barrier(n_workers + 1)
+        barrier = mp.Barrier(n_workers)
+        self._workers = [
+            mp.Process(target=_worker, daemon=True,
+                       args=(rank, n_workers, system, specs, rows, cols,
+                             self._control_barrier, barrier))
+            for rank in range(n_workers)]
+        for worker in self._workers:
+            worker.start()
+
+    def advance(self, state, n_steps=1):
+        """Like src.cavity.advance: (u, v, u1, v1, p) after n_steps, input untouched."""
+        a = self.arrays
+        for name, x in zip(['u', 'v', 'u1', 'v1', 'p'], state):
+            a[name][...] = x
+        a['control'][:] = _RUN, n_steps
+        self._control_barrier.wait()  # start
+        self._control_barrier.wait()  # done
+        return tuple(a[name].copy() for name in ['u', 'v', 'u1', 'v1', 'p'])
+
+    def simulate(self):
+        """Like system.simulate(): the u, v and p of every one of the nt steps."""
+        state = initial_state(self.system)
+        u_list, v_list, p_list = [], [], []
+        for n in range(self.system.nt):
+            state = self.advance(state)
+            u_list.append(state[0])
+            v_list.append(state[1])
+            p_list.append(state[4])
+        return np.stack(u_list), np.stack(v_list), np.stack(p_list)
+
+    def close(self):
+        if self._workers is None:
+            return
+        self.arrays['control'][0] = _STOP
+        self._control_barrier.wait()
+        for worker in self._workers:
+            worker.join()
+        self._workers = None
+        self.arrays = None
+        for shm in self._shm:
+            shm.close()
+            shm.unlink()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+        return False
+
+
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--solver', type=str, default='direct_fd',
+                        choices=['direct_fd', 'chorin_fd_explicit', 'chorin_fd'],
+                        help='default: direct_fd')
+    parser.add_argument('--nx', type=int, default=513, help='nx = ny [default: 513]')
+    parser.add_argument('--nt', type=int, default=10, help='default: 10')
+    parser.add_argument('--dt', type=float, default=1e-5, help='default: 1e-5')
+    parser.add_argument('--nit', type=int, default=None,
+                        help='pressure iterations [default: the script value]')
+    parser.add_argument('--workers', type=int, default=4, help='default: 4')
+    parser.add_argument('--skip-serial', action='store_true', default=False,
+                        help='do not time the serial step for comparison')
+    args = parser.parse_args()
+
+    system = cavity_system(args.solver, nx=args.nx, ny=args.nx, nt=args.nt,
+                           dt=args.dt, nit=args.nit)
+    state = initial_state(system)
+
+    with DecomposedSystem(system, args.workers) as decomposed:
+        start = time.perf_counter()
+        result = decomposed.advance(state, args.nt)
+        decomposed_s = time.perf_counter() - start
+    print('{} workers: {:.3f}s ({:.2f} steps/s)'.format(
+        args.workers, decomposed_s, args.nt / decomposed_s))
+
+    if not args.skip_serial:
+        start = time.perf_counter()
+        serial = advance(system, state, args.nt)
+        serial_s = time.perf_counter() - start
+        print('serial:    {:.3f}s ({:.2f} steps/s), {:.2f}x speedup'.format(
+            serial_s, args.nt / serial_s, serial_s / decomposed_s))
+        print('max difference: u {:.2e}, v {:.2e}, p {:.2e}'.format(
+            *[np.abs(x - y).max() for x, y in zip(np.array(result)[[0, 1, 4]],
+                                                   np.array(serial)[[0, 1, 4]])]))
@@ -8,6 +8,8 @@ superficial boundary conditions on pressure.
 import numpy as np
 from tqdm import tqdm
 
+from src.profiling import NullProfiler
+
 
 class NavierStokesSystem():
     """
@@ -41,10 +43,14 @@ class NavierStokesSystem():
           constant in the Navier Stokes equations
     nu : float
          constant in the Navier Stokes equations
+    profiler : object
+               instrumentation for the phases of step(), see src.profiling
+               (default: None, no instrumentation)
     """
 
     def __init__(self, u_ic, v_ic, p_ic, u_bc, v_bc, p_bc, 
-                 nt=200, nit=50, nx=50, ny=50, dt=0.001, rho=1, nu=0.1):
+                 nt=200, nit=50, nx=50, ny=50, dt=0.001, rho=1, nu=0.1,
+                 profiler=None):
         super().__init__()
         self.u_ic, self.v_ic, self.p_ic = u_ic, v_ic, p_ic
         self.u_bc, self.v_bc, self.p_bc = u_bc, v_bc, p_bc
@@ -52,6 +58,7 @@ class NavierStokesSystem():
         # hard code to size of x over 2 (un-dimensionalize to [-1, 1])
         self.dx, self.dy = 2. / (self.nx - 1), 2. / (self.ny - 1)
         self.nit, self.rho, self.nu = nit, rho, nu
+        self.profiler = NullProfiler() if profiler is None else profiler
 
     def _build_up_b(self, u, v):
         rho, dt, dx, dy = self.rho, self.dt, self.dx, self.dy
@@ -72,26 +79,28 @@ class NavierStokesSystem():
         dt, dx, dy = self.dt, self.dx, self.dy
         rho, nu = self.rho, self.nu
 
-        dx, dy = self.dx, self.dy
         for q in range(self.nit):
             pn = p.copy()
-            p[1:-1, 1:-1] = (((pn[1:-1, 2:] + pn[1:-1, 0:-2]) * dy**2 + 
-                            (pn[2:, 1:-1] + pn[0:-2, 1:-1]) * dx**2) /
-                            (2 * (dx**2 + dy**2)) -
-                            dx**2 * dy**2 / (2 * (dx**2 + dy**2)) * 
-                            b[1:-1,1:-1])
+            self._pressure_sweep(p, pn, b)
 
             # set boundary conditions for pressure
             for bc in self.p_bc:
                 p = bc.apply(p)
-            
-        return p
 
-    def step(self, u, v, p):
-        un, vn = u.copy(), v.copy()
-        b = self._build_up_b(u, v)
-        p = self._pressure_poisson(p, b)
+        self.profiler.count('pressure_iterations', self.nit)
+        return p
 
+    def _pressure_sweep(self, p, pn, b):
+        # one Jacobi sweep of the interior of p from pn, in place
+        dx, dy = self.dx, self.dy
+        p[1:-1, 1:-1] = (((pn[1:-1, 2:] + pn[1:-1, 0:-2]) * dy**2 + 
+                        (pn[2:, 1:-1] + pn[0:-2, 1:-1]) * dx**2) /
+                        (2 * (dx**2 + dy**2)) -
+                        dx**2 * dy**2 / (2 * (dx**2 + dy**2)) * 
+                        b[1:-1,1:-1])
+
+    def _momentum_step(self, u, v, un, vn, p):
+        # update the interior of u and v in place from un, vn and p
         dt, dx, dy = self.dt, self.dx, self.dy
         rho, nu = self.rho, self.nu
 
@@ -117,25 +126,53 @@ class NavierStokesSystem():
                         dt / dy**2 *
                        (vn[2:, 1:-1] - 2 * vn[1:-1, 1:-1] + vn[0:-2, 1:-1])))
 
+    def step(self, u, v, p):
+        with self.profiler.phase('step'):
+            return self._step(u, v, p)
+
+    def _step(self, u, v, p):
+        profiler = self.profiler
+        un, vn = u.copy(), v.copy()
+        with profiler.phase('build_up_b'):
+            b = self._build_up_b(u, v)
+        with profiler.phase('pressure'):
+            p = self._pressure_poisson(p, b)
+
+        with profiler.phase('momentum'):
+            self._momentum_step(u, v, un, vn, p)
+
         # set boundary conditions
-        for bc in self.u_bc:
-            u = bc.apply(u)
-        
-        for bc in self.v_bc:
-            v = bc.apply(v)
+        with profiler.phase('boundary'):
+            for bc in self.u_bc:
+                u = bc.apply(u)
+
+            for bc in self.v_bc:
+                v = bc.apply(v)
 
         return u, v, p
 
-    def simulate(self):
+    def simulate(self, tol=None):
+        """
+        March nt steps from the initial conditions and stack the fields
+        of every step. With tol, stop early once the largest change of
+        u or v over one step falls below tol (a steady state); fewer
+        than nt steps are returned then.
+        """
         # collect propagations for dataset
         u_list, v_list, p_list = [], [], []
         u, v, p = self.u_ic, self.v_ic, self.p_ic
     
         for n in tqdm(range(self.nt)):
+            if tol is not None:
+                # step updates u and v in place
+                u1, v1 = u.copy(), v.copy()
             u, v, p = self.step(u, v, p)
             u_list.append(u.copy())
             v_list.append(v.copy())
             p_list.append(p.copy())
+
+            if tol is not None and max(np.abs(u - u1).max(), np.abs(v - v1).max()) < tol:
+                break
     
         u_list = np.stack(u_list)
         v_list = np.stack(v_list)
@@ -0,0 +1,151 @@
+"""
+Time the forward and backward pass of spectral_ode.PDEFunc and record
+its peak memory under each gradient backend (anode adjoint, torchdiffeq
+adjoint, direct backprop) across numbers of coefficients, window
+lengths and grid sizes. Every configuration runs in a fresh process so
+the peak resident set size (or peak CUDA allocation) belongs to that
+configuration alone. Results are written as JSON.
+
+    python -m src.neural_spectral.adjoint_benchmark --n-coeffs 5 10 --nt 20 100 \
+        --grid 16 51 --out adjoint_benchmark.json
+"""
+import os
+import sys
+import json
+import time
+import platform
+import resource
+import itertools
+import subprocess
+
+import torch
+
+
+def peak_rss_mb():
+    # ru_maxrss is in kilobytes on Linux and bytes on macOS
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return rss / 1024. ** 2 if sys.platform == 'darwin' else rss / 1024.
+
+
+def run_config(backend, K, nt, nx, ny, batch_size, n_repeats, device):
+    """Benchmark one configuration in this process and return a result dict."""
+    from src.neural_spectral.spectral_ode import PDEFunc
+
+    def sync():
+        if device.type == 'cuda':
+            torch.cuda.synchronize(device)
+
+    torch.manual_seed(0)
+    model = PDEFunc(K, nx, ny, init_from_grid=True, backend=backend).to(device)
+    obs = torch.randn(nt, batch_size, 3, nx, ny, device=device)
+    t = (torch.arange(nt) + 1).to(device)
+
+    base_rss = peak_rss_mb()
+    if device.type == 'cuda':
+        torch.cuda.reset_peak_memory_stats(device)
+        base_cuda = torch.cuda.memory_allocated(device) / 1024. ** 2
+
+    forward_times, backward_times = [], []
+    for i in range(n_repeats + 1):  # the first repeat is a warm up
+        model.zero_grad()
+        sync()
+        start = time.perf_counter()
+        obs_pred = model(obs[0], t)
+        loss = torch.norm(obs_pred - obs, p=2)
+        sync()
+        middle = time.perf_counter()
+        loss.backward()
+        sync()
+        end = time.perf_counter()
+        if i > 0:
+            forward_times.append(middle - start)
+            backward_times.append(end - middle)
+
+    result = {
+        'backend': backend, 'n_coeffs': K, 'nt': nt, 'nx': nx, 'ny': ny,
+        'batch_size': batch_size, 'device': str(device),
+        'forward_s': min(forward_times), 'backward_s': min(backward_times),
+        'forward_s_mean': sum(forward_times) / n_repeats,
+        'backward_s_mean': sum(backward_times) / n_repeats,
+        'base_rss_mb': base_rss, 'peak_rss_mb': peak_rss_mb(),
+        'nfe': model.nfe if backend != 'torchdiffeq' else None,
+        'loss': loss.item(),
+    }
+    if device.type == 'cuda':
+        result['base_cuda_mb'] = base_cuda
+        result['peak_cuda_mb'] = torch.cuda.max_memory_allocated(device) / 1024. ** 2
+    return result
+
+
+def spawn_config(backend, K, nt, grid, args):
+    """Run one configuration in a subprocess and parse its JSON line."""
+    cmd = [sys.executable, '-m', 'src.neural_spectral.adjoint_benchmark', '--worker',
+           '--backends', backend, '--n-coeffs', str(K), '--nt', str(nt), '--grid', str(grid),
+           '--batch-size', str(args.batch_size), '--n-repeats', str(args.n_repeats),
+           '--gpu-device', str(args.gpu_device)]
+    if args.cpu:
+        cmd.append('--cpu')
+    proc = subprocess.run(cmd, capture_output=True, text=True)
+    config = {'backend': backend, 'n_coeffs': K, 'nt': nt, 'nx': grid, 'ny': grid}
+    if proc.returncode != 0:
+        # e.g. out of memory: keep the failure in the results
+        config['error'] = proc.stderr.strip().splitlines()[-1] if proc.stderr.strip() else \
+            'exit code {}'.format(proc.returncode)
+        return config
+    return json.loads(proc.stdout.strip().splitlines()[-1])
+
+
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--backends', type=str, nargs='+', default=['anode', 'torchdiffeq', 'direct'],
+                        choices=['anode', 'torchdiffeq', 'direct'],
+                        help='default: anode torchdiffeq direct')
+    parser.add_argument('--n-coeffs', type=int, nargs='+', default=[5, 10, 20], help='default: 5 10 20')
+    parser.add_argument('--nt', type=int, nargs='+', default=[20, 100], help='default: 20 100')
+    parser.add_argument('--grid', type=int, nargs='+', default=[16, 51],
+                        help='grid sizes nx = ny [default: 16 51]')
+    parser.add_argument('--batch-size', type=int, default=1, help='default: 1')
+    parser.add_argument('--n-repeats', type=int, default=3, help='default: 3')
+    parser.add_argument('--out', type=str, default='adjoint_benchmark.json',
+                        help='where to write the results [default: adjoint_benchmark.json]')
+    parser.add_argument('--cpu', action='store_true', default=False, help='never use a GPU')
+    parser.add_argument('--gpu-device', type=int, default=0, help='default: 0')
+    parser.add_argument('--worker', action='store_true', default=False,
+                        help='run the single given configuration and print it as JSON')
+    args = parser.parse_args()
+
+    device = (torch.device('cuda:' + str(args.gpu_device)
+              if torch.cuda.is_available() and not args.cpu else 'cpu'))
+
+    if args.worker:
+        result = run_config(args.backends[0], args.n_coeffs[0], args.nt[0],
+                            args.grid[0], args.grid[0], args.batch_size, args.n_repeats, device)
+        print(json.dumps(result))
+        sys.exit(0)
+
+    results = []
+    configs = list(itertools.product(args.n_coeffs, args.nt, args.grid, args.backends))
+    for i, (K, nt, grid, backend) in enumerate(configs):
+        result = spawn_config(backend, K, nt, grid, args)
+        results.append(result)
+        if 'error' in result:
+            summary = 'failed: {}'.format(result['error'])
+        else:
+            summary = 'fwd {:.4f}s  bwd {:.4f}s  peak rss {:.0f} MB (+{:.1f} MB)'.format(
+                result['forward_s'], result['backward_s'], result['peak_rss_mb'],
+                result['peak_rss_mb'] - result['base_rss_mb'])
+        print('[{}/{}] {:12s} K={:<3d} nt={:<4d} grid={:<4d} {}'.format(
+            i + 1, len(configs), backend, K, nt, grid, summary))
+
+    with open(args.out, 'w') as fp:
+        json.dump({
+            'torch_version': torch.__version__,
+            'python_version': platform.python_version(),
+            'platform': platform.platform(),
+            'cpu_count': os.cpu_count(),
+            'device': str(device),
+            'n_repeats': args.n_repeats,
+            'results': results,
+        }, fp, indent=2)
+    print('wrote {} results to {}'.format(len(results), args.out))
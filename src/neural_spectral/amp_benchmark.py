@@ -0,0 +1,116 @@
+"""
+Compare an --amp training step against float32 for one of the neural
+models: relative drift of the loss, predictions and gradients (same
+weights, same window) and the throughput of forward + backward.
+
+    python -m src.neural_spectral.amp_benchmark --model spectral_ode --amp bf16
+"""
+import time
+import copy
+import numpy as np
+
+import torch
+
+from src.neural_spectral.data import load_trajectory
+from src.utils import autocast, grad_scaler
+
+
+def build_model(name, nx, ny, K):
+    if name == 'rnn':
+        from src.neural_spectral.rnn import RNN
+        return RNN(nx * ny * 3, 512)
+    elif name == 'conv_rnn':
+        from src.neural_spectral.conv_rnn import ConvRNN
+        return ConvRNN(nx, ny, 512)
+    elif name == 'spectral_ode':
+        from src.neural_spectral.spectral_ode import PDEFunc
+    elif name == 'spectral_ode2':
+        from src.neural_spectral.spectral_ode2 import PDEFunc
+    elif name == 'spectral_rnn':
+        from src.neural_spectral.spectral_rnn import PDEFunc
+    else:
+        raise ValueError('unknown model {}'.format(name))
+    return PDEFunc(K, nx, ny, init_from_grid=True)
+
+
+def train_step(model, obs, device, amp):
+    """One forward + backward on a mb x nt x 3 x nx x ny window, the way
+    the training scripts do it. Returns loss, predictions and gradients."""
+    model.zero_grad()
+    scaler = grad_scaler(device, amp)
+    mb, nt = obs.size(0), obs.size(1)
+    with autocast(device, amp):
+        if hasattr(model, 'extrapolate'):  # rnn-style next frame prediction
+            obs = obs.reshape(mb, nt, -1)
+            obs_pred, _ = model(obs[:, :-1])
+            target = obs[:, 1:]
+        else:
+            target = obs.transpose(0, 1)
+            t = (torch.arange(nt) + 1).to(device)
+            obs_pred = model(target[0], t)
+    loss = torch.norm(obs_pred.float() - target, p=2)
+    scaler.scale(loss).backward()
+    scale = scaler.get_scale() if scaler.is_enabled() else 1.
+    grads = torch.cat([p.grad.flatten() / scale for p in model.parameters()
+                       if p.grad is not None])
+    return loss.detach(), obs_pred.detach().float(), grads
+
+
+def relative_error(a, b):
+    return (torch.norm(a - b) / torch.norm(b)).item()
+
+
+def benchmark(model, obs, device, amp, n_repeats):
+    train_step(model, obs, device, amp)  # warm up
+    if device.type == 'cuda':
+        torch.cuda.synchronize(device)
+    start = time.perf_counter()
+    for _ in range(n_repeats):
+        train_step(model, obs, device, amp)
+    if device.type == 'cuda':
+        torch.cuda.synchronize(device)
+    return n_repeats * obs.size(0) / (time.perf_counter() - start)
+
+
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--model', type=str, default='spectral_ode',
+                        choices=['rnn', 'conv_rnn', 'spectral_ode', 'spectral_ode2', 'spectral_rnn'],
+                        help='default: spectral_ode')
+    parser.add_argument('--npz-path', type=str, default='../data/data_semi_implicit.npz',
+                        help='trajectory to take the window from')
+    parser.add_argument('--amp', type=str, default='bf16', choices=['bf16', 'fp16'],
+                        help='default: bf16')
+    parser.add_argument('--n-coeffs', type=int, default=10, help='default: 10')
+    parser.add_argument('--window', type=int, default=100, help='default: 100')
+    parser.add_argument('--batch-size', type=int, default=1, help='default: 1')
+    parser.add_argument('--n-repeats', type=int, default=10, help='default: 10')
+    parser.add_argument('--gpu-device', type=int, default=0, help='default: 0')
+    args = parser.parse_args()
+
+    device = (torch.device('cuda:' + str(args.gpu_device)
+              if torch.cuda.is_available() else 'cpu'))
+
+    obs = load_trajectory(args.npz_path, args.window)
+    nx, ny = obs.size(2), obs.size(3)
+    obs = obs.unsqueeze(0).repeat(args.batch_size, 1, 1, 1, 1).to(device)
+
+    torch.manual_seed(0)
+    model = build_model(args.model, nx, ny, args.n_coeffs).to(device)
+    model_amp = copy.deepcopy(model)
+
+    loss, pred, grads = train_step(model, obs, device, 'none')
+    loss_amp, pred_amp, grads_amp = train_step(model_amp, obs, device, args.amp)
+    fp32_rate = benchmark(model, obs, device, 'none', args.n_repeats)
+    amp_rate = benchmark(model_amp, obs, device, args.amp, args.n_repeats)
+
+    print('{} vs float32 ({}, {})'.format(args.amp, args.model, device))
+    print('  loss drift:        {:.3e}'.format(relative_error(loss_amp, loss)))
+    print('  prediction drift:  {:.3e}'.format(relative_error(pred_amp, pred)))
+    if torch.isfinite(grads_amp).all():
+        print('  gradient drift:    {:.3e}'.format(relative_error(grads_amp, grads)))
+    else:
+        print('  gradient drift:    overflow (GradScaler would skip this step and lower the scale)')
+    print('  throughput:        {:.2f} -> {:.2f} samples/s ({:.2f}x)'.format(
+        fp32_rate, amp_rate, amp_rate / fp32_rate))
@@ -1,2 +1,3 @@
 from src.neural_spectral.anode.odesolver import odesolver
 from src.neural_spectral.anode.adjoint import odesolver_adjoint
+from src.neural_spectral.anode.ensemble import Ensemble, odesolver_ensemble
@@ -15,10 +15,11 @@
 # You should have received a copy of the GNU General Public License
 # along with ANODE.  If not, see <http://www.gnu.org/licenses/>.
 #*
+import math
 import torch
 import torch.nn as nn
 from src.neural_spectral.anode import odesolver
-from torch.autograd import Variable
+from src.neural_spectral.anode.odesolver import get_solver, SOLVERS
 
 
 def flatten_params(params):
@@ -35,7 +36,28 @@ def flatten_params_grad(params, params_ref):
     return torch.cat(flat_params) if len(flat_params) > 0 else torch.tensor([])
 
 
+def checkpoint_interval(n_out, options):
+    """Output times per checkpointed segment, options['checkpoint_every']
+    or about sqrt(n_out), which minimizes the O(n_out/c + c) peak memory.
+    Adaptive methods would choose different steps when restarted from
+    a checkpoint, so they always recompute the whole horizon."""
+    if getattr(SOLVERS.get(options['method']), 'adaptive', False):
+        return n_out
+    c = options.get('checkpoint_every')
+    if c is None:
+        c = int(math.ceil(math.sqrt(n_out)))
+    return max(1, min(int(c), n_out))
+
+
 class Checkpointing_Adjoint(torch.autograd.Function):
+    """
+    Integrate without a graph and keep the state at every c-th output
+    time (every c steps for the default outputs). The
+    backward pass walks the segments in reverse: each one is recomputed
+    from its checkpoint with a graph, backpropagated with a single
+    autograd.grad call for the segment input and the parameters, and
+    freed before the next, so at most one segment's graph is alive.
+    """
 
     @staticmethod
     def forward(ctx, *args):
@@ -44,33 +66,142 @@ class Checkpointing_Adjoint(torch.autograd.Function):
 
         with torch.no_grad():
             ans = odesolver(func, z0, options) 
-        ctx.save_for_backward(z0)
+        # ans[i] is the state at output i, so segments starting at
+        # outputs c, 2c, ... start from ans[c - 1], ans[2c - 1], ...;
+        # cloned because the caller may modify ans in place
+        c = checkpoint_interval(ans.size(0), options)
+        checkpoints = ans[c - 1:-1:c].clone()
+        ctx.save_for_backward(z0, checkpoints)
         ctx.in1 = options
+        ctx.checkpoint_every = c
+        # the recomputation in backward must see the same autocast state
+        device_type = z0.device.type
+        ctx.autocast = (device_type, torch.is_autocast_enabled(device_type),
+                        torch.get_autocast_dtype(device_type))
         return ans
 
     @staticmethod
     def backward(ctx, grad_output):
 
-        z0 = ctx.saved_tensors
+        z0, checkpoints = ctx.saved_tensors
         options = ctx.in1
         func = ctx.func
-        f_params = func.parameters()
-        t = 0
+        c = ctx.checkpoint_every
+        solver = get_solver(func, z0, options)
+        n_out = grad_output.size(0)
+
+        f_params = list(func.parameters())
+        trainable = [p for p in f_params if p.requires_grad]
+        param_grads = [torch.zeros_like(p) for p in trainable]
+        adj_z = None  # dL/d(state at the end of the current segment)
+
+        device_type, autocast_enabled, autocast_dtype = ctx.autocast
+        for k in reversed(range(0, n_out, c)):
+            n_end = min(k + c, n_out)
+            z_start = z0 if k == 0 else checkpoints[k // c - 1]
+            with torch.set_grad_enabled(True), \
+                    torch.autocast(device_type, dtype=autocast_dtype, enabled=autocast_enabled):
+                z = z_start.detach().requires_grad_(True)
+                func_eval = solver.integrate_outputs(z, k, n_end)
+                grad_segment = grad_output[k:n_end]
+                if adj_z is not None:
+                    # the segment end also feeds every later segment
+                    grad_segment = grad_segment.clone()
+                    grad_segment[-1] += adj_z
+                out = torch.autograd.grad(
+                   func_eval, [z] + trainable,
+                   grad_segment, allow_unused=True)
+            adj_z = out[0]
+            for g, dp in zip(param_grads, out[1:]):
+                if dp is not None:
+                    g += dp
+        options['nfe_backward'] = solver.nfe
+
+        grads = iter(param_grads)
+        out2 = [next(grads) if p.requires_grad else None for p in f_params]
+        return adj_z, None, flatten_params_grad(out2, f_params), None
+
+
+class Reversible_Adjoint(torch.autograd.Function):
+    """
+    Adjoint for reversible schemes (ALF). Only the final augmented state
+    is kept; backward inverts the steps one at a time to recover each
+    step's input, recomputes that single step with a graph and pulls the
+    adjoint of (z, v) through it. Memory is constant in the number of
+    steps and the gradients are those of the discrete forward pass, up
+    to the round-off of the reconstruction.
+    """
+
+    @staticmethod
+    def forward(ctx, *args):
+        z0, func, flat_params, options= args[0], args[1], args[2], args[3]
+        ctx.func = func
+
+        solver = get_solver(func, z0, options)
+        with torch.no_grad():
+            ans, v = solver.integrate_alf(z0, 0., solver.t)
+        options['nfe'] = solver.nfe
+        ctx.save_for_backward(z0, ans[-1].clone(), v)
+        ctx.in1 = options
+        device_type = z0.device.type
+        ctx.autocast = (device_type, torch.is_autocast_enabled(device_type),
+                        torch.get_autocast_dtype(device_type))
+        return ans
+
+    @staticmethod
+    def backward(ctx, grad_output):
+
+        z0, z, v = ctx.saved_tensors
+        options = ctx.in1
+        func = ctx.func
+        solver = get_solver(func, z0, options)
+
+        f_params = list(func.parameters())
+        trainable = [p for p in f_params if p.requires_grad]
+        param_grads = [torch.zeros_like(p) for p in trainable]
+        adj_z, adj_v = torch.zeros_like(z), torch.zeros_like(v)
+
+        def pull_back(outputs, inputs, grad_outputs):
+            out = torch.autograd.grad(outputs, inputs + trainable, grad_outputs, allow_unused=True)
+            for g, dp in zip(param_grads, out[len(inputs):]):
+                if dp is not None:
+                    g += dp
+            return [torch.zeros_like(x) if dx is None else dx
+                    for x, dx in zip(inputs, out[:len(inputs)])]
+
+        device_type, autocast_enabled, autocast_dtype = ctx.autocast
+        with torch.autocast(device_type, dtype=autocast_dtype, enabled=autocast_enabled):
+            t_out = solver.t
+            for i in reversed(range(len(t_out))):
+                adj_z = adj_z + grad_output[i]
+                t0 = t_out[i - 1] if i > 0 else 0.
+                n_sub, dt = solver.substeps(t0, t_out[i])
+                for n in reversed(range(n_sub)):
+                    t = t0 + n * dt
+                    with torch.no_grad():
+                        z, v = solver.inverse_step_alf(solver.rhs, t, dt, z, v)
+                    with torch.set_grad_enabled(True):
+                        z_in = z.detach().requires_grad_(True)
+                        v_in = v.detach().requires_grad_(True)
+                        z_out, v_out = solver.step_alf(solver.rhs, t, dt, z_in, v_in)
+                        adj_z, adj_v = pull_back([z_out, v_out], [z_in, v_in], [adj_z, adj_v])
 
-        with torch.set_grad_enabled(True):
-            z = Variable(z0[0].detach(),requires_grad=True)
-            func_eval = odesolver(func, z, options) 
-            out1 = torch.autograd.grad(
-               func_eval,  z,
-               grad_output, allow_unused=True, retain_graph=True)
-            out2 = torch.autograd.grad(
-               func_eval,  f_params,
-               grad_output, allow_unused=True, retain_graph=True)
+            # v0 = f(0, z0)
+            with torch.set_grad_enabled(True):
+                z_in = z0.detach().requires_grad_(True)
+                v0 = solver.rhs(0., z_in).to(z_in.dtype)
+                adj_z = adj_z + pull_back([v0], [z_in], [adj_v])[0]
+        options['nfe_backward'] = solver.nfe
 
-        return out1[0], None, flatten_params_grad(out2, func.parameters()), None
+        grads = iter(param_grads)
+        out2 = [next(grads) if p.requires_grad else None for p in f_params]
+        return adj_z, None, flatten_params_grad(out2, f_params), None
 
 
 def odesolver_adjoint(func, z0, options = None):
     flat_params = flatten_params(func.parameters())
-    zs = Checkpointing_Adjoint.apply(z0, func, flat_params, options)
+    if getattr(SOLVERS.get(options['method']), 'reversible', False):
+        zs = Reversible_Adjoint.apply(z0, func, flat_params, options)
+    else:
+        zs = Checkpointing_Adjoint.apply(z0, func, flat_params, options)
     return zs
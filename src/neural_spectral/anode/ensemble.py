@@ -0,0 +1,97 @@
+#*
+# @file ensemble.py
+# This file is part of ANODE library.
+#
+# ANODE is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# ANODE is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with ANODE.  If not, see <http://www.gnu.org/licenses/>.
+#*
+import copy
+import torch
+import torch.nn as nn
+from torch.func import functional_call, stack_module_state, vmap
+from src.neural_spectral.anode import odesolver, odesolver_adjoint
+
+
+class Ensemble(nn.Module):
+    """
+    E independent copies of an ODE function evaluated as one. The
+    parameters of the members are stacked along a leading axis and
+    the member forward is vmapped over it, so the ensemble is itself
+    an ODE function on states of size E x ... that the (adjoint)
+    solvers integrate in a single call.
+
+    All members must share an architecture (e.g. one ensemble per
+    number of coefficients in a sweep, with members differing by seed
+    or initialization). Adaptive methods pick one step size for the
+    whole ensemble from the error of all members together.
+
+    Args
+    ----
+    modules := list of nn.Module
+               members with identical parameter names and shapes;
+               called as module(t, z)
+    """
+
+    def __init__(self, modules):
+        super().__init__()
+        self.n_members = len(modules)
+        params, buffers = stack_module_state(modules)
+        # ParameterDict keys may not contain '.'
+        self._names = {name.replace('.', '_'): name for name in params}
+        self.params = nn.ParameterDict({
+            key: nn.Parameter(params[name].detach().clone()) for key, name in self._names.items()})
+        self._buffer_names = {name.replace('.', '_'): name for name in buffers}
+        for key, name in self._buffer_names.items():
+            self.register_buffer('buffer_' + key, buffers[name].clone())
+        # stateless copy used as the template in functional_call; kept in
+        # a list so it is not registered as a submodule
+        self._base = [copy.deepcopy(modules[0]).to('meta')]
+
+    def _state(self):
+        params = {name: self.params[key] for key, name in self._names.items()}
+        buffers = {name: getattr(self, 'buffer_' + key) for key, name in self._buffer_names.items()}
+        return params, buffers
+
+    def forward(self, t, z):
+        # z = E x mb x D, evaluated member-wise
+        base = self._base[0]
+
+        def member(params, buffers, z):
+            return functional_call(base, (params, buffers), (t, z))
+
+        params, buffers = self._state()
+        return vmap(member)(params, buffers, z)
+
+    def member(self, i):
+        """A standalone copy of member i, e.g. to save or evaluate it alone."""
+        module = copy.deepcopy(self._base[0]).to_empty(device=self.params[next(iter(self.params))].device)
+        params, buffers = self._state()
+        state = {name: p[i].detach().clone() for name, p in params.items()}
+        state.update({name: b[i].clone() for name, b in buffers.items()})
+        module.load_state_dict(state)
+        return module
+
+
+def odesolver_ensemble(ensemble, z0, options = None, adjoint = True):
+    """
+    Integrate every member of an Ensemble from its own initial state.
+    z0 is E x mb x D; returns Nt x E x mb x D. With adjoint, gradients
+    come from the checkpointing adjoint, which recomputes all members
+    together and takes one autograd.grad call per segment for the
+    stacked parameters.
+    """
+    assert z0.size(0) == ensemble.n_members, \
+        'z0 has {} members but the ensemble has {}'.format(z0.size(0), ensemble.n_members)
+    if adjoint:
+        return odesolver_adjoint(ensemble, z0, options)
+    return odesolver(ensemble, z0, options)
@@ -15,23 +15,39 @@
 # You should have received a copy of the GNU General Public License
 # along with ANODE.  If not, see <http://www.gnu.org/licenses/>.
 #*
-from src.neural_spectral.anode.scheme import Euler, RK2, RK4
+from src.neural_spectral.anode.scheme import Euler, RK2, RK4, Bosh3, Dopri5, ALF
 
+SOLVERS = {'Euler': Euler, 'RK2': RK2, 'RK4': RK4, 'Bosh3': Bosh3, 'Dopri5': Dopri5,
+           'ALF': ALF}
 
-def odesolver(func, z0, options = None):
+
+def get_solver(func, z0, options = None):
     if options == None:
-        Nt = 2
-    else:
-        Nt = options['Nt']
-    if (options['method'] == 'Euler'):
-        solver = Euler(func, z0, Nt = Nt)
-    elif (options['method'] == 'RK2'):
-        solver = RK2(func, z0, Nt = Nt)
-    elif (options['method'] == 'RK4'):
-        solver = RK4(func, z0, Nt = Nt)
-    else:
+        options = {'method': 'RK4'}
+    Nt = options.get('Nt', 2)
+    if options['method'] not in SOLVERS:
         print('error unsupported method passed')
         return
+    solver_cls = SOLVERS[options['method']]
+    # optional output times in [0, 1]; Nt then only sets the step size
+    t = options.get('t')
+    if getattr(solver_cls, 'adaptive', False):
+        solver = solver_cls(func, z0, Nt = Nt, t = t,
+                            rtol = options.get('rtol', 1e-3),
+                            atol = options.get('atol', 1e-6))
+    elif solver_cls is ALF:
+        solver = solver_cls(func, z0, Nt = Nt, t = t, eta = options.get('eta', 1.))
+    else:
+        solver = solver_cls(func, z0, Nt = Nt, t = t)
+    return solver
+
+
+def odesolver(func, z0, options = None):
+    solver = get_solver(func, z0, options)
+    if solver is None:
+        return
     z1 = solver.integrate(z0)
+    if options is not None:
+        options['nfe'] = solver.nfe  # reported back to the caller
 
     return z1
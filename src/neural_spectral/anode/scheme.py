@@ -15,28 +15,117 @@
 # You should have received a copy of the GNU General Public License
 # along with ANODE.  If not, see <http://www.gnu.org/licenses/>.
 #*
-from src.neural_spectral.anode.time_stepper import Time_Stepper
+from src.neural_spectral.anode.time_stepper import Time_Stepper, Embedded_Time_Stepper
 
 
+# func may run under autocast and return low precision slopes; casting
+# them to the dtype of y keeps the state accumulation in full precision
+
 class Euler(Time_Stepper):
     def step(self, func, t, dt, y):
-        out = y + dt * func(t, y)
+        out = y + dt * func(t, y).to(y.dtype)
         return out
 
 
 class RK2(Time_Stepper):
     def step(self, func, t, dt, y):
-        k1 = dt * func(t, y)
-        k2 = dt * func(t + dt / 2.0, y + 1.0 / 2.0 * k1)
+        k1 = dt * func(t, y).to(y.dtype)
+        k2 = dt * func(t + dt / 2.0, y + 1.0 / 2.0 * k1).to(y.dtype)
         out = y + k2
         return out
 
 
 class RK4(Time_Stepper):
     def step(self, func, t, dt, y):
-        k1 = dt * func(t, y)
-        k2 = dt * func(t + dt / 2.0, y + 1.0 / 2.0 * k1)
-        k3 = dt * func(t + dt / 2.0, y + 1.0 / 2.0 * k2)
-        k4 = dt * func(t + dt, y + k3)
+        k1 = dt * func(t, y).to(y.dtype)
+        k2 = dt * func(t + dt / 2.0, y + 1.0 / 2.0 * k1).to(y.dtype)
+        k3 = dt * func(t + dt / 2.0, y + 1.0 / 2.0 * k2).to(y.dtype)
+        k4 = dt * func(t + dt, y + k3).to(y.dtype)
         out = y + 1.0 / 6.0 * k1 + 1.0 / 3.0 * k2 + 1.0 / 3.0 * k3 + 1.0 / 6.0 * k4
         return out
+
+
+class ALF(Time_Stepper):
+    """
+    Asynchronous leapfrog (Zhuang et al., MALI, ICLR 2021). The state
+    is augmented with v, an estimate of dz/dt starting at f(0, z0):
+
+        k = z + dt/2 v,   u = f(t + dt/2, k)
+        v' = v + 2 eta (u - v),   z' = k + dt/2 v'
+
+    Every step can be inverted in closed form, so the adjoint in
+    adjoint.py reconstructs the trajectory backward in time instead of
+    storing it. eta < 1 damps v for stiffer problems, but the inverse
+    step then amplifies round-off by |1 / (1 - 2 eta)|, so long float32
+    rollouts should keep the default eta = 1; eta = 1/2 is not invertible.
+    """
+    reversible = True
+
+    def __init__(self, func, y0, Nt = 2, t = None, eta = 1.):
+        super().__init__(func, y0, Nt = Nt, t = t)
+        assert eta != 0.5, 'ALF with eta = 1/2 is not invertible'
+        self.eta = eta
+
+    def step(self, func, t, dt, y):
+        z, _ = self.step_alf(func, t, dt, y, func(t, y).to(y.dtype))
+        return z
+
+    def step_alf(self, func, t, dt, z, v):
+        k = z + 0.5 * dt * v
+        u = func(t + dt / 2.0, k).to(z.dtype)
+        v = v + 2.0 * self.eta * (u - v)
+        return k + 0.5 * dt * v, v
+
+    def inverse_step_alf(self, func, t, dt, z, v):
+        # (z, v) at t + dt -> (z, v) at t
+        k = z - 0.5 * dt * v
+        u = func(t + dt / 2.0, k).to(z.dtype)
+        v = (v - 2.0 * self.eta * u) / (1.0 - 2.0 * self.eta)
+        return k - 0.5 * dt * v, v
+
+    def integrate_times(self, y0, t0, t_out):
+        y1_all, _ = self.integrate_alf(y0, t0, t_out)
+        return y1_all
+
+    def integrate_alf(self, y0, t0, t_out):
+        """Like integrate_times, but also returns v at the last output time."""
+        z = y0
+        v = self.rhs(t0, y0).to(y0.dtype)
+        y1_all = y0.new_empty((len(t_out),) + y0.shape)
+        for i, t1 in enumerate(t_out):
+            n_sub, dt = self.substeps(t0, t1)
+            for n in range(n_sub):
+                z, v = self.step_alf(self.rhs, t0 + n * dt, dt, z, v)
+            y1_all[i] = z
+            t0 = t1
+        return y1_all, v
+
+
+class Bosh3(Embedded_Time_Stepper):
+    # Bogacki-Shampine 3(2)
+    c = [0., 1. / 2., 3. / 4., 1.]
+    a = [[1. / 2.],
+         [0., 3. / 4.],
+         [2. / 9., 1. / 3., 4. / 9.]]
+    b = [2. / 9., 1. / 3., 4. / 9., 0.]
+    b_err = [2. / 9. - 7. / 24., 1. / 3. - 1. / 4., 4. / 9. - 1. / 3., -1. / 8.]
+    error_order = 3
+
+
+class Dopri5(Embedded_Time_Stepper):
+    # Dormand-Prince 5(4)
+    c = [0., 1. / 5., 3. / 10., 4. / 5., 8. / 9., 1., 1.]
+    a = [[1. / 5.],
+         [3. / 40., 9. / 40.],
+         [44. / 45., -56. / 15., 32. / 9.],
+         [19372. / 6561., -25360. / 2187., 64448. / 6561., -212. / 729.],
+         [9017. / 3168., -355. / 33., 46732. / 5247., 49. / 176., -5103. / 18656.],
+         [35. / 384., 0., 500. / 1113., 125. / 192., -2187. / 6784., 11. / 84.]]
+    b = [35. / 384., 0., 500. / 1113., 125. / 192., -2187. / 6784., 11. / 84., 0.]
+    b_err = [35. / 384. - 5179. / 57600., 0., 500. / 1113. - 7571. / 16695.,
+             125. / 192. - 393. / 640., -2187. / 6784. + 92097. / 339200.,
+             11. / 84. - 187. / 2100., -1. / 40.]
+    c_mid = [6025192743. / 30085553152. / 2., 0., 51252292925. / 65400821598. / 2.,
+             -2691868925. / 45128329728. / 2., 187940372067. / 1594534317056. / 2.,
+             -1776094331. / 19743644256. / 2., 11237099. / 235043384. / 2.]
+    error_order = 5
@@ -16,30 +16,179 @@
 # along with ANODE.  If not, see <http://www.gnu.org/licenses/>.
 #*
 import abc
+import math
 import torch
 import copy
 import numpy as np
 
 
 class Time_Stepper(object):
+    """
+    Integrates over [0, 1] with a nominal step of 1 / Nt and reports
+    the state at the output times t (increasing, in [0, 1]). Between
+    two output times the solver takes as many equal steps as needed to
+    keep the step no larger than 1 / Nt, so the internal resolution is
+    independent of how many (or how irregular) the outputs are. By
+    default the outputs are the Nt step ends (n + 1) / Nt.
+    """
     __metaclass__ = abc.ABCMeta
 
-    def __init__(self, func, y0, Nt = 2 ):
+    def __init__(self, func, y0, Nt = 2, t = None):
         self.func = func
         self.Nt = Nt
+        self.nfe = 0
+        if t is None:
+            t = [(n + 1) / float(Nt) for n in range(Nt)]
+        elif torch.is_tensor(t):
+            t = t.tolist()
+        self.t = [float(t_i) for t_i in t]
 
     @abc.abstractmethod
     def step(self, func, t, dt, y):
         pass
 
+    def rhs(self, t, y):
+        # func with a count of the function evaluations
+        self.nfe += 1
+        return self.func(t, y)
+
     def integrate(self, y0):
+        return self.integrate_outputs(y0, 0, len(self.t))
+
+    def integrate_outputs(self, y0, i_start, i_end):
+        """
+        States at output times t[i_start], ..., t[i_end - 1], starting
+        from y0 at the previous output time (or at 0 if i_start is 0).
+        """
+        t0 = self.t[i_start - 1] if i_start > 0 else 0.
+        return self.integrate_times(y0, t0, self.t[i_start:i_end])
+
+    def integrate_times(self, y0, t0, t_out):
+        """States at the increasing times t_out >= t0, stacked along a new first axis."""
         y1 = y0
-        dt = 1. / float(self.Nt)
-        y1_all = []
-        for n in range(self.Nt):
-            t0 = 0 + n * dt
-            y1 = self.step(self.func, t0, dt, y1)
-            y1_all.append(y1)
-
-        y1_all = torch.stack(y1_all)
+        y1_all = y0.new_empty((len(t_out),) + y0.shape)
+        for i, t1 in enumerate(t_out):
+            n_sub, dt = self.substeps(t0, t1)
+            for n in range(n_sub):
+                y1 = self.step(self.rhs, t0 + n * dt, dt, y1)
+            y1_all[i] = y1
+            t0 = t1
+
+        return y1_all
+
+    def substeps(self, t0, t1):
+        """Number and size of the equal steps from t0 to t1, none longer than 1 / Nt."""
+        # tolerance so float round-off never adds a spurious substep
+        n_sub = int(math.ceil((t1 - t0) * self.Nt - 1e-6))
+        return n_sub, (t1 - t0) / n_sub if n_sub > 0 else 0.
+
+
+class Embedded_Time_Stepper(Time_Stepper):
+    """
+    Adaptive explicit Runge-Kutta method with an embedded error
+    estimate, described by a Butcher tableau (c, a, b) and the error
+    weights b - b_hat of the lower order solution. The last stage must
+    be evaluated at the new state (first same as last), so every
+    accepted step reuses it as the next first stage.
+
+    Nt plays no role here beyond the default output times: steps are
+    chosen by the local error control, and the states at the output
+    times are interpolated
+    with a cubic Hermite polynomial through the step end points, or a
+    quartic that also passes through a midpoint estimate if the method
+    provides one (c_mid).
+    """
+    adaptive = True
+    c, a, b, b_err = None, None, None, None
+    c_mid = None  # weights of the stages giving y(t + dt / 2)
+    error_order = None  # the local error estimate scales as dt**error_order
+
+    def __init__(self, func, y0, Nt = 2, t = None, rtol = 1e-3, atol = 1e-6, max_steps = 10000):
+        super().__init__(func, y0, Nt = Nt, t = t)
+        self.rtol, self.atol = rtol, atol
+        self.max_steps = max_steps
+        self.n_accepted, self.n_rejected = 0, 0
+
+    def step(self, func, t, dt, y):
+        k = [func(t, y).to(y.dtype)]
+        y_new, _ = self._stages(func, t, dt, y, k)
+        return y_new
+
+    def _stages(self, func, t, dt, y, k):
+        # k holds the first stage on entry and all stages on exit, the
+        # last one being f(y_new); returns y_new and the error estimate
+        for c_i, a_i in zip(self.c[1:], self.a):
+            y_i = y + dt * sum(a_ij * k_j for a_ij, k_j in zip(a_i, k) if a_ij != 0)
+            k.append(func(t + c_i * dt, y_i).to(y.dtype))
+        y_new = y + dt * sum(b_j * k_j for b_j, k_j in zip(self.b, k) if b_j != 0)
+        err = dt * sum(e_j * k_j for e_j, k_j in zip(self.b_err, k) if e_j != 0)
+        return y_new, err
+
+    def _error_norm(self, err, y, y_new):
+        scale = self.atol + self.rtol * torch.max(y.abs(), y_new.abs())
+        return torch.sqrt(torch.mean((err / scale) ** 2)).item()
+
+    def _initial_step(self, t, y, f, t_end):
+        # Hairer, Norsett & Wanner, Solving ODEs I, section II.4
+        scale = self.atol + self.rtol * y.abs()
+        d0 = torch.sqrt(torch.mean((y / scale) ** 2)).item()
+        d1 = torch.sqrt(torch.mean((f / scale) ** 2)).item()
+        h0 = 1e-6 if d0 < 1e-5 or d1 < 1e-5 else 0.01 * d0 / d1
+        f1 = self.rhs(t + h0, y + h0 * f).to(y.dtype)
+        d2 = torch.sqrt(torch.mean(((f1 - f) / scale) ** 2)).item() / h0
+        if max(d1, d2) <= 1e-15:
+            h1 = max(1e-6, h0 * 1e-3)
+        else:
+            h1 = (0.01 / max(d1, d2)) ** (1. / self.error_order)
+        return min(100 * h0, h1, t_end - t)
+
+    def integrate_times(self, y0, t0, t_out):
+        t, y = t0, y0
+        y1_all = y0.new_empty((len(t_out),) + y0.shape)
+        i = 0
+        while i < len(t_out) and t_out[i] <= t:
+            y1_all[i] = y
+            i += 1
+        if i == len(t_out):
+            return y1_all
+        f = self.rhs(t, y).to(y.dtype)
+        h = self._initial_step(t, y, f, t_out[-1])
+        while i < len(t_out):
+            if self.n_accepted + self.n_rejected >= self.max_steps:
+                raise RuntimeError('adaptive solver exceeded {} steps'.format(self.max_steps))
+            h = min(h, t_out[-1] - t)
+            k = [f]
+            y_new, err = self._stages(self.rhs, t, h, y, k)
+            err_norm = self._error_norm(err, y, y_new)
+            if err_norm <= 1:
+                self.n_accepted += 1
+                # report every observation time covered by this step
+                while i < len(t_out) and t_out[i] <= t + h * (1 + 1e-12):
+                    theta = (t_out[i] - t) / h
+                    y1_all[i] = self._interpolate(y, y_new, k, h, theta)
+                    i += 1
+                t, y, f = t + h, y_new, k[-1]
+            else:
+                self.n_rejected += 1
+            factor = 10. if err_norm == 0 else 0.9 * err_norm ** (-1. / self.error_order)
+            h = h * min(10., max(0.2, factor))
+
         return y1_all
+
+    def _interpolate(self, y0, y1, k, h, theta):
+        # dense output on [t, t + h] at t + theta * h
+        if theta >= 1.:
+            return y1
+        f0, f1 = k[0], k[-1]
+        if self.c_mid is not None:
+            # quartic through y0, y_mid, y1 with slopes f0, f1
+            y_mid = y0 + h * sum(c_j * k_j for c_j, k_j in zip(self.c_mid, k) if c_j != 0)
+            a = 2 * h * (f1 - f0) - 8 * (y1 + y0) + 16 * y_mid
+            b = h * (5 * f0 - 3 * f1) + 18 * y0 + 14 * y1 - 32 * y_mid
+            c = h * (f1 - 4 * f0) - 11 * y0 - 5 * y1 + 16 * y_mid
+            return (((a * theta + b) * theta + c) * theta + h * f0) * theta + y0
+        h00 = 2 * theta ** 3 - 3 * theta ** 2 + 1
+        h10 = theta ** 3 - 2 * theta ** 2 + theta
+        h01 = -2 * theta ** 3 + 3 * theta ** 2
+        h11 = theta ** 3 - theta ** 2
+        return h00 * y0 + h10 * h * f0 + h01 * y1 + h11 * h * f1
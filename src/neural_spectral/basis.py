@@ -0,0 +1,245 @@
+import numpy as np
+from scipy.fft import dct, dctn
+
+import torch
+import torch.nn as nn
+
+
+class SeparableBasis(nn.Module):
+    """
+    K basis functions, each a sum of rank-r outer products
+
+        f_k(x,y) = sum_{l=1}^r a_kl(x) b_kl(y)
+
+    so the basis costs K*r*(nx+ny) numbers instead of K*nx*ny and
+    a grid is synthesized with two small matmuls per frame.
+
+    Args
+    ----
+    K := integer
+         number of basis functions
+    nx, ny := integer
+              grid size
+    rank := integer
+            number of outer products per basis function
+    n_channels := integer (default: None)
+                  number of fields per basis function (e.g. 3 for
+                  u, v, p); None means a single field with no
+                  channel axis, as in spectral_ode2
+    """
+
+    def __init__(self, K, nx, ny, rank, n_channels=None):
+        super().__init__()
+        self.K, self.nx, self.ny, self.rank = K, nx, ny, rank
+        self.n_channels = n_channels
+        C = 1 if n_channels is None else n_channels
+        # scale factors so entries of f_k have unit variance like the
+        # dense basis: var(a) * var(b) * r = 1
+        std = rank ** -0.25
+        self.x_factors = nn.Parameter(torch.normal(torch.zeros(K, C, nx, rank), std))
+        self.y_factors = nn.Parameter(torch.normal(torch.zeros(K, C, ny, rank), std))
+
+    def forward(self, coeff):
+        """coeff (... x K [x C]) -> soln (... [x C] x nx x ny)"""
+        if self.n_channels is None:
+            coeff = coeff.unsqueeze(-1)
+        lead, (K, C) = coeff.shape[:-2], coeff.shape[-2:]
+        coeff = coeff.reshape(-1, K, C)
+        # weight the x factors, then contract over (k, l) in one matmul
+        a = torch.einsum('bkc,kcxr->bcxkr', coeff, self.x_factors)
+        a = a.reshape(-1, C, self.nx, K * self.rank)
+        b = self.y_factors.permute(1, 0, 3, 2).reshape(C, K * self.rank, self.ny)
+        soln = (a @ b).reshape(*lead, C, self.nx, self.ny)
+        if self.n_channels is None:
+            soln = soln.squeeze(-3)
+        return soln
+
+    def dense(self):
+        """Materialize the basis as K [x C] x nx x ny."""
+        basis_fns = torch.einsum('kcxr,kcyr->kcxy', self.x_factors, self.y_factors)
+        if self.n_channels is None:
+            basis_fns = basis_fns.squeeze(1)
+        return basis_fns
+
+    def gram(self):
+        """
+        Per-channel inner products <f_i, f_j> as C x K x K, computed
+        from the factors: <A_i B_i^T, A_j B_j^T> = sum (A_i^T A_j) * (B_i^T B_j)
+        """
+        xx = torch.einsum('icxr,jcxs->cijrs', self.x_factors, self.x_factors)
+        yy = torch.einsum('icyr,jcys->cijrs', self.y_factors, self.y_factors)
+        return (xx * yy).sum(dim=(-2, -1))
+
+    def inner(self, grid):
+        """<f_k, grid> for grid (mb [x C] x nx x ny) as C x K x mb"""
+        if self.n_channels is None:
+            grid = grid.unsqueeze(1)
+        gx = torch.einsum('mcxy,kcxr->ckmyr', grid, self.x_factors)
+        return torch.einsum('ckmyr,kcyr->ckm', gx, self.y_factors)
+
+
+def spectral_modes(K, nx, ny):
+    """First K (kx, ky) mode pairs, lowest total degree first."""
+    modes = sorted(((kx, ky) for kx in range(nx) for ky in range(ny)),
+                   key=lambda m: (m[0] + m[1], m[0]))
+    assert K <= len(modes)
+    return modes[:K]
+
+
+class FixedSpectralBasis(nn.Module):
+    """
+    Fixed orthonormal basis of the K lowest tensor-product modes
+
+        f_k(x,y) = T_{kx}(x) T_{ky}(y)
+
+    shared by every channel. 'cosine' uses the DCT-II modes, which
+    suit uniform (finite difference) grids; 'chebyshev' uses DCT-I
+    modes, i.e. Chebyshev polynomials on Gauss-Lobatto points as
+    produced by chorin_spectral. Because the basis is orthonormal,
+    projection is a plain inner product and transform() computes the
+    coefficients of whole trajectories with a fast DCT.
+
+    Args
+    ----
+    K := integer
+         number of basis functions
+    nx, ny := integer
+              grid size
+    kind := string (default: 'cosine')
+            cosine | chebyshev
+    """
+
+    def __init__(self, K, nx, ny, kind='cosine'):
+        super().__init__()
+        assert kind in ['cosine', 'chebyshev']
+        self.K, self.nx, self.ny, self.kind = K, nx, ny, kind
+        self.dct_type = 2 if kind == 'cosine' else 1
+
+        modes = np.array(spectral_modes(K, nx, ny))
+        self.x_modes, self.y_modes = modes[:, 0], modes[:, 1]
+        # rows of the orthonormal DCT matrix are the 1d basis vectors
+        Mx = dct(np.eye(nx), type=self.dct_type, norm='ortho', axis=0)
+        My = dct(np.eye(ny), type=self.dct_type, norm='ortho', axis=0)
+        self.register_buffer('x_basis', torch.from_numpy(Mx[self.x_modes]).float())
+        self.register_buffer('y_basis', torch.from_numpy(My[self.y_modes]).float())
+
+    def forward(self, coeff):
+        """coeff (... x K x C) -> soln (... x C x nx x ny)"""
+        return torch.einsum('...kc,kx,ky->...cxy', coeff, self.x_basis, self.y_basis)
+
+    def dense(self):
+        return torch.einsum('kx,ky->kxy', self.x_basis, self.y_basis)
+
+    def project(self, grid):
+        """grid (mb x C x nx x ny) -> coefficients (mb x K x C)"""
+        return torch.einsum('mcxy,kx,ky->mkc', grid, self.x_basis, self.y_basis)
+
+    def transform(self, obs):
+        """
+        Fast DCT of a whole trajectory, obs (T x C x nx x ny), to its
+        coefficients (T x K x C). Meant for precomputing targets once.
+        """
+        coeff = dctn(obs.numpy(), type=self.dct_type, axes=(-2, -1), norm='ortho')
+        coeff = coeff[:, :, self.x_modes, self.y_modes]  # T x C x K
+        return torch.from_numpy(np.ascontiguousarray(coeff.transpose(0, 2, 1))).float()
+
+
+def synthesize(coeff, basis_fns):
+    """
+    Compute sum_k coeff_k * f_k(x,y) for a stacked basis tensor
+    (K [x C] x nx x ny), a SeparableBasis or a FixedSpectralBasis,
+    given coefficients of size ... x K [x C]. Returns ... [x C] x nx x ny.
+    """
+    if isinstance(basis_fns, (SeparableBasis, FixedSpectralBasis)):
+        return basis_fns(coeff)
+    elif basis_fns.dim() == 4:
+        return torch.einsum('...kc,kcxy->...cxy', coeff, basis_fns)
+    return torch.einsum('...k,kxy->...xy', coeff, basis_fns)
+
+
+def project_onto_basis(grid, basis_fns, ridge=1e-6):
+    """
+    Least-squares coefficients of a batch of fields in a (not
+    necessarily orthogonal) set of basis functions. Each channel is
+    projected separately by solving the K x K normal equations,
+    which keeps this cheap and differentiable wrt the basis.
+
+    Args
+    ----
+    grid := torch.Tensor (size: mb x C x nx x ny)
+    basis_fns := torch.Tensor (size: K x C x nx x ny), SeparableBasis
+                 or FixedSpectralBasis
+    ridge := float (default: 1e-6)
+             diagonal jitter for nearly collinear basis functions
+
+    Returns coefficients of size mb x K x C (mb x K for a basis
+    without a channel axis).
+    """
+    if isinstance(basis_fns, FixedSpectralBasis):
+        return basis_fns.project(grid)  # orthonormal, no solve needed
+    elif isinstance(basis_fns, SeparableBasis):
+        gram, rhs = basis_fns.gram(), basis_fns.inner(grid)
+        squeeze = basis_fns.n_channels is None
+    else:
+        squeeze = basis_fns.dim() == 3
+        if squeeze:
+            grid, basis_fns = grid.unsqueeze(1), basis_fns.unsqueeze(1)
+        K, C = basis_fns.size(0), basis_fns.size(1)
+        mb = grid.size(0)
+        A = basis_fns.reshape(K, C, -1).permute(1, 2, 0)  # C x nx*ny x K
+        b = grid.reshape(mb, C, -1).permute(1, 2, 0)      # C x nx*ny x mb
+        gram = A.transpose(1, 2) @ A                      # C x K x K
+        rhs = A.transpose(1, 2) @ b                       # C x K x mb
+
+    K = gram.size(-1)
+    gram = gram + ridge * torch.eye(K, dtype=gram.dtype, device=gram.device)
+    coeff = torch.linalg.solve(gram, rhs).permute(2, 1, 0)  # mb x K x C
+    return coeff.squeeze(-1) if squeeze else coeff
+
+
+def pairwise_distances(basis_fns):
+    """
+    L2 distances ||f_i - f_j|| for all i < j, in torch.pdist order.
+    A SeparableBasis is never materialized: distances come from its
+    Gram matrix, ||f_i - f_j||^2 = G_ii + G_jj - 2 G_ij.
+    """
+    if isinstance(basis_fns, FixedSpectralBasis):
+        return torch.pdist(basis_fns.dense().flatten(1), p=2)
+    elif not isinstance(basis_fns, SeparableBasis):
+        return torch.pdist(basis_fns.flatten(1), p=2)
+    gram = basis_fns.gram().sum(0)
+    diag = torch.diagonal(gram)
+    sq_dist = diag[:, None] + diag[None, :] - 2 * gram
+    i, j = torch.triu_indices(gram.size(0), gram.size(0), offset=1, device=gram.device)
+    # clamp keeps sqrt differentiable when two functions coincide
+    return torch.sqrt(torch.clamp(sq_dist[i, j], min=1e-12))
+
+
+def make_basis(K, nx, ny, rank=None, n_channels=None, kind='learned'):
+    """
+    Dense K [x C] x nx x ny parameter, a SeparableBasis if rank is
+    set, or a FixedSpectralBasis if kind is cosine or chebyshev.
+    """
+    if kind != 'learned':
+        return FixedSpectralBasis(K, nx, ny, kind=kind)
+    elif rank is not None:
+        return SeparableBasis(K, nx, ny, rank, n_channels=n_channels)
+    size = (K, nx, ny) if n_channels is None else (K, n_channels, nx, ny)
+    return nn.Parameter(torch.normal(torch.zeros(*size), 1))
+
+
+def stack_legacy_basis(state_dict, prefix, name):
+    """
+    Basis functions used to be stored as an nn.ParameterList with
+    one (C x) nx x ny entry per function. They are now a single
+    stacked parameter; rewrite old checkpoints in place so
+    load_state_dict keeps working. Meant to be called from a
+    load_state_dict pre-hook.
+    """
+    key = prefix + name
+    legacy = '{}.'.format(key)
+    indices = sorted(int(k[len(legacy):]) for k in state_dict
+                     if k.startswith(legacy) and k[len(legacy):].isdigit())
+    if key in state_dict or len(indices) == 0:
+        return
+    state_dict[key] = torch.stack([state_dict.pop(legacy + str(i)) for i in indices])
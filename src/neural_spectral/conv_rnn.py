@@ -0,0 +1,90 @@
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+
+from src.neural_spectral.rnn import extrapolate
+
+
+class ConvRNN(nn.Module):
+    """
+    Latent GRU over convolutional frame encodings. Each 3 x nx x ny
+    frame is encoded by n_layers stride-2 convolutions into a small
+    latent vector, the GRU steps in latent space and a mirrored stack
+    of transposed convolutions decodes back to the grid. Unlike RNN,
+    the recurrent weights do not grow with the grid area.
+
+    Frames are zero padded to a multiple of 2^n_layers so the decoder
+    output lines up with the input, and cropped back to nx x ny.
+    Inputs and outputs use the same flattened mb x nt x 3*nx*ny layout
+    as RNN so both plug into the same training loop.
+
+    Args
+    ----
+    nx, ny := integer
+              grid size
+    hidden_dim := integer (default: 256)
+                  GRU state size
+    n_filters := integer (default: 16)
+                 channels after the first convolution, doubled per layer
+    n_layers := integer (default: 4)
+                number of stride-2 convolutions
+    latent_channels := integer (default: 8)
+                       channels of the coarsest feature map
+    """
+
+    def __init__(self, nx, ny, hidden_dim=256, n_filters=16, n_layers=4, latent_channels=8):
+        super().__init__()
+        self.nx, self.ny = nx, ny
+        self.hidden_dim = hidden_dim
+        self.n_layers = n_layers
+        self.latent_channels = latent_channels
+
+        factor = 2 ** n_layers
+        self.pad_x = -nx % factor
+        self.pad_y = -ny % factor
+        self.lx = (nx + self.pad_x) // factor
+        self.ly = (ny + self.pad_y) // factor
+        self.latent_dim = latent_channels * self.lx * self.ly
+
+        channels = [3] + [n_filters * 2 ** i for i in range(n_layers)]
+        encoder = []
+        for c_in, c_out in zip(channels[:-1], channels[1:]):
+            encoder += [nn.Conv2d(c_in, c_out, 4, stride=2, padding=1), nn.ReLU(inplace=True)]
+        encoder.append(nn.Conv2d(channels[-1], latent_channels, 1))
+        self.encoder = nn.Sequential(*encoder)
+
+        self.gru = nn.GRU(self.latent_dim, self.hidden_dim, batch_first=True)
+        self.linear = nn.Linear(self.hidden_dim, self.latent_dim)
+
+        decoder = [nn.Conv2d(latent_channels, channels[-1], 1), nn.ReLU(inplace=True)]
+        for c_in, c_out in zip(channels[:0:-1], channels[-2::-1]):
+            decoder += [nn.ConvTranspose2d(c_in, c_out, 4, stride=2, padding=1), nn.ReLU(inplace=True)]
+        self.decoder = nn.Sequential(*decoder[:-1])  # no activation on the output
+
+    def encode(self, frames):
+        # frames = n x 3*nx*ny -> n x latent_dim
+        frames = frames.view(-1, 3, self.nx, self.ny)
+        frames = F.pad(frames, (0, self.pad_y, 0, self.pad_x))
+        return self.encoder(frames).flatten(1)
+
+    def decode(self, out):
+        # out = n x hidden_dim -> n x 3*nx*ny
+        latent = self.linear(out).view(-1, self.latent_channels, self.lx, self.ly)
+        frames = self.decoder(latent)[:, :, :self.nx, :self.ny]
+        return frames.reshape(frames.size(0), -1)
+
+    def forward(self, obs_seq):
+        mb, nt = obs_seq.size(0), obs_seq.size(1)
+        latent_seq = self.encode(obs_seq.reshape(mb * nt, -1)).view(mb, nt, -1)
+        out_seq, gru_hid = self.gru(latent_seq, None)
+        out_seq = self.decode(out_seq.reshape(mb * nt, -1))
+        out_seq = out_seq.view(mb, nt, -1)
+        return out_seq, gru_hid
+
+    def step(self, obs, hid):
+        # obs = mb x 3*nx*ny; feeds one frame through and predicts the next
+        out, hid = self.gru(self.encode(obs).unsqueeze(1), hid)
+        return self.decode(out.squeeze(1)), hid
+
+    def extrapolate(self, obs, T_extrapolate, chunk_size=None):
+        return extrapolate(self.step, obs, T_extrapolate, chunk_size=chunk_size)
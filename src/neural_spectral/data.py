@@ -0,0 +1,121 @@
+import bisect
+import numpy as np
+
+import torch
+from torch.utils.data import Dataset, DataLoader, RandomSampler
+
+
+def load_trajectory(npz_path, n_steps=None):
+    """Load a simulated trajectory saved by one of the simulators.
+
+    Args
+    ----
+    npz_path := string
+                path to an npz file with u, v, p arrays (each T x nx x ny)
+    n_steps := integer (default: None)
+               only keep the first n_steps time steps
+
+    Returns a float tensor of size T x 3 x nx x ny.
+    """
+    data = np.load(npz_path)
+    u, v, p = data['u'][:n_steps], data['v'][:n_steps], data['p'][:n_steps]
+    obs = np.stack([u, v, p], axis=1).astype(np.float32)
+    return torch.from_numpy(obs)
+
+
+def trajectory_shape(npz_path):
+    """Shape (T x nx x ny) of each field in a trajectory file, read
+    from the npy header so nothing is decompressed."""
+    with np.load(npz_path) as data:
+        with data.zip.open('u.npy') as fp:
+            major, _ = np.lib.format.read_magic(fp)
+            if major == 1:
+                shape, _, _ = np.lib.format.read_array_header_1_0(fp)
+            else:
+                shape, _, _ = np.lib.format.read_array_header_2_0(fp)
+    return shape
+
+
+class TrajectoryWindowDataset(Dataset):
+    """
+    Fixed-length windows cut out of many simulated trajectories.
+    Each item is a tensor of size window x 3 x nx x ny. Trajectories
+    are loaded lazily and cached per process, so every DataLoader
+    worker only decompresses a file once.
+
+    Args
+    ----
+    npz_paths := list of strings
+                 trajectory files (all must share nx and ny)
+    window := integer
+              number of time steps per item
+    n_steps := integer (default: None)
+               only use the first n_steps time steps of every trajectory
+    random_start := boolean (default: True)
+                    if False, every trajectory contributes a single
+                    window starting at its first time step
+    transform := callable (default: None)
+                 applied once to each loaded T x 3 x nx x ny trajectory
+                 before caching (e.g. to precompute basis coefficients)
+    """
+
+    def __init__(self, npz_paths, window, n_steps=None, random_start=True,
+                 transform=None):
+        super().__init__()
+        self.npz_paths = list(npz_paths)
+        self.window = window
+        self.n_steps = n_steps
+        self.random_start = random_start
+        self.transform = transform
+
+        self.n_windows = []
+        for path in self.npz_paths:
+            T = trajectory_shape(path)[0]
+            if n_steps is not None:
+                T = min(T, n_steps)
+            assert T >= window, \
+                '{} has {} steps but window is {}'.format(path, T, window)
+            self.n_windows.append(T - window + 1 if random_start else 1)
+        self.cum_windows = np.cumsum(self.n_windows).tolist()
+        self._cache = {}
+
+    def __len__(self):
+        return self.cum_windows[-1]
+
+    def _get_trajectory(self, index):
+        if index not in self._cache:
+            obs = load_trajectory(self.npz_paths[index], self.n_steps)
+            if self.transform is not None:
+                obs = self.transform(obs)
+            self._cache[index] = obs
+        return self._cache[index]
+
+    def __getitem__(self, index):
+        file_index = bisect.bisect_right(self.cum_windows, index)
+        start = index - (self.cum_windows[file_index - 1] if file_index > 0 else 0)
+        obs = self._get_trajectory(file_index)
+        return obs[start:start + self.window]
+
+
+def get_window_loader(npz_paths, window, batch_size, n_iters, n_steps=None,
+                      random_start=True, transform=None, num_workers=0,
+                      pin_memory=False):
+    """Build a DataLoader that yields exactly n_iters minibatches of
+    size batch_size x window x 3 x nx x ny. Windows are sampled with
+    replacement so n_iters is independent of the number of files.
+
+    Worker processes (num_workers > 0) are kept alive across the run
+    and prefetch batches while the model trains on the current one.
+    """
+    dataset = TrajectoryWindowDataset(npz_paths, window, n_steps=n_steps,
+                                      random_start=random_start,
+                                      transform=transform)
+    sampler = RandomSampler(dataset, replacement=True,
+                            num_samples=batch_size * n_iters)
+    kwargs = {}
+    if num_workers > 0:
+        kwargs['persistent_workers'] = True
+        kwargs['prefetch_factor'] = 2
+    return DataLoader(dataset, batch_size=batch_size, sampler=sampler,
+                      num_workers=num_workers, pin_memory=pin_memory,
+                      drop_last=True, **kwargs)
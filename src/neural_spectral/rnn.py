@@ -9,6 +9,9 @@ import torch.nn as nn
 import torch.optim as optim
 import torch.nn.utils.rnn as rnn_utils
 
+from src.neural_spectral.data import load_trajectory, get_window_loader
+from src.utils import AverageMeter, AsyncCheckpointWriter, MetricsLogger, autocast, grad_scaler
+
 
 class RNN(nn.Module):
     def __init__(self, input_dim, hidden_dim=256):
@@ -24,47 +27,94 @@ class RNN(nn.Module):
     def forward(self, obs_seq):
         mb, nt = obs_seq.size(0), obs_seq.size(1)
         out_seq, gru_hid = self.gru(obs_seq, None)
-        out_seq = out_seq.view(mb * nt, -1)
+        out_seq = out_seq.reshape(mb * nt, -1)
         out_seq = self.linear(out_seq)
         out_seq = out_seq.view(mb, nt, -1)
         return out_seq, gru_hid
 
-    def extrapolate(self, obs, T_extrapolate):
-        h0 = None
-        out_extrapolate = []
+    def step(self, obs, hid):
+        # obs = mb x D; feeds one frame through and predicts the next
+        out, hid = self.gru(obs.unsqueeze(1), hid)
+        return self.linear(out.squeeze(1)), hid
+
+    def extrapolate(self, obs, T_extrapolate, chunk_size=None):
+        return extrapolate(self.step, obs, T_extrapolate, chunk_size=chunk_size)
+
+
+def extrapolate(step, obs, T_extrapolate, chunk_size=None):
+    """
+    Autoregressive rollout from a batch of initial conditions. Frames
+    are written into a preallocated mb x T x D buffer on the device
+    of obs, so nothing is synchronized or moved per step.
+
+    Args
+    ----
+    step := callable
+            (obs, hid) -> (next obs, hid), with hid None at the start
+    obs := torch.Tensor (size: mb x D or mb x 1 x D)
+           one initial condition per trajectory
+    T_extrapolate := integer
+                     number of frames to predict
+    chunk_size := integer (default: None)
+                  on a GPU, copy every chunk_size finished frames into
+                  a pinned host buffer on a side stream while the next
+                  chunk is computed; ignored on the CPU
+
+    Returns predictions of size mb x T x D, on the host if chunks were
+    streamed and on the device of obs otherwise.
+    """
+    with torch.inference_mode():
+        obs = obs.reshape(obs.size(0), -1)
+        mb, D = obs.size()
+        out = obs.new_empty(mb, T_extrapolate, D)
+
+        streaming = chunk_size is not None and obs.is_cuda
+        if streaming:
+            host = torch.empty(mb, T_extrapolate, D, dtype=obs.dtype, pin_memory=True)
+            copy_stream = torch.cuda.Stream(device=obs.device)
+            start = 0
+
+        hid = None
         for t in range(T_extrapolate):
-            out, h0 = self.gru(obs, h0)
-            obs = self.linear(out.squeeze(1)).unsqueeze(1)
-            out_extrapolate.append(obs.cpu().detach())
-        out_extrapolate = torch.cat(out_extrapolate, dim=1)
-        return out_extrapolate
-
-
-class AverageMeter(object):
-    """Computes and stores the average and current value"""
-    def __init__(self):
-        self.reset()
-
-    def reset(self):
-        self.val = 0
-        self.avg = 0
-        self.sum = 0
-        self.count = 0
-
-    def update(self, val, n=1):
-        self.val = val
-        self.sum += val * n
-        self.count += n
-        self.avg = self.sum / self.count
+            obs, hid = step(obs, hid)
+            out[:, t] = obs
+            if streaming and (t + 1 - start == chunk_size or t + 1 == T_extrapolate):
+                # the side stream must see the finished frames; later frames
+                # are written to a different slice so compute can go on
+                copy_stream.wait_stream(torch.cuda.current_stream(obs.device))
+                with torch.cuda.stream(copy_stream):
+                    host[:, start:t + 1].copy_(out[:, start:t + 1], non_blocking=True)
+                start = t + 1
+
+        if streaming:
+            copy_stream.synchronize()
+            return host
+        return out
 
 
 if __name__ == "__main__":
     import argparse
     parser = argparse.ArgumentParser()
-    parser.add_argument('--npz-path', type=str, default='../data/data_semi_implicit.npz')
+    parser.add_argument('--npz-path', type=str, nargs='+', default=['../data/data_semi_implicit.npz'],
+                        help='one or more trajectory files to train on')
+    parser.add_argument('--model', type=str, default='dense', choices=['dense', 'conv'],
+                        help='GRU over flattened frames or over conv encodings [default: dense]')
     parser.add_argument('--out-dir', type=str, default='./checkpoints/rnn', 
                         help='where to save checkpoints [default: ./checkpoints/rnn]')
     parser.add_argument('--n-iters', type=int, default=1000, help='default: 1000')
+    parser.add_argument('--window', type=int, default=100, 
+                        help='time steps per training window [default: 100]')
+    parser.add_argument('--batch-size', type=int, default=1, help='default: 1')
+    parser.add_argument('--random-windows', action='store_true', default=False,
+                        help='sample window starts uniformly instead of always at t=0')
+    parser.add_argument('--num-workers', type=int, default=0, 
+                        help='data loading processes [default: 0]')
+    parser.add_argument('--keep-checkpoints', type=int, default=3, 
+                        help='numbered checkpoints to keep on disk [default: 3]')
+    parser.add_argument('--extrapolate-chunk', type=int, default=None, 
+                        help='stream extrapolated frames to the host in chunks of this size (GPU only)')
+    parser.add_argument('--amp', type=str, default='none', choices=['none', 'bf16', 'fp16'],
+                        help='autocast the forward pass to this precision [default: none]')
     parser.add_argument('--gpu-device', type=int, default=0, help='default: 0')
     args = parser.parse_args()
 
@@ -74,61 +124,68 @@ if __name__ == "__main__":
     device = (torch.device('cuda:' + str(args.gpu_device)
               if torch.cuda.is_available() else 'cpu'))
 
-    data = np.load(args.npz_path)
-    u, v, p = data['u'][:100], data['v'][:100], data['p'][:100]
-    u = torch.from_numpy(u).float()
-    v = torch.from_numpy(v).float()
-    p = torch.from_numpy(p).float()
-    obs = torch.stack([u, v, p]).permute(1, 0, 2, 3).to(device)
-    nt, nx, ny = obs.size(0), obs.size(2), obs.size(3)
-    obs = obs.unsqueeze(0)  # add a batch size of 1
-
-    obs = obs.view(1, nt, 3*nx*ny)
-    obs_in, obs_out = obs[:, :-1], obs[:, 1:]
+    loader = get_window_loader(args.npz_path, args.window, args.batch_size, args.n_iters,
+                               random_start=args.random_windows,
+                               num_workers=args.num_workers,
+                               pin_memory=torch.cuda.is_available())
+    nx, ny = loader.dataset[0].size(2), loader.dataset[0].size(3)
     
-    model = RNN(nx*ny*3, 512).to(device)
+    if args.model == 'conv':
+        from src.neural_spectral.conv_rnn import ConvRNN
+        model = ConvRNN(nx, ny, 512).to(device)
+    else:
+        model = RNN(nx*ny*3, 512).to(device)
     optimizer = optim.Adam(model.parameters(), lr=1e-3)
+    scaler = grad_scaler(device, args.amp)
 
     loss_meter = AverageMeter()
 
+    checkpoint_writer = AsyncCheckpointWriter(args.out_dir, keep_last=args.keep_checkpoints)
+    metrics_logger = MetricsLogger(os.path.join(args.out_dir, 'metrics.bin'))
+    best_loss = np.inf
+
     tqdm_batch = tqdm(total=args.n_iters, desc="[Iteration]")
-    for itr in range(1, args.n_iters + 1):
+    for itr, obs in enumerate(loader, 1):
+        obs = obs.to(device, non_blocking=True)
+        mb, nt = obs.size(0), obs.size(1)
+        obs = obs.view(mb, nt, 3*nx*ny)
+        obs_in, obs_out = obs[:, :-1], obs[:, 1:]
+
         optimizer.zero_grad()
 
-        obs_pred, _ = model(obs_in)
-        loss = torch.norm(obs_pred - obs_out, p=2)
+        with autocast(device, args.amp):
+            obs_pred, _ = model(obs_in)
+        # reduce in float32 whatever precision the forward pass ran in
+        loss = torch.norm(obs_pred.float() - obs_out, p=2)
 
-        loss.backward()
-        optimizer.step()
+        scaler.scale(loss).backward()
+        scaler.step(optimizer)
+        scaler.update()
         loss_meter.update(loss.item())
+        metrics_logger.log(itr, loss.item(), n_samples=mb)
 
         if itr % 10 == 0:
-            torch.save({
+            is_best = loss.item() < best_loss
+            best_loss = min(best_loss, loss.item())
+            checkpoint_writer.save({
                 'model_state_dict': model.state_dict(),
                 'optimizer_state_dict': optimizer.state_dict(),
                 'config': args,
-            }, os.path.join(args.out_dir, 'checkpoint.pth.tar'))
+            }, itr, is_best=is_best)
 
         tqdm_batch.set_postfix({"Loss": loss_meter.avg})
         tqdm_batch.update()
     tqdm_batch.close()
+    checkpoint_writer.close()
+    metrics_logger.close()
+
+    obs = load_trajectory(args.npz_path[0])
+    nt = obs.size(0)
+    obs0 = obs[0].view(1, 3*nx*ny).to(device)  # first timestep, batch size of 1
 
-    with torch.no_grad():
-        data = np.load(args.npz_path)
-        u, v, p = data['u'], data['v'], data['p']
-        u = torch.from_numpy(u).float()
-        v = torch.from_numpy(v).float()
-        p = torch.from_numpy(p).float()
-        obs = torch.stack([u, v, p]).permute(1, 0, 2, 3).to(device)
-        nt, nx, ny = obs.size(0), obs.size(2), obs.size(3)
-        obs = obs.unsqueeze(0)  # add a batch size of 1
-        obs = obs.view(1, nt, 3*nx*ny)
-        obs0 = obs[:, 0].unsqueeze(1)  # first timestep - shape: mb x 3 x nx x ny
-
-        obs_extrapolate = model.extrapolate(obs0, nt)
-        obs_extrapolate = obs_extrapolate[0]
-        obs_extrapolate = obs_extrapolate.numpy()
-        obs_extrapolate = obs_extrapolate.reshape(obs_extrapolate.shape[0], 3, nx, ny)
+    obs_extrapolate = model.extrapolate(obs0, nt, chunk_size=args.extrapolate_chunk)
+    obs_extrapolate = obs_extrapolate[0].cpu().numpy()
+    obs_extrapolate = obs_extrapolate.reshape(nt, 3, nx, ny)
 
     np.save(os.path.join(args.out_dir, 'extrapolation.npy'), 
             obs_extrapolate)
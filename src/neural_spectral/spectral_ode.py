@@ -9,6 +9,12 @@ import torch.nn.utils.rnn as rnn_utils
 
 from torchdiffeq import odeint_adjoint as odeint
 from src.neural_spectral.anode import odesolver_adjoint as odesolver
+from src.neural_spectral.anode import odesolver as direct_odesolver
+from src.neural_spectral.basis import (make_basis, synthesize, project_onto_basis,
+                                        pairwise_distances, stack_legacy_basis,
+                                        FixedSpectralBasis)
+from src.neural_spectral.data import load_trajectory, trajectory_shape, get_window_loader
+from src.utils import AverageMeter, AsyncCheckpointWriter, MetricsLogger, autocast, grad_scaler
 
 
 class ODEFunc(nn.Module):
@@ -44,55 +50,100 @@ class PDEFunc(nn.Module):
 
     Notice this is very similar to a dynamic mixture 
     of experts (or ensemble) model.
+
+    If init_from_grid is True, w_k(0) is the least-squares projection
+    of the initial grid onto f_k(.) so every element of a minibatch
+    starts from its own state; otherwise w_k(0) is learned and shared.
+
+    If basis_rank is set, each f_k(.) is a sum of basis_rank separable
+    outer products a(x) b(y)^T instead of a full nx x ny grid.
+
+    If basis is cosine or chebyshev, f_k(.) are fixed orthonormal
+    spectral modes and only w_k(.) is learned; see coefficients() to
+    train directly against precomputed target coefficients.
+
+    method is any anode scheme; the adaptive ones (Bosh3, Dopri5)
+    report their function evaluations of the last solve in self.nfe.
+
+    backend picks how gradients reach the ODE: the anode adjoint, the
+    torchdiffeq adjoint (fixed-step rk4 only) or direct backprop
+    through the anode solver's graph (see adjoint_benchmark.py).
     """
     
-    def __init__(self, K, nx, ny):
+    def __init__(self, K, nx, ny, init_from_grid=False, basis_rank=None,
+                 basis='learned', method='RK4', backend='anode'):
         super().__init__()
         self.K = K
         self.nx, self.ny = nx, ny
-        self.init_coeffs = nn.Parameter(torch.normal(torch.zeros(self.K * 3), 1))
+        self.init_from_grid = init_from_grid
+        self.basis_rank = basis_rank
+        self.basis = basis
+        self.method = method
+        self.backend = backend
+        self.nfe = 0
+        if not self.init_from_grid:
+            self.init_coeffs = nn.Parameter(torch.normal(torch.zeros(self.K * 3), 1))
         self.basis_coeffs = ODEFunc(self.K * 3)
         # self.basis_fns = nn.ModuleList([BasisFunc(self.nx, self.ny)
         #                                 for _ in range(self.K) ])
-        self.basis_fns = nn.ParameterList([
-            nn.Parameter(torch.normal(torch.zeros(3, self.nx, self.ny), 1))
-            for _ in range(self.K)
-        ])
+        # stacked K x 3 x nx x ny (or its separable factors) so synthesis is one einsum
+        self.basis_fns = make_basis(self.K, self.nx, self.ny, rank=self.basis_rank,
+                                    n_channels=3, kind=self.basis)
+        self._register_load_state_dict_pre_hook(self._load_legacy_basis)
 
-    def forward(self, grid0, t):
+    def forward(self, grid0, t, n_frames=None):
         # grid0 = mb x 3 x nx x ny
         # t     = nt
         # coeff = nt x mb x K*3
     
-        mb, nt = grid0.size(0), t.size(0)
-        coeff = odesolver(  self.basis_coeffs, 
-                            self.init_coeffs.unsqueeze(0).repeat(mb, 1), 
-                            {'Nt': nt, 'method': 'RK4'}  )
-        coeff = coeff.view(nt, mb, self.K, 3)
-
-        soln = 0
-        for k in range(self.K):
-            f_k = self.basis_fns[k]
-            f_k = f_k.unsqueeze(0).repeat(nt * mb, 1, 1, 1)
-            f_k = f_k.view(nt, mb, 3, self.nx, self.ny)
-            w_k = coeff[:, :, k, :, None, None]
-            soln = soln + f_k * w_k
-        
+        coeff = self.coefficients(self.initial_coeffs(grid0), t, n_frames)
+
+        # sum_k w_k(t) * f_k(x,y) without materializing nt*mb copies of f_k
+        soln = synthesize(coeff, self.basis_fns)
         return soln
 
+    def coefficients(self, init_coeff, t, n_frames=None):
+        # init_coeff = mb x K*3
+        # returns w_k(t) as nt x mb x K x 3
+        mb, nt = init_coeff.size(0), t.size(0)
+        # t holds 1-based frame indices, possibly a sparse subset of the
+        # n_frames (default: t[-1]) frames spanning [0, 1]: take one
+        # solver step per frame and only output the requested ones
+        Nt = int(t[-1]) if n_frames is None else n_frames
+        if self.backend == 'torchdiffeq':
+            assert self.method == 'RK4', 'the torchdiffeq backend only runs RK4'
+            t_out = torch.cat([t.new_zeros(1), t]).to(init_coeff.dtype) / Nt
+            coeff = odeint(self.basis_coeffs, init_coeff, t_out, method='rk4',
+                           options={'step_size': 1. / Nt})[1:]
+            return coeff.view(nt, mb, self.K, 3)
+        solver = direct_odesolver if self.backend == 'direct' else odesolver
+        options = {'Nt': Nt, 't': t.double() / Nt, 'method': self.method}
+        coeff = solver(  self.basis_coeffs, 
+                         init_coeff, 
+                         options  )
+        self.nfe = options['nfe']
+        return coeff.view(nt, mb, self.K, 3)
+
+    def initial_coeffs(self, grid0):
+        # returns mb x K*3, laid out to match coeff.view(nt, mb, K, 3)
+        mb = grid0.size(0)
+        if not self.init_from_grid:
+            return self.init_coeffs.unsqueeze(0).repeat(mb, 1)
+        return project_onto_basis(grid0, self.basis_fns).reshape(mb, self.K * 3)
+
+    def _load_legacy_basis(self, state_dict, prefix, *args):
+        stack_legacy_basis(state_dict, prefix, 'basis_fns')
+
     def basis_weight_mat(self):
-        W = []
-        for k in range(self.K):
-            theta = self.basis_fns[k].flatten()
-            W.append(theta)
-        return torch.stack(W)
+        # K x 3*nx*ny matrix of basis functions (a view for the dense basis)
+        if not isinstance(self.basis_fns, nn.Parameter):
+            return self.basis_fns.dense().flatten(1)
+        return self.basis_fns.flatten(1)
 
     def diversity_penalty(self):
-        W = self.basis_weight_mat()
-        penalty = 0
-        for i in range(0, self.K):
-            for j in range(i, self.K):
-                penalty = penalty + torch.norm(W[i] - W[j], p=2)
+        # inverse of the summed pairwise L2 distances between basis
+        # functions, all i < j pairs computed in a single kernel
+        penalty = pairwise_distances(self.basis_fns).sum()
         penalty = 1. / penalty
         return penalty
 
@@ -119,32 +170,41 @@ class BasisFunc(nn.Module):
         return self.net(grid) 
 
 
-class AverageMeter(object):
-    """Computes and stores the average and current value"""
-    def __init__(self):
-        self.reset()
-
-    def reset(self):
-        self.val = 0
-        self.avg = 0
-        self.sum = 0
-        self.count = 0
-
-    def update(self, val, n=1):
-        self.val = val
-        self.sum += val * n
-        self.count += n
-        self.avg = self.sum / self.count
-
-
 if __name__ == "__main__":
     import argparse
     parser = argparse.ArgumentParser()
-    parser.add_argument('--npz-path', type=str, default='../data/data_semi_implicit.npz')
+    parser.add_argument('--npz-path', type=str, nargs='+', default=['../data/data_semi_implicit.npz'],
+                        help='one or more trajectory files to train on')
     parser.add_argument('--out-dir', type=str, default='./checkpoints/spectral_ode', 
                         help='where to save checkpoints [default: ./checkpoints/spectral_ode]')
     parser.add_argument('--n-iters', type=int, default=1000, help='default: 1000')
     parser.add_argument('--n-coeffs', type=int, default=10, help='default: 10')
+    parser.add_argument('--basis-rank', type=int, default=None, 
+                        help='use separable basis functions of this rank [default: dense]')
+    parser.add_argument('--basis', type=str, default='learned', 
+                        choices=['learned', 'cosine', 'chebyshev'],
+                        help='learned basis or fixed spectral modes [default: learned]')
+    parser.add_argument('--diversity-weight', type=float, default=0., 
+                        help='weight of the diversity penalty in the loss; 0 only monitors it [default: 0]')
+    parser.add_argument('--method', type=str, default='RK4', 
+                        choices=['Euler', 'RK2', 'RK4', 'Bosh3', 'Dopri5', 'ALF'],
+                        help='ODE solver for the coefficients [default: RK4]')
+    parser.add_argument('--backend', type=str, default='anode', 
+                        choices=['anode', 'torchdiffeq', 'direct'],
+                        help='how gradients are computed through the ODE [default: anode]')
+    parser.add_argument('--window', type=int, default=100, 
+                        help='time steps per training window [default: 100]')
+    parser.add_argument('--frame-stride', type=int, default=1, 
+                        help='only fit every n-th frame of a window [default: 1]')
+    parser.add_argument('--batch-size', type=int, default=1, help='default: 1')
+    parser.add_argument('--random-windows', action='store_true', default=False,
+                        help='sample window starts uniformly instead of always at t=0')
+    parser.add_argument('--num-workers', type=int, default=0, 
+                        help='data loading processes [default: 0]')
+    parser.add_argument('--keep-checkpoints', type=int, default=3, 
+                        help='numbered checkpoints to keep on disk [default: 3]')
+    parser.add_argument('--amp', type=str, default='none', choices=['none', 'bf16', 'fp16'],
+                        help='autocast the forward pass to this precision [default: none]')
     parser.add_argument('--gpu-device', type=int, default=0, help='default: 0')
     args = parser.parse_args()
     args.out_dir = '{}_{}'.format(args.out_dir, args.n_coeffs)
@@ -155,64 +215,93 @@ if __name__ == "__main__":
     device = (torch.device('cuda:' + str(args.gpu_device)
               if torch.cuda.is_available() else 'cpu'))
 
-    data = np.load(args.npz_path)
-    u, v, p = data['u'][:100], data['v'][:100], data['p'][:100]
-    u = torch.from_numpy(u).float()
-    v = torch.from_numpy(v).float()
-    p = torch.from_numpy(p).float()
-    obs = torch.stack([u, v, p]).permute(1, 0, 2, 3).to(device)
-    nt, nx, ny = obs.size(0), obs.size(2), obs.size(3)
-    obs = obs.unsqueeze(1)  # add a batch size of 1
-    obs0 = obs[0]  # first timestep - shape: mb x 3 x nx x ny
-    t = (torch.arange(nt) + 1).to(device)
+    _, nx, ny = trajectory_shape(args.npz_path[0])
+    nt = args.window
+    # train on every frame_stride-th frame of each window
+    frames = torch.arange(0, nt, args.frame_stride)
+    t = (frames + 1).to(device)
     K = args.n_coeffs
 
-    model = PDEFunc(K, nx, ny).to(device)
+    # with a fixed basis the targets never change, so project every
+    # trajectory onto it once (fast DCT) and train in coefficient space
+    fixed_basis = args.basis != 'learned'
+    transform = FixedSpectralBasis(K, nx, ny, kind=args.basis).transform if fixed_basis else None
+
+    loader = get_window_loader(args.npz_path, args.window, args.batch_size, args.n_iters,
+                               random_start=args.random_windows,
+                               transform=transform,
+                               num_workers=args.num_workers,
+                               pin_memory=torch.cuda.is_available())
+
+    # random windows, or windows of several trajectories, do not start
+    # from a shared state so the initial coefficients have to come from
+    # the observed first frame
+    init_from_grid = args.random_windows or len(args.npz_path) > 1
+    model = PDEFunc(K, nx, ny, init_from_grid=init_from_grid,
+                    basis_rank=args.basis_rank, basis=args.basis,
+                    method=args.method, backend=args.backend).to(device)
     optimizer = optim.Adam(model.parameters(), lr=1e-3)
+    scaler = grad_scaler(device, args.amp)
 
     loss_meter = AverageMeter()
     penalty_meter = AverageMeter()
-    losses, penalties = [], []
+
+    checkpoint_writer = AsyncCheckpointWriter(args.out_dir, keep_last=args.keep_checkpoints)
+    metrics_logger = MetricsLogger(os.path.join(args.out_dir, 'metrics.bin'))
+    best_loss = np.inf
 
     tqdm_batch = tqdm(total=args.n_iters, desc="[Iteration]")
-    for itr in range(1, args.n_iters + 1):
+    for itr, obs in enumerate(loader, 1):
+        obs = obs[:, frames].to(device, non_blocking=True)
+        obs = obs.transpose(0, 1)  # nt x mb x 3 x nx x ny (or nt x mb x K x 3)
+        mb = obs.size(1)
+
         optimizer.zero_grad()
 
-        obs_pred = model(obs0, t)
-        loss = torch.norm(obs_pred - obs, p=2)
+        with autocast(device, args.amp):
+            if fixed_basis:
+                # the basis is orthonormal so this equals the error of the
+                # projected fields, with K*3 instead of 3*nx*ny terms
+                coeff0 = (obs[0].reshape(mb, K * 3) if init_from_grid
+                          else model.init_coeffs.unsqueeze(0).repeat(mb, 1))
+                obs_pred = model.coefficients(coeff0, t, nt)
+            else:
+                obs0 = obs[0]  # first timestep - shape: mb x 3 x nx x ny
+                obs_pred = model(obs0, t, nt)
+        # reduce in float32 whatever precision the forward pass ran in
+        loss = torch.norm(obs_pred.float() - obs, p=2)
         
-        with torch.no_grad():
-            penalty = 1. / model.diversity_penalty()
-            penalty_meter.update(penalty.item())
-
-        loss.backward()
-        optimizer.step()
+        # only track gradients through the penalty if it is optimized
+        with torch.set_grad_enabled(args.diversity_weight > 0):
+            diversity = model.diversity_penalty()
+        penalty = 1. / diversity.detach()
+        penalty_meter.update(penalty.item())
+
+        scaler.scale(loss + args.diversity_weight * diversity).backward()
+        scaler.step(optimizer)
+        scaler.update()
         loss_meter.update(loss.item())
 
-        losses.append(loss.item())
-        penalties.append(penalty.item())
+        metrics_logger.log(itr, loss.item(), penalty.item(), n_samples=mb)
     
         if itr % 10 == 0:
-            torch.save({
+            is_best = loss.item() < best_loss
+            best_loss = min(best_loss, loss.item())
+            checkpoint_writer.save({
                 'model_state_dict': model.state_dict(),
                 'optimizer_state_dict': optimizer.state_dict(),
                 'config': args,
-                'losses': np.array(losses),
-                'penalties': np.array(penalties),
-            }, os.path.join(args.out_dir, 'checkpoint.pth.tar'))
+            }, itr, is_best=is_best)
 
-        tqdm_batch.set_postfix({"Loss": loss_meter.avg, "Penalty": penalty_meter.avg})
+        tqdm_batch.set_postfix({"Loss": loss_meter.avg, "Penalty": penalty_meter.avg, "NFE": model.nfe})
         tqdm_batch.update()
     tqdm_batch.close()
+    checkpoint_writer.close()
+    metrics_logger.close()
 
     with torch.no_grad():
-        data = np.load(args.npz_path)
-        u, v, p = data['u'], data['v'], data['p']
-        u = torch.from_numpy(u).float()
-        v = torch.from_numpy(v).float()
-        p = torch.from_numpy(p).float()
-        obs = torch.stack([u, v, p]).permute(1, 0, 2, 3).to(device)
-        nt, nx, ny = obs.size(0), obs.size(2), obs.size(3)
+        obs = load_trajectory(args.npz_path[0]).to(device)
+        nt = obs.size(0)
         obs = obs.unsqueeze(1)  # add a batch size of 1
         obs0 = obs[0]  # first timestep - shape: mb x 3 x nx x ny
         t = (torch.arange(nt) + 1).to(device)  
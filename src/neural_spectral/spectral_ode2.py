@@ -9,24 +9,50 @@ import torch.nn.utils.rnn as rnn_utils
 
 from torchdiffeq import odeint_adjoint as odeint
 from src.neural_spectral.anode import odesolver_adjoint as odesolver
+from src.neural_spectral.basis import make_basis, synthesize, project_onto_basis, stack_legacy_basis
+from src.neural_spectral.data import load_trajectory, get_window_loader
+from src.utils import AverageMeter, AsyncCheckpointWriter, MetricsLogger, autocast, grad_scaler
 
 
-class ODEFunc(nn.Module):
-    """Model basis coefficients as a an ODE wrt time"""
+class GroupedLinear(nn.Module):
+    """
+    G independent linear layers applied with a single bmm. The weight
+    is G x out x in, i.e. G nn.Linear weights stacked, and the input
+    is G x mb x in so group g only ever sees weight[g].
+    """
+
+    def __init__(self, n_groups, in_features, out_features):
+        super().__init__()
+        self.weight = nn.Parameter(torch.empty(n_groups, out_features, in_features))
+        self.bias = nn.Parameter(torch.empty(n_groups, out_features))
+
+    def forward(self, x):
+        return torch.baddbmm(self.bias.unsqueeze(1), x, self.weight.transpose(1, 2))
 
-    def __init__(self, K):
+
+class GroupedODEFunc(nn.Module):
+    """
+    One K -> 128 -> 128 -> K MLP per field fused into a block-diagonal
+    MLP, so all fields are integrated by a single solver call. The
+    state is n_fields x mb x K and fields never mix: group g of every
+    layer holds the weights of field g's own MLP (the separate
+    u/v/p_basis_coeffs of older checkpoints).
+    """
+
+    def __init__(self, K, n_fields=3):
         super().__init__()
         self.K = K
+        self.n_fields = n_fields
         self.net = nn.Sequential(
-            nn.Linear(self.K, 128),
+            GroupedLinear(n_fields, self.K, 128),
             nn.ReLU(inplace=True),
-            nn.Linear(128, 128),
+            GroupedLinear(n_fields, 128, 128),
             nn.ELU(inplace=True),
-            nn.Linear(128, self.K),
+            GroupedLinear(n_fields, 128, self.K),
         )
 
         for m in self.net.modules():
-            if isinstance(m, nn.Linear):
+            if isinstance(m, GroupedLinear):
                 nn.init.normal_(m.weight, mean=0, std=0.1)
                 nn.init.constant_(m.bias, val=0)
 
@@ -44,95 +70,113 @@ class PDEFunc(nn.Module):
 
     Notice this is very similar to a dynamic mixture 
     of experts (or ensemble) model.
+
+    If init_from_grid is True, w_k(0) is the least-squares projection
+    of the initial grid onto f_k(.) so every element of a minibatch
+    starts from its own state; otherwise w_k(0) is learned and shared.
+
+    If basis_rank is set, each f_k(.) is a sum of basis_rank separable
+    outer products a(x) b(y)^T instead of a full nx x ny grid.
+
+    method is any anode scheme; the adaptive ones (Bosh3, Dopri5)
+    report their function evaluations of the last solve in self.nfe.
     """
     
-    def __init__(self, K, nx, ny):
+    def __init__(self, K, nx, ny, init_from_grid=False, basis_rank=None, method='RK4'):
         super().__init__()
         self.K = K
         self.nx, self.ny = nx, ny
-        self.u_init_coeffs = nn.Parameter(torch.normal(torch.zeros(self.K), 1))
-        self.v_init_coeffs = nn.Parameter(torch.normal(torch.zeros(self.K), 1))
-        self.p_init_coeffs = nn.Parameter(torch.normal(torch.zeros(self.K), 1))
-        self.u_basis_coeffs = ODEFunc(self.K)
-        self.v_basis_coeffs = ODEFunc(self.K)
-        self.p_basis_coeffs = ODEFunc(self.K)
-        self.u_basis_fns = nn.ParameterList([
-            nn.Parameter(torch.normal(torch.zeros(self.nx, self.ny), 1))
-            for _ in range(self.K)])
-        self.v_basis_fns = nn.ParameterList([
-            nn.Parameter(torch.normal(torch.zeros(self.nx, self.ny), 1))
-            for _ in range(self.K)])
-        self.p_basis_fns = nn.ParameterList([
-            nn.Parameter(torch.normal(torch.zeros(self.nx, self.ny), 1))
-            for _ in range(self.K)])
-
-    def forward(self, grid0, t):
+        self.init_from_grid = init_from_grid
+        self.basis_rank = basis_rank
+        self.method = method
+        self.nfe = 0
+        if not self.init_from_grid:
+            self.u_init_coeffs = nn.Parameter(torch.normal(torch.zeros(self.K), 1))
+            self.v_init_coeffs = nn.Parameter(torch.normal(torch.zeros(self.K), 1))
+            self.p_init_coeffs = nn.Parameter(torch.normal(torch.zeros(self.K), 1))
+        # u, v and p dynamics, fused so they are integrated together
+        self.basis_coeffs = GroupedODEFunc(self.K, n_fields=3)
+        # stacked K x nx x ny (or its separable factors) so synthesis is one einsum per field
+        self.u_basis_fns = make_basis(self.K, self.nx, self.ny, rank=self.basis_rank)
+        self.v_basis_fns = make_basis(self.K, self.nx, self.ny, rank=self.basis_rank)
+        self.p_basis_fns = make_basis(self.K, self.nx, self.ny, rank=self.basis_rank)
+        self._register_load_state_dict_pre_hook(self._load_legacy_basis)
+
+    def forward(self, grid0, t, n_frames=None):
         # grid0 = mb x 3 x nx x ny
         # t     = nt
         # coeff = nt x mb x K*3
     
         mb, nt = grid0.size(0), t.size(0)
-        u_coeff = odesolver(  self.u_basis_coeffs, 
-                              self.u_init_coeffs.unsqueeze(0).repeat(mb, 1), 
-                              {'Nt': nt, 'method': 'RK4'}  )
-        v_coeff = odesolver(  self.v_basis_coeffs, 
-                              self.v_init_coeffs.unsqueeze(0).repeat(mb, 1), 
-                              {'Nt': nt, 'method': 'RK4'}  )
-        p_coeff = odesolver(  self.p_basis_coeffs, 
-                              self.p_init_coeffs.unsqueeze(0).repeat(mb, 1), 
-                              {'Nt': nt, 'method': 'RK4'}  )
-
-        u_soln, v_soln, p_soln = 0, 0, 0
-        for k in range(self.K):
-            u_f_k = self.u_basis_fns[k]
-            u_f_k = u_f_k.unsqueeze(0).repeat(nt * mb, 1, 1)
-            u_f_k = u_f_k.view(nt, mb, self.nx, self.ny)
-            u_w_k = u_coeff[:, :, k, None, None]
-            u_soln = u_soln + u_f_k * u_w_k
-
-            v_f_k = self.v_basis_fns[k]
-            v_f_k = v_f_k.unsqueeze(0).repeat(nt * mb, 1, 1)
-            v_f_k = v_f_k.view(nt, mb, self.nx, self.ny)
-            v_w_k = v_coeff[:, :, k, None, None]
-            v_soln = v_soln + v_f_k * v_w_k
-
-            p_f_k = self.p_basis_fns[k]
-            p_f_k = p_f_k.unsqueeze(0).repeat(nt * mb, 1, 1)
-            p_f_k = p_f_k.view(nt, mb, self.nx, self.ny)
-            p_w_k = p_coeff[:, :, k, None, None]
-            p_soln = p_soln + p_f_k * p_w_k
-        
-        soln = torch.cat([u_soln.unsqueeze(2), v_soln.unsqueeze(2), 
-                          p_soln.unsqueeze(2)], dim=2)
+        init_coeff = torch.stack(self.initial_coeffs(grid0))  # 3 x mb x K
+        # t holds 1-based frame indices, possibly a sparse subset of the
+        # n_frames (default: t[-1]) frames spanning [0, 1]: take one
+        # solver step per frame and only output the requested ones
+        Nt = int(t[-1]) if n_frames is None else n_frames
+        options = {'Nt': Nt, 't': t.double() / Nt, 'method': self.method}
+        coeff = odesolver(  self.basis_coeffs, 
+                            init_coeff, 
+                            options  )
+        self.nfe = options['nfe']
+        u_coeff, v_coeff, p_coeff = coeff.unbind(1)  # each nt x mb x K
+
+        # sum_k w_k(t) * f_k(x,y) without materializing nt*mb copies of f_k
+        u_soln = synthesize(u_coeff, self.u_basis_fns)
+        v_soln = synthesize(v_coeff, self.v_basis_fns)
+        p_soln = synthesize(p_coeff, self.p_basis_fns)
+
+        soln = torch.stack([u_soln, v_soln, p_soln], dim=2)
         return soln
 
-
-class AverageMeter(object):
-    """Computes and stores the average and current value"""
-    def __init__(self):
-        self.reset()
-
-    def reset(self):
-        self.val = 0
-        self.avg = 0
-        self.sum = 0
-        self.count = 0
-
-    def update(self, val, n=1):
-        self.val = val
-        self.sum += val * n
-        self.count += n
-        self.avg = self.sum / self.count
+    def initial_coeffs(self, grid0):
+        # returns three mb x K tensors for u, v and p
+        mb = grid0.size(0)
+        if not self.init_from_grid:
+            return (self.u_init_coeffs.unsqueeze(0).repeat(mb, 1),
+                    self.v_init_coeffs.unsqueeze(0).repeat(mb, 1),
+                    self.p_init_coeffs.unsqueeze(0).repeat(mb, 1))
+        return (project_onto_basis(grid0[:, 0], self.u_basis_fns),
+                project_onto_basis(grid0[:, 1], self.v_basis_fns),
+                project_onto_basis(grid0[:, 2], self.p_basis_fns))
+
+    def _load_legacy_basis(self, state_dict, prefix, *args):
+        for name in ['u_basis_fns', 'v_basis_fns', 'p_basis_fns']:
+            stack_legacy_basis(state_dict, prefix, name)
+        # separate u/v/p_basis_coeffs MLPs are stacked into the grouped one
+        legacy = prefix + 'u_basis_coeffs.'
+        for key in [k for k in state_dict if k.startswith(legacy)]:
+            name = key[len(legacy):]
+            state_dict[prefix + 'basis_coeffs.' + name] = torch.stack(
+                [state_dict.pop(prefix + field + '_basis_coeffs.' + name) for field in 'uvp'])
 
 
 if __name__ == "__main__":
     import argparse
     parser = argparse.ArgumentParser()
-    parser.add_argument('--npz-path', type=str, default='../data/data_semi_implicit.npz')
+    parser.add_argument('--npz-path', type=str, nargs='+', default=['../data/data_semi_implicit.npz'],
+                        help='one or more trajectory files to train on')
     parser.add_argument('--out-dir', type=str, default='./checkpoints/spectral_ode2', 
                         help='where to save checkpoints [default: ./checkpoints/spectral_ode2]')
     parser.add_argument('--n-iters', type=int, default=1000, help='default: 1000')
     parser.add_argument('--n-coeffs', type=int, default=10, help='default: 10')
+    parser.add_argument('--basis-rank', type=int, default=None, 
+                        help='use separable basis functions of this rank [default: dense]')
+    parser.add_argument('--method', type=str, default='RK4', 
+                        choices=['Euler', 'RK2', 'RK4', 'Bosh3', 'Dopri5', 'ALF'],
+                        help='ODE solver for the coefficients [default: RK4]')
+    parser.add_argument('--window', type=int, default=100, 
+                        help='time steps per training window [default: 100]')
+    parser.add_argument('--frame-stride', type=int, default=1, 
+                        help='only fit every n-th frame of a window [default: 1]')
+    parser.add_argument('--batch-size', type=int, default=1, help='default: 1')
+    parser.add_argument('--random-windows', action='store_true', default=False,
+                        help='sample window starts uniformly instead of always at t=0')
+    parser.add_argument('--num-workers', type=int, default=0, 
+                        help='data loading processes [default: 0]')
+    parser.add_argument('--keep-checkpoints', type=int, default=3, 
+                        help='numbered checkpoints to keep on disk [default: 3]')
+    parser.add_argument('--amp', type=str, default='none', choices=['none', 'bf16', 'fp16'],
+                        help='autocast the forward pass to this precision [default: none]')
     parser.add_argument('--gpu-device', type=int, default=0, help='default: 0')
     args = parser.parse_args()
     args.out_dir = '{}_{}'.format(args.out_dir, args.n_coeffs)
@@ -143,56 +187,69 @@ if __name__ == "__main__":
     device = (torch.device('cuda:' + str(args.gpu_device)
               if torch.cuda.is_available() else 'cpu'))
 
-    data = np.load(args.npz_path)
-    u, v, p = data['u'][:100], data['v'][:100], data['p'][:100]
-    u = torch.from_numpy(u).float()
-    v = torch.from_numpy(v).float()
-    p = torch.from_numpy(p).float()
-    obs = torch.stack([u, v, p]).permute(1, 0, 2, 3).to(device)
-    nt, nx, ny = obs.size(0), obs.size(2), obs.size(3)
-    obs = obs.unsqueeze(1)  # add a batch size of 1
-    obs0 = obs[0]  # first timestep - shape: mb x 3 x nx x ny
-    t = (torch.arange(nt) + 1).to(device)
+    loader = get_window_loader(args.npz_path, args.window, args.batch_size, args.n_iters,
+                               random_start=args.random_windows,
+                               num_workers=args.num_workers,
+                               pin_memory=torch.cuda.is_available())
+    nx, ny = loader.dataset[0].size(2), loader.dataset[0].size(3)
+    nt = args.window
+    # train on every frame_stride-th frame of each window
+    frames = torch.arange(0, nt, args.frame_stride)
+    t = (frames + 1).to(device)
     K = args.n_coeffs
 
-    model = PDEFunc(K, nx, ny).to(device)
+    # random windows, or windows of several trajectories, do not start
+    # from a shared state so the initial coefficients have to come from
+    # the observed first frame
+    init_from_grid = args.random_windows or len(args.npz_path) > 1
+    model = PDEFunc(K, nx, ny, init_from_grid=init_from_grid,
+                    basis_rank=args.basis_rank, method=args.method).to(device)
     optimizer = optim.Adam(model.parameters(), lr=1e-3)
+    scaler = grad_scaler(device, args.amp)
 
     loss_meter = AverageMeter()
-    losses = []
+
+    checkpoint_writer = AsyncCheckpointWriter(args.out_dir, keep_last=args.keep_checkpoints)
+    metrics_logger = MetricsLogger(os.path.join(args.out_dir, 'metrics.bin'))
+    best_loss = np.inf
 
     tqdm_batch = tqdm(total=args.n_iters, desc="[Iteration]")
-    for itr in range(1, args.n_iters + 1):
+    for itr, obs in enumerate(loader, 1):
+        obs = obs[:, frames].to(device, non_blocking=True)
+        obs = obs.permute(1, 0, 2, 3, 4)  # nt x mb x 3 x nx x ny
+        obs0 = obs[0]  # first timestep - shape: mb x 3 x nx x ny
+
         optimizer.zero_grad()
 
-        obs_pred = model(obs0, t)
-        loss = torch.norm(obs_pred - obs, p=2)
-        loss.backward()
-        optimizer.step()
+        with autocast(device, args.amp):
+            obs_pred = model(obs0, t, nt)
+        # reduce in float32 whatever precision the forward pass ran in
+        loss = torch.norm(obs_pred.float() - obs, p=2)
+        scaler.scale(loss).backward()
+        scaler.step(optimizer)
+        scaler.update()
         loss_meter.update(loss.item())
 
-        losses.append(loss.item())
+        metrics_logger.log(itr, loss.item(), n_samples=obs0.size(0))
     
         if itr % 10 == 0:
-            torch.save({
+            is_best = loss.item() < best_loss
+            best_loss = min(best_loss, loss.item())
+            checkpoint_writer.save({
                 'model_state_dict': model.state_dict(),
                 'optimizer_state_dict': optimizer.state_dict(),
                 'config': args,
-                'losses': np.array(losses),
-            }, os.path.join(args.out_dir, 'checkpoint.pth.tar'))
+            }, itr, is_best=is_best)
 
-        tqdm_batch.set_postfix({"Loss": loss_meter.avg})
+        tqdm_batch.set_postfix({"Loss": loss_meter.avg, "NFE": model.nfe})
         tqdm_batch.update()
     tqdm_batch.close()
+    checkpoint_writer.close()
+    metrics_logger.close()
 
     with torch.no_grad():
-        data = np.load(args.npz_path)
-        u, v, p = data['u'], data['v'], data['p']
-        u = torch.from_numpy(u).float()
-        v = torch.from_numpy(v).float()
-        p = torch.from_numpy(p).float()
-        obs = torch.stack([u, v, p]).permute(1, 0, 2, 3).to(device)
-        nt, nx, ny = obs.size(0), obs.size(2), obs.size(3)
+        obs = load_trajectory(args.npz_path[0]).to(device)
+        nt = obs.size(0)
         obs = obs.unsqueeze(1)  # add a batch size of 1
         obs0 = obs[0]  # first timestep - shape: mb x 3 x nx x ny
         t = (torch.arange(nt) + 1).to(device)  
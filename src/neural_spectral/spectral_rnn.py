@@ -8,6 +8,52 @@ import torch.optim as optim
 import torch.nn.utils.rnn as rnn_utils
 
 from torchdiffeq import odeint_adjoint as odeint
+from src.neural_spectral.basis import (make_basis, synthesize, project_onto_basis,
+                                        pairwise_distances, stack_legacy_basis)
+from src.neural_spectral.data import load_trajectory, get_window_loader
+from src.utils import AverageMeter, AsyncCheckpointWriter, MetricsLogger, autocast, grad_scaler
+
+
+class GRURollout(nn.Module):
+    """
+    Autonomous GRU rollout of the basis coefficients
+
+        h_1 = GRU(w(0), 0),   h_{t+1} = GRU(h_t, h_t)
+
+    i.e. each step feeds the previous output back in as the input.
+    Built on a GRUCell writing into a preallocated nt x mb x D buffer,
+    so the loop has no list bookkeeping and the module can be passed
+    to torch.jit.script or torch.compile.
+
+    Args
+    ----
+    hidden_size := integer
+                   size of the coefficient vector (K*3)
+    """
+
+    def __init__(self, hidden_size):
+        super().__init__()
+        self.hidden_size = hidden_size
+        self.cell = nn.GRUCell(hidden_size, hidden_size)
+        self._register_load_state_dict_pre_hook(self._load_legacy_gru)
+
+    def forward(self, init_coeff, nt: int):
+        # init_coeff = mb x D; returns nt x mb x D
+        mb = init_coeff.size(0)
+        coeff = init_coeff.new_empty(nt, mb, self.hidden_size)
+        h = self.cell(init_coeff, torch.zeros_like(init_coeff))
+        coeff[0] = h
+        for i in range(1, nt):
+            h = self.cell(h, h)
+            coeff[i] = h
+        return coeff
+
+    def _load_legacy_gru(self, state_dict, prefix, *args):
+        # checkpoints from the nn.GRU version store weight_ih_l0 etc.
+        for name in ['weight_ih', 'weight_hh', 'bias_ih', 'bias_hh']:
+            legacy = prefix + name + '_l0'
+            if legacy in state_dict:
+                state_dict[prefix + 'cell.' + name] = state_dict.pop(legacy)
 
 
 class PDEFunc(nn.Module):
@@ -20,28 +66,31 @@ class PDEFunc(nn.Module):
 
     Notice this is very similar to a dynamic mixture 
     of experts (or ensemble) model.
+
+    If init_from_grid is True, w_k(0) is the least-squares projection
+    of the initial grid onto f_k(.) so every element of a minibatch
+    starts from its own state; otherwise w_k(0) is learned and shared.
+
+    If basis_rank is set, each f_k(.) is a sum of basis_rank separable
+    outer products a(x) b(y)^T instead of a full nx x ny grid.
     """
     
-    def __init__(self, K, nx, ny):
+    def __init__(self, K, nx, ny, init_from_grid=False, basis_rank=None):
         super().__init__()
         self.K = K
         self.nx, self.ny = nx, ny
-        self.init_coeffs = nn.Parameter(torch.normal(torch.zeros(self.K * 3), 1))
-        self.basis_coeffs = nn.GRU(self.K * 3, self.K * 3, batch_first=True)
-        self.basis_fns = nn.ParameterList([
-            nn.Parameter(torch.normal(torch.zeros(3, self.nx, self.ny), 1))
-            for _ in range(self.K)
-        ])
+        self.init_from_grid = init_from_grid
+        self.basis_rank = basis_rank
+        if not self.init_from_grid:
+            self.init_coeffs = nn.Parameter(torch.normal(torch.zeros(self.K * 3), 1))
+        self.basis_coeffs = GRURollout(self.K * 3)
+        # stacked K x 3 x nx x ny (or its separable factors) so synthesis is one einsum
+        self.basis_fns = make_basis(self.K, self.nx, self.ny, rank=self.basis_rank, n_channels=3)
+        self._register_load_state_dict_pre_hook(self._load_legacy_basis)
 
     def rnnint(self, init_coeff, nt):
-        inputs = init_coeff.unsqueeze(1)
-        h0 = None
-        coeff = []
-        for t in range(nt):
-            inputs, h0 = self.basis_coeffs(inputs, h0)
-            coeff.append(inputs.squeeze(1))
-        coeff = torch.cat(coeff)
-        return coeff
+        # returns nt x mb x K*3
+        return self.basis_coeffs(init_coeff, nt)
 
     def forward(self, grid0, t):
         # grid0 = mb x 3 x nx x ny
@@ -49,62 +98,64 @@ class PDEFunc(nn.Module):
         # coeff = nt x mb x K*3
 
         mb, nt = grid0.size(0), t.size(0)
-        coeff = self.rnnint(self.init_coeffs.unsqueeze(0).repeat(mb, 1), nt)
+        coeff = self.rnnint(self.initial_coeffs(grid0), nt)
         coeff = coeff.view(nt, mb, self.K, 3)
 
-        soln = 0
-        for k in range(self.K):
-            f_k = self.basis_fns[k]
-            f_k = f_k.unsqueeze(0).repeat(nt * mb, 1, 1, 1)
-            f_k = f_k.view(nt, mb, 3, self.nx, self.ny)
-            w_k = coeff[:, :, k, :, None, None]
-            soln = soln + f_k * w_k
-        
+        # sum_k w_k(t) * f_k(x,y) without materializing nt*mb copies of f_k
+        soln = synthesize(coeff, self.basis_fns)
         return soln
 
+    def initial_coeffs(self, grid0):
+        # returns mb x K*3, laid out to match coeff.view(nt, mb, K, 3)
+        mb = grid0.size(0)
+        if not self.init_from_grid:
+            return self.init_coeffs.unsqueeze(0).repeat(mb, 1)
+        return project_onto_basis(grid0, self.basis_fns).reshape(mb, self.K * 3)
+
+    def _load_legacy_basis(self, state_dict, prefix, *args):
+        stack_legacy_basis(state_dict, prefix, 'basis_fns')
+
     def basis_weight_mat(self):
-        W = []
-        for k in range(self.K):
-            theta = self.basis_fns[k].flatten()
-            W.append(theta)
-        return torch.stack(W)
+        # K x 3*nx*ny matrix of basis functions (a view for the dense basis)
+        if self.basis_rank is not None:
+            return self.basis_fns.dense().flatten(1)
+        return self.basis_fns.flatten(1)
 
     def diversity_penalty(self):
-        W = self.basis_weight_mat()
-        penalty = 0
-        for i in range(0, self.K):
-            for j in range(i, self.K):
-                penalty = penalty + torch.norm(W[i] - W[j], p=2)
+        # inverse of the summed pairwise L2 distances between basis
+        # functions, all i < j pairs computed in a single kernel
+        penalty = pairwise_distances(self.basis_fns).sum()
         penalty = 1. / penalty
         return penalty
 
 
-class AverageMeter(object):
-    """Computes and stores the average and current value"""
-    def __init__(self):
-        self.reset()
-
-    def reset(self):
-        self.val = 0
-        self.avg = 0
-        self.sum = 0
-        self.count = 0
-
-    def update(self, val, n=1):
-        self.val = val
-        self.sum += val * n
-        self.count += n
-        self.avg = self.sum / self.count
-
-
 if __name__ == "__main__":
     import argparse
     parser = argparse.ArgumentParser()
-    parser.add_argument('--npz-path', type=str, default='../data/data_semi_implicit.npz')
+    parser.add_argument('--npz-path', type=str, nargs='+', default=['../data/data_semi_implicit.npz'],
+                        help='one or more trajectory files to train on')
     parser.add_argument('--out-dir', type=str, default='./checkpoints/spectral_rnn', 
                         help='where to save checkpoints [default: ./checkpoints/spectral_rnn]')
     parser.add_argument('--n-iters', type=int, default=1000, help='default: 1000')
     parser.add_argument('--n-coeffs', type=int, default=10, help='default: 10')
+    parser.add_argument('--basis-rank', type=int, default=None, 
+                        help='use separable basis functions of this rank [default: dense]')
+    parser.add_argument('--diversity-weight', type=float, default=0., 
+                        help='weight of the diversity penalty in the loss; 0 only monitors it [default: 0]')
+    parser.add_argument('--window', type=int, default=100, 
+                        help='time steps per training window [default: 100]')
+    parser.add_argument('--batch-size', type=int, default=1, help='default: 1')
+    parser.add_argument('--random-windows', action='store_true', default=False,
+                        help='sample window starts uniformly instead of always at t=0')
+    parser.add_argument('--num-workers', type=int, default=0, 
+                        help='data loading processes [default: 0]')
+    parser.add_argument('--keep-checkpoints', type=int, default=3, 
+                        help='numbered checkpoints to keep on disk [default: 3]')
+    parser.add_argument('--compile', type=str, default='none', 
+                        choices=['none', 'script', 'inductor'],
+                        help='compile the GRU rollout with TorchScript or torch.compile [default: none]')
+    parser.add_argument('--amp', type=str, default='none', choices=['none', 'bf16', 'fp16'],
+                        help='autocast the forward pass to this precision [default: none]')
     parser.add_argument('--gpu-device', type=int, default=0, help='default: 0')
     args = parser.parse_args()
     args.out_dir = '{}_{}'.format(args.out_dir, args.n_coeffs)
@@ -115,64 +166,80 @@ if __name__ == "__main__":
     device = (torch.device('cuda:' + str(args.gpu_device)
               if torch.cuda.is_available() else 'cpu'))
 
-    data = np.load(args.npz_path)
-    u, v, p = data['u'][:100], data['v'][:100], data['p'][:100]
-    u = torch.from_numpy(u).float()
-    v = torch.from_numpy(v).float()
-    p = torch.from_numpy(p).float()
-    obs = torch.stack([u, v, p]).permute(1, 0, 2, 3).to(device)
-    nt, nx, ny = obs.size(0), obs.size(2), obs.size(3)
-    obs = obs.unsqueeze(1)  # add a batch size of 1
-    obs0 = obs[0]  # first timestep - shape: mb x 3 x nx x ny
+    loader = get_window_loader(args.npz_path, args.window, args.batch_size, args.n_iters,
+                               random_start=args.random_windows,
+                               num_workers=args.num_workers,
+                               pin_memory=torch.cuda.is_available())
+    nx, ny = loader.dataset[0].size(2), loader.dataset[0].size(3)
+    nt = args.window
     t = (torch.arange(nt) + 1).to(device)
     K = args.n_coeffs
 
-    model = PDEFunc(K, nx, ny).to(device)
+    # random windows, or windows of several trajectories, do not start
+    # from a shared state so the initial coefficients have to come from
+    # the observed first frame
+    init_from_grid = args.random_windows or len(args.npz_path) > 1
+    model = PDEFunc(K, nx, ny, init_from_grid=init_from_grid,
+                    basis_rank=args.basis_rank).to(device)
+    # both keep the parameters and state_dict keys of the original module
+    if args.compile == 'script':
+        model.basis_coeffs = torch.jit.script(model.basis_coeffs)
+    elif args.compile == 'inductor':
+        model.basis_coeffs.forward = torch.compile(model.basis_coeffs.forward)
     optimizer = optim.Adam(model.parameters(), lr=1e-3)
+    scaler = grad_scaler(device, args.amp)
 
     loss_meter = AverageMeter()
     penalty_meter = AverageMeter()
-    losses, penalties = [], []
+
+    checkpoint_writer = AsyncCheckpointWriter(args.out_dir, keep_last=args.keep_checkpoints)
+    metrics_logger = MetricsLogger(os.path.join(args.out_dir, 'metrics.bin'))
+    best_loss = np.inf
 
     tqdm_batch = tqdm(total=args.n_iters, desc="[Iteration]")
-    for itr in range(1, args.n_iters + 1):
+    for itr, obs in enumerate(loader, 1):
+        obs = obs.to(device, non_blocking=True)
+        obs = obs.permute(1, 0, 2, 3, 4)  # nt x mb x 3 x nx x ny
+        obs0 = obs[0]  # first timestep - shape: mb x 3 x nx x ny
+
         optimizer.zero_grad()
 
-        obs_pred = model(obs0, t)
-        loss = torch.norm(obs_pred - obs, p=2)
+        with autocast(device, args.amp):
+            obs_pred = model(obs0, t)
+        # reduce in float32 whatever precision the forward pass ran in
+        loss = torch.norm(obs_pred.float() - obs, p=2)
 
-        with torch.no_grad():
-            penalty = 1. / model.diversity_penalty()
-            penalty_meter.update(penalty.item())
+        # only track gradients through the penalty if it is optimized
+        with torch.set_grad_enabled(args.diversity_weight > 0):
+            diversity = model.diversity_penalty()
+        penalty = 1. / diversity.detach()
+        penalty_meter.update(penalty.item())
 
-        loss.backward()
-        optimizer.step()
+        scaler.scale(loss + args.diversity_weight * diversity).backward()
+        scaler.step(optimizer)
+        scaler.update()
         loss_meter.update(loss.item())
 
-        losses.append(loss.item())
-        penalties.append(penalty.item())
+        metrics_logger.log(itr, loss.item(), penalty.item(), n_samples=obs0.size(0))
     
         if itr % 10 == 0:
-            torch.save({
+            is_best = loss.item() < best_loss
+            best_loss = min(best_loss, loss.item())
+            checkpoint_writer.save({
                 'model_state_dict': model.state_dict(),
                 'optimizer_state_dict': optimizer.state_dict(),
                 'config': args,
-                'losses': np.array(losses),
-                'penalties': np.array(penalties),
-            }, os.path.join(args.out_dir, 'checkpoint.pth.tar'))
+            }, itr, is_best=is_best)
 
         tqdm_batch.set_postfix({"Loss": loss_meter.avg})
         tqdm_batch.update()
     tqdm_batch.close()
+    checkpoint_writer.close()
+    metrics_logger.close()
 
     with torch.no_grad():
-        data = np.load(args.npz_path)
-        u, v, p = data['u'], data['v'], data['p']
-        u = torch.from_numpy(u).float()
-        v = torch.from_numpy(v).float()
-        p = torch.from_numpy(p).float()
-        obs = torch.stack([u, v, p]).permute(1, 0, 2, 3).to(device)
-        nt, nx, ny = obs.size(0), obs.size(2), obs.size(3)
+        obs = load_trajectory(args.npz_path[0]).to(device)
+        nt = obs.size(0)
         obs = obs.unsqueeze(1)  # add a batch size of 1
         obs0 = obs[0]  # first timestep - shape: mb x 3 x nx x ny
         t = (torch.arange(nt) + 1).to(device)  
@@ -0,0 +1,184 @@
+"""
+Parareal time-parallel integration of a NavierStokesSystem. The time
+horizon is cut into slices; a cheap coarse propagator G sweeps through
+them serially while the fine propagator F (the system's own step())
+advances every slice from its current start state in parallel, in a
+process pool. Each iteration corrects the slice start states with
+
+    U[n+1] = G(U_new[n]) + F(U[n]) - G(U[n])
+
+and stops once they change less than a tolerance. After k iterations
+the first k slices are exact, so at worst it costs as much as the
+serial run; it pays off when it converges in a few iterations.
+
+The coarse propagator is the same solver with a coarsening-factor times
+larger dt, or on a grid coarsened by injection (uniform grids of size
+factor * m + 1) with linear interpolation back to the fine grid.
+
+    python -m src.parareal --solver direct_fd --nx 33 --nt 400 --n-slices 8 \
+        --coarsen time --workers 8
+"""
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+from scipy.interpolate import RegularGridInterpolator
+
+from src.cavity import SOLVERS, cavity_system, initial_state, advance
+
+_system = None  # the fine system of a worker process
+
+
+def _init_worker(system):
+    global _system
+    _system = system
+
+
+def _fine(state, n_steps):
+    with np.errstate(over='ignore', invalid='ignore'):
+        return advance(_system, state, n_steps)
+
+
+def restrict(state, factor):
+    """Inject a state onto every factor-th point of a uniform grid."""
+    return tuple(x[::factor, ::factor].copy() for x in state)
+
+
+def prolong(state, shape):
+    """Linearly interpolate a state on a uniform grid onto a finer one of the given shape."""
+    nx, ny = state[0].shape
+    X, Y = np.meshgrid(np.linspace(0, 1, shape[0]), np.linspace(0, 1, shape[1]), indexing='ij')
+    points = np.stack([X.ravel(), Y.ravel()], axis=1)
+    grid = (np.linspace(0, 1, nx), np.linspace(0, 1, ny))
+    return tuple(RegularGridInterpolator(grid, x)(points).reshape(shape) for x in state)
+
+
+class CoarsePropagator(object):
+    """
+    G over one slice: n_steps // factor steps of a coarse system, which
+    has a factor times larger dt (coarsen='time') or a factor times
+    coarser grid (coarsen='space', with the same number of steps).
+    """
+
+    def __init__(self, coarse_system, factor, coarsen='time'):
+        assert coarsen in ['time', 'space']
+        self.system, self.factor, self.coarsen = coarse_system, factor, coarsen
+
+    def __call__(self, state, n_steps):
+        with np.errstate(over='ignore', invalid='ignore'):
+            if self.coarsen == 'time':
+                return advance(self.system, state, max(1, n_steps // self.factor))
+            shape = state[0].shape
+            coarse = advance(self.system, restrict(state, self.factor), n_steps)
+            return prolong(coarse, shape)
+
+
+def state_change(a, b):
+    """Largest change of u or v between two states."""
+    return max(np.abs(a[0] - b[0]).max(), np.abs(a[1] - b[1]).max())
+
+
+def parareal(system, coarse, n_slices, n_steps, state=None, tol=1e-6, max_iters=None,
+             workers=None, verbose=False):
+    """
+    Integrate system for n_slices * n_steps steps with Parareal.
+
+    Args
+    ----
+    system := NavierStokesSystem
+              the fine propagator, run by the pool (it is pickled once
+              into every worker)
+    coarse := callable
+              G(state, n_steps) -> state over one slice, e.g. a
+              CoarsePropagator
+    n_slices := integer
+                number of time slices
+    n_steps := integer
+               fine steps per slice
+    state := tuple (default: None)
+             (u, v, u1, v1, p) at the start; the initial conditions if None
+    tol := float (default: 1e-6)
+           stop when no slice start state moves more than this
+    max_iters := integer (default: None)
+                 at most this many iterations; n_slices if None
+    workers := integer (default: None)
+               size of the process pool; the number of cores if None
+
+    Returns the states at the n_slices + 1 slice boundaries and the
+    number of iterations.
+    """
+    if state is None:
+        state = initial_state(system)
+    max_iters = n_slices if max_iters is None else max_iters
+
+    # initial coarse sweep
+    U = [state]
+    G_old = []
+    for n in range(n_slices):
+        G_old.append(coarse(U[n], n_steps))
+        U.append(G_old[n])
+
+    with ProcessPoolExecutor(max_workers=workers, initializer=_init_worker,
+                             initargs=(system,)) as pool:
+        for k in range(max_iters):
+            # slices before k are already exact
+            F = list(pool.map(_fine, U[k:n_slices], [n_steps] * (n_slices - k)))
+            U_new = U[:k + 1]
+            change = 0.
+            for n in range(k, n_slices):
+                G_new = coarse(U_new[n], n_steps)
+                corrected = tuple(g + f - g_old for g, f, g_old in zip(G_new, F[n - k], G_old[n]))
+                change = max(change, state_change(corrected, U[n + 1]))
+                U_new.append(corrected)
+                G_old[n] = G_new
+            U = U_new
+            if verbose:
+                print('iteration {}: max change {:.3e}'.format(k + 1, change))
+            if change < tol:
+                break
+
+    return U, k + 1
+
+
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--solver', type=str, default='direct_fd', choices=SOLVERS,
+                        help='default: direct_fd')
+    parser.add_argument('--nx', type=int, default=33, help='nx = ny [default: 33]')
+    parser.add_argument('--nt', type=int, default=400, help='total fine steps [default: 400]')
+    parser.add_argument('--dt', type=float, default=1e-3, help='default: 1e-3')
+    parser.add_argument('--n-slices', type=int, default=8, help='default: 8')
+    parser.add_argument('--coarsen', type=str, default='time', choices=['time', 'space'],
+                        help='coarse propagator: larger dt or coarser grid [default: time]')
+    parser.add_argument('--factor', type=int, default=4, help='coarsening factor [default: 4]')
+    parser.add_argument('--tol', type=float, default=1e-6, help='default: 1e-6')
+    parser.add_argument('--workers', type=int, default=None,
+                        help='process pool size [default: number of cores]')
+    args = parser.parse_args()
+
+    assert args.nt % args.n_slices == 0, '--nt must be a multiple of --n-slices'
+    n_steps = args.nt // args.n_slices
+
+    system = cavity_system(args.solver, nx=args.nx, ny=args.nx, dt=args.dt)
+    if args.coarsen == 'time':
+        coarse_system = cavity_system(args.solver, nx=args.nx, ny=args.nx, dt=args.dt * args.factor)
+    else:
+        assert (args.nx - 1) % args.factor == 0, '--nx - 1 must be a multiple of --factor'
+        coarse_system = cavity_system(args.solver, nx=(args.nx - 1) // args.factor + 1,
+                                      ny=(args.nx - 1) // args.factor + 1, dt=args.dt)
+    coarse = CoarsePropagator(coarse_system, args.factor, args.coarsen)
+
+    start = time.perf_counter()
+    serial = advance(system, initial_state(system), args.nt)
+    serial_s = time.perf_counter() - start
+
+    start = time.perf_counter()
+    U, n_iters = parareal(system, coarse, args.n_slices, n_steps, tol=args.tol,
+                          workers=args.workers, verbose=True)
+    parareal_s = time.perf_counter() - start
+
+    print('serial:   {:.2f}s'.format(serial_s))
+    print('parareal: {:.2f}s in {} iterations ({:.2f}x speedup)'.format(
+        parareal_s, n_iters, serial_s / parareal_s))
+    print('max difference from serial at the end: {:.2e}'.format(state_change(U[-1], serial)))
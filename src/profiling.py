@@ -0,0 +1,189 @@
+"""
+Instrumentation for the NavierStokesSystem simulators. Each simulator
+takes a profiler and wraps the phases of step() in profiler.phase(name)
+and reports solver statistics (e.g. pressure iterations) through
+profiler.count(name, n). The default NullProfiler does nothing; a
+PhaseProfiler records wall time and memory per (nested) phase and
+exports them for chrome://tracing / Perfetto or as folded stacks for
+flamegraph.pl / speedscope.
+
+    python -m src.profiling --solver chorin_fd --nx 33 --nt 20 \
+        --trace trace.json --folded step.folded
+"""
+import time
+import json
+import tracemalloc
+from contextlib import nullcontext
+
+
+class NullProfiler(object):
+    """Profiler that records nothing, at the cost of one method call per phase."""
+    enabled = False
+    _null = nullcontext()
+
+    def phase(self, name):
+        return self._null
+
+    def count(self, name, n=1):
+        pass
+
+
+class _Phase(object):
+    __slots__ = ('profiler', 'name', 'start', 'memory', 'children_s')
+
+    def __init__(self, profiler, name):
+        self.profiler = profiler
+        self.name = name
+
+    def __enter__(self):
+        self.children_s = 0.
+        if self.profiler.track_memory:
+            current, peak = tracemalloc.get_traced_memory()
+            stack = self.profiler._stack
+            if stack:  # keep the parent's peak before resetting it
+                stack[-1].memory[1] = max(stack[-1].memory[1], peak)
+            tracemalloc.reset_peak()
+            self.memory = [current, current]
+        self.profiler._stack.append(self)
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        end = time.perf_counter()
+        profiler = self.profiler
+        stack = profiler._stack
+        stack.pop()
+        duration = end - self.start
+        event = {
+            'stack': tuple(p.name for p in stack) + (self.name,),
+            'start': self.start - profiler._t0, 'duration': duration,
+            'self': duration - self.children_s,
+        }
+        if profiler.track_memory:
+            current, peak = tracemalloc.get_traced_memory()
+            peak = max(self.memory[1], peak)
+            event['net_bytes'] = current - self.memory[0]
+            event['peak_bytes'] = peak - self.memory[0]
+            if stack:
+                stack[-1].memory[1] = max(stack[-1].memory[1], peak)
+        if stack:
+            stack[-1].children_s += duration
+        profiler.events.append(event)
+        return False
+
+
+class PhaseProfiler(object):
+    """
+    Records every phase a simulator enters as an event with its stack
+    of enclosing phases, start time and duration, and accumulates the
+    counts it reports.
+
+    Memory is measured with tracemalloc (which sees NumPy buffers):
+    per phase the bytes still allocated at its end (net_bytes) and the
+    high water mark above its start (peak_bytes), i.e. the temporaries
+    it needs. Python has no cheap cumulative allocation counter, so
+    these stand in for allocation counts. Tracing slows allocation-heavy
+    code noticeably; leave it off when only timings matter.
+
+    Args
+    ----
+    track_memory := boolean (default: False)
+                    measure memory with tracemalloc (started if needed)
+    """
+    enabled = True
+
+    def __init__(self, track_memory=False):
+        self.track_memory = track_memory
+        if track_memory and not tracemalloc.is_tracing():
+            tracemalloc.start()
+        self.reset()
+
+    def reset(self):
+        self.events = []
+        self.counts = {}
+        self.count_events = []
+        self._stack = []
+        self._t0 = time.perf_counter()
+
+    def phase(self, name):
+        return _Phase(self, name)
+
+    def count(self, name, n=1):
+        self.counts[name] = self.counts.get(name, 0) + n
+        self.count_events.append((time.perf_counter() - self._t0, name, n))
+
+    def summary(self):
+        """Per phase name: calls, total and mean seconds, and memory if tracked."""
+        summary = {}
+        for event in self.events:
+            entry = summary.setdefault(event['stack'][-1], {'calls': 0, 'total_s': 0., 'self_s': 0.})
+            entry['calls'] += 1
+            entry['total_s'] += event['duration']
+            entry['self_s'] += event['self']
+            if 'peak_bytes' in event:
+                entry['net_bytes'] = entry.get('net_bytes', 0) + event['net_bytes']
+                entry['peak_bytes'] = max(entry.get('peak_bytes', 0), event['peak_bytes'])
+        for entry in summary.values():
+            entry['mean_s'] = entry['total_s'] / entry['calls']
+        return summary
+
+    def to_chrome_trace(self, path):
+        """Complete ('X') events and counters in the Chrome trace event format."""
+        trace = []
+        for event in self.events:
+            args = {key: event[key] for key in ('net_bytes', 'peak_bytes') if key in event}
+            trace.append({
+                'name': event['stack'][-1], 'cat': 'step', 'ph': 'X', 'pid': 0, 'tid': 0,
+                'ts': event['start'] * 1e6, 'dur': event['duration'] * 1e6, 'args': args,
+            })
+        for ts, name, n in self.count_events:
+            trace.append({'name': name, 'ph': 'C', 'pid': 0, 'tid': 0,
+                          'ts': ts * 1e6, 'args': {name: n}})
+        with open(path, 'w') as fp:
+            json.dump({'traceEvents': trace, 'displayTimeUnit': 'ms'}, fp)
+
+    def to_folded(self, path):
+        """Folded stacks ('step;pressure <microseconds>') of the self time of each phase."""
+        folded = {}
+        for event in self.events:
+            stack = ';'.join(event['stack'])
+            folded[stack] = folded.get(stack, 0.) + event['self']
+        with open(path, 'w') as fp:
+            for stack, seconds in sorted(folded.items()):
+                fp.write('{} {}\n'.format(stack, int(round(seconds * 1e6))))
+
+
+if __name__ == "__main__":
+    import argparse
+    from src.cavity import SOLVERS, cavity_system, initial_state, advance
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--solver', type=str, default='chorin_fd', choices=SOLVERS,
+                        help='default: chorin_fd')
+    parser.add_argument('--nx', type=int, default=33, help='nx = ny [default: 33]')
+    parser.add_argument('--nt', type=int, default=20, help='default: 20')
+    parser.add_argument('--track-memory', action='store_true', default=False,
+                        help='also record memory per phase with tracemalloc')
+    parser.add_argument('--trace', type=str, default=None,
+                        help='write a Chrome trace here [default: None]')
+    parser.add_argument('--folded', type=str, default=None,
+                        help='write folded stacks here [default: None]')
+    args = parser.parse_args()
+
+    profiler = PhaseProfiler(track_memory=args.track_memory)
+    system = cavity_system(args.solver, nx=args.nx, ny=args.nx, nt=args.nt, profiler=profiler)
+    profiler.reset()
+    advance(system, initial_state(system), args.nt)
+
+    print('{:24s} {:>6s} {:>10s} {:>10s}{}'.format(
+        'phase', 'calls', 'mean ms', 'self ms', '  peak MB' if args.track_memory else ''))
+    for name, entry in sorted(profiler.summary().items(), key=lambda kv: -kv[1]['total_s']):
+        print('{:24s} {:6d} {:10.3f} {:10.3f}{}'.format(
+            name, entry['calls'], 1e3 * entry['mean_s'], 1e3 * entry['self_s'] / entry['calls'],
+            '  {:7.2f}'.format(entry['peak_bytes'] / 1024. ** 2) if args.track_memory else ''))
+    for name, n in profiler.counts.items():
+        print('{}: {} ({:.1f} per step)'.format(name, n, n / args.nt))
+    if args.trace is not None:
+        profiler.to_chrome_trace(args.trace)
+    if args.folded is not None:
+        profiler.to_folded(args.folded)
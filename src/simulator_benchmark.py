@@ -0,0 +1,188 @@
+"""
+Throughput of the NavierStokesSystem simulators (direct_fd, chorin_fd,
+chorin_spectral) on the lid-driven cavity across grid sizes and numbers
+of time steps: steps per second, time per phase of a step, setup time
+and peak memory. Every configuration runs in a fresh process so the
+peak resident set size belongs to that configuration alone. Results are
+written as JSON; given a stored baseline (an earlier --out file), any
+configuration that got slower or larger than the tolerance allows is
+reported and the run exits with status 1.
+
+    python -m src.simulator_benchmark --solvers direct_fd chorin_spectral \
+        --grid 17 33 51 --nt 10 50 --out benchmark.json
+    python -m src.simulator_benchmark --baseline benchmark.json --tolerance 0.2
+"""
+import os
+import sys
+import json
+import time
+import platform
+import resource
+import itertools
+import subprocess
+
+import numpy as np
+
+from src.cavity import SOLVERS, cavity_system, initial_state, advance
+from src.profiling import PhaseProfiler
+
+
+def peak_rss_mb():
+    # ru_maxrss is in kilobytes on Linux and bytes on macOS
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return rss / 1024. ** 2 if sys.platform == 'darwin' else rss / 1024.
+
+
+def run_config(solver, nx, nt, n_repeats, n_threads=1):
+    """Benchmark one configuration in this process and return a result dict."""
+    cavity_system(solver, nx=5, ny=5)  # keep the imports out of the setup time
+    # direct_fd has no predictor solves to run on threads
+    kwargs = {} if solver == 'direct_fd' else {'n_threads': n_threads}
+    start = time.perf_counter()
+    system = cavity_system(solver, nx=nx, ny=nx, nt=nt, **kwargs)
+    setup_s = time.perf_counter() - start
+    system.profiler = profiler = PhaseProfiler()
+    state = initial_state(system)
+    base_rss = peak_rss_mb()
+
+    times = []
+    # an unstable configuration keeps its timings, flagged as diverged
+    with np.errstate(over='ignore', invalid='ignore', divide='ignore'):
+        for i in range(n_repeats + 1):  # the first repeat is a warm up
+            if i == 1:
+                profiler.reset()
+            start = time.perf_counter()
+            final = advance(system, state, nt)
+            if i > 0:
+                times.append(time.perf_counter() - start)
+
+    step_s = sum(times) / (n_repeats * nt)
+    # self time, so the phases add up to the step
+    phase_s = {name: entry['self_s'] / (n_repeats * nt)
+               for name, entry in profiler.summary().items()}
+    counts = {name: n / (n_repeats * nt) for name, n in profiler.counts.items()}
+    return {
+        'solver': solver, 'nx': nx, 'ny': nx, 'nt': nt, 'n_threads': n_threads,
+        'steps_per_s': nt / min(times),
+        'steps_per_s_mean': 1. / step_s,
+        'setup_s': setup_s,
+        'phase_s': phase_s,
+        'counts_per_step': counts,
+        'base_rss_mb': base_rss, 'peak_rss_mb': peak_rss_mb(),
+        'diverged': not all(np.isfinite(x).all() for x in final),
+    }
+
+
+def spawn_config(solver, nx, nt, args):
+    """Run one configuration in a subprocess and parse its JSON line."""
+    cmd = [sys.executable, '-m', 'src.simulator_benchmark', '--worker',
+           '--solvers', solver, '--grid', str(nx), '--nt', str(nt),
+           '--n-repeats', str(args.n_repeats), '--n-threads', str(args.n_threads)]
+    proc = subprocess.run(cmd, capture_output=True, text=True)
+    config = {'solver': solver, 'nx': nx, 'ny': nx, 'nt': nt, 'n_threads': args.n_threads}
+    if proc.returncode != 0:
+        config['error'] = proc.stderr.strip().splitlines()[-1] if proc.stderr.strip() else \
+            'exit code {}'.format(proc.returncode)
+        return config
+    return json.loads(proc.stdout.strip().splitlines()[-1])
+
+
+def compare(results, baseline, tolerance, memory_tolerance):
+    """
+    Regressions of results against a baseline list of results, as
+    messages. A configuration regresses if its steps per second fell by
+    more than the tolerance fraction, or its peak memory above the base
+    grew by more than the memory tolerance fraction (plus 1 MB of noise).
+    """
+    key = lambda r: (r['solver'], r['nx'], r['ny'], r['nt'], r.get('n_threads', 1))
+    reference = {key(r): r for r in baseline if 'error' not in r}
+    regressions = []
+    for result in results:
+        old = reference.get(key(result))
+        if old is None:
+            continue
+        name = '{} nx={} nt={}'.format(result['solver'], result['nx'], result['nt'])
+        if 'error' in result:
+            regressions.append('{}: failed ({})'.format(name, result['error']))
+            continue
+        if result['steps_per_s'] < (1 - tolerance) * old['steps_per_s']:
+            regressions.append('{}: {:.2f} steps/s, baseline {:.2f} ({:+.0%})'.format(
+                name, result['steps_per_s'], old['steps_per_s'],
+                result['steps_per_s'] / old['steps_per_s'] - 1))
+        memory = result['peak_rss_mb'] - result['base_rss_mb']
+        old_memory = old['peak_rss_mb'] - old['base_rss_mb']
+        if memory > (1 + memory_tolerance) * old_memory + 1.:
+            regressions.append('{}: step memory {:.1f} MB, baseline {:.1f} MB'.format(
+                name, memory, old_memory))
+    return regressions
+
+
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--solvers', type=str, nargs='+',
+                        default=['direct_fd', 'chorin_fd', 'chorin_spectral'], choices=SOLVERS,
+                        help='default: direct_fd chorin_fd chorin_spectral')
+    parser.add_argument('--grid', type=int, nargs='+', default=[17, 33, 51],
+                        help='grid sizes nx = ny [default: 17 33 51]')
+    parser.add_argument('--nt', type=int, nargs='+', default=[10, 40], help='default: 10 40')
+    parser.add_argument('--n-repeats', type=int, default=1, help='default: 1')
+    parser.add_argument('--n-threads', type=int, default=1,
+                        help='threads for the u/v predictor solves of the chorin solvers [default: 1]')
+    parser.add_argument('--out', type=str, default='simulator_benchmark.json',
+                        help='where to write the results [default: simulator_benchmark.json]')
+    parser.add_argument('--baseline', type=str, default=None,
+                        help='results of an earlier run to compare against [default: None]')
+    parser.add_argument('--tolerance', type=float, default=0.2,
+                        help='allowed fractional drop in steps/s [default: 0.2]')
+    parser.add_argument('--memory-tolerance', type=float, default=0.2,
+                        help='allowed fractional growth in step memory [default: 0.2]')
+    parser.add_argument('--worker', action='store_true', default=False,
+                        help='run the single given configuration and print it as JSON')
+    args = parser.parse_args()
+
+    if args.worker:
+        result = run_config(args.solvers[0], args.grid[0], args.nt[0], args.n_repeats,
+                            args.n_threads)
+        print(json.dumps(result))
+        sys.exit(0)
+
+    # read the baseline first: --out may well be the same file
+    baseline = None
+    if args.baseline is not None:
+        with open(args.baseline) as fp:
+            baseline = json.load(fp)['results']
+
+    results = []
+    configs = list(itertools.product(args.grid, args.nt, args.solvers))
+    for i, (nx, nt, solver) in enumerate(configs):
+        result = spawn_config(solver, nx, nt, args)
+        results.append(result)
+        if 'error' in result:
+            summary = 'failed: {}'.format(result['error'])
+        else:
+            summary = '{:9.2f} steps/s  setup {:.3f}s  peak rss {:.0f} MB{}'.format(
+                result['steps_per_s'], result['setup_s'], result['peak_rss_mb'],
+                '  (diverged)' if result['diverged'] else '')
+        print('[{}/{}] {:18s} nx={:<4d} nt={:<4d} {}'.format(
+            i + 1, len(configs), solver, nx, nt, summary))
+
+    with open(args.out, 'w') as fp:
+        json.dump({
+            'numpy_version': np.__version__,
+            'python_version': platform.python_version(),
+            'platform': platform.platform(),
+            'cpu_count': os.cpu_count(),
+            'n_repeats': args.n_repeats,
+            'results': results,
+        }, fp, indent=2)
+    print('wrote {} results to {}'.format(len(results), args.out))
+
+    if baseline is not None:
+        regressions = compare(results, baseline, args.tolerance, args.memory_tolerance)
+        if regressions:
+            print('{} regression(s) against {}:'.format(len(regressions), args.baseline))
+            for message in regressions:
+                print('  ' + message)
+            sys.exit(1)
+        print('no regressions against {}'.format(args.baseline))
@@ -0,0 +1,143 @@
+"""
+Steady state of a NavierStokesSystem by Jacobian-free Newton-Krylov.
+A steady flow is a fixed point of the time stepper, so we solve
+
+    F(u, v, p) = (step^k(u, v, p) - (u, v, p)) / (k dt) = 0
+
+with scipy.optimize.newton_krylov, using the existing step() as the
+map (with the previous velocity equal to the current one, as it is at
+steady state). Each evaluation of F costs k steps; on the 17 x 17 cavity
+the solve takes about a quarter of the steps of marching to the same
+residual.
+
+    python -m src.steady --solver direct_fd --nx 17 --compare
+"""
+import time
+
+import numpy as np
+from scipy.optimize import newton_krylov, NoConvergence
+
+from src.cavity import SOLVERS, cavity_system, initial_state, advance
+
+
+def steady_residual(system, n_steps=10):
+    """F above as a function of the flattened (u, v, p), with the field shape."""
+    shape = (system.nx, system.ny)
+
+    def residual(x):
+        u, v, p = x.reshape((3,) + shape)
+        u1, v1, _, _, p1 = advance(system, (u, v, u, v, p), n_steps)
+        return (np.stack([u1, v1, p1]) - np.stack([u, v, p])).ravel() / (n_steps * system.dt)
+
+    return residual
+
+
+def steady_state(system, state=None, n_steps=10, f_tol=1e-6, maxiter=100,
+                 method='lgmres', verbose=False):
+    """
+    Solve for the steady (u, v, p) of a system.
+
+    Args
+    ----
+    system := NavierStokesSystem
+    state := tuple (default: None)
+             (u, v, u1, v1, p) to start from, e.g. after some time
+             marching; the initial conditions if None
+    n_steps := integer (default: 10)
+               time steps per evaluation of the fixed point map; with
+               a single step the pressure iteration (a fixed number of
+               Jacobi or SOR sweeps per step) makes the Jacobian too
+               ill conditioned for the Krylov solver, a few steps
+               smooth it out at a proportional cost
+    f_tol := float (default: 1e-6)
+             max-norm of the residual, i.e. of du/dt, to stop at
+    maxiter := integer (default: 100)
+               Newton iterations
+    method := string (default: lgmres)
+              Krylov method of newton_krylov
+    verbose := boolean (default: False)
+
+    Returns (u, v, p) and the number of step() calls it took. Raises
+    scipy.optimize.NoConvergence if f_tol is not reached.
+    """
+    if state is None:
+        state = initial_state(system)
+    u, v, _, _, p = state
+    residual = steady_residual(system, n_steps)
+
+    n_calls = [0]
+
+    def counted(x):
+        n_calls[0] += 1
+        return residual(x)
+
+    # the chorin modules turn numpy warnings into errors; trial points
+    # of the line search may overflow without harm
+    with np.errstate(over='ignore', invalid='ignore'):
+        x = newton_krylov(counted, np.stack([u, v, p]).ravel(), f_tol=f_tol,
+                          maxiter=maxiter, method=method, verbose=verbose)
+    u, v, p = x.reshape((3, system.nx, system.ny))
+    return (u, v, p), n_calls[0] * n_steps
+
+
+def march_to_steady(system, state=None, tol=1e-7, max_steps=100000):
+    """
+    Time march until the largest change of u or v over a step is below
+    tol (or max_steps). Returns the state, the number of steps and
+    whether tol was reached.
+    """
+    if state is None:
+        state = initial_state(system)
+    for n in range(max_steps):
+        state = advance(system, state)
+        u, v, u1, v1, _ = state
+        if max(np.abs(u - u1).max(), np.abs(v - v1).max()) < tol:
+            return state, n + 1, True
+    return state, max_steps, False
+
+
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--solver', type=str, default='direct_fd', choices=SOLVERS,
+                        help='default: direct_fd')
+    parser.add_argument('--nx', type=int, default=17, help='nx = ny [default: 17]')
+    parser.add_argument('--dt', type=float, default=1e-3, help='default: 1e-3')
+    parser.add_argument('--nu', type=float, default=0.1, help='default: 0.1')
+    parser.add_argument('--n-steps', type=int, default=10,
+                        help='time steps per fixed point map evaluation [default: 10]')
+    parser.add_argument('--warmup', type=int, default=0,
+                        help='time steps to march before the Newton solve [default: 0]')
+    parser.add_argument('--f-tol', type=float, default=1e-6, help='default: 1e-6')
+    parser.add_argument('--maxiter', type=int, default=100, help='default: 100')
+    parser.add_argument('--compare', action='store_true', default=False,
+                        help='also time march to a steady state and compare')
+    parser.add_argument('--out', type=str, default=None,
+                        help='save the steady u, v, p as npz [default: None]')
+    args = parser.parse_args()
+
+    system = cavity_system(args.solver, nx=args.nx, ny=args.nx, dt=args.dt, nu=args.nu)
+    start = time.perf_counter()
+    state = advance(system, initial_state(system), args.warmup)
+    try:
+        (u, v, p), n_calls = steady_state(system, state, n_steps=args.n_steps,
+                                          f_tol=args.f_tol, maxiter=args.maxiter, verbose=True)
+    except NoConvergence:
+        raise SystemExit('Newton-Krylov did not reach f_tol {:g} in {} iterations'.format(
+            args.f_tol, args.maxiter))
+    newton_s = time.perf_counter() - start
+    print('newton-krylov: {:.2f}s, {} steps'.format(newton_s, n_calls + args.warmup))
+
+    if args.compare:
+        start = time.perf_counter()
+        # an increment of f_tol * dt per step is a residual of f_tol
+        marched, n_marched, converged = march_to_steady(system, tol=args.f_tol * args.dt)
+        march_s = time.perf_counter() - start
+        print('time marching: {:.2f}s, {} steps{} ({:.1f}x the newton-krylov time)'.format(
+            march_s, n_marched, '' if converged else ' (not converged)',
+            march_s / newton_s))
+        print('max difference: u {:.2e}, v {:.2e}'.format(
+            np.abs(marched[0] - u).max(), np.abs(marched[1] - v).max()))
+
+    if args.out is not None:
+        np.savez(args.out, u=u, v=v, p=p)
@@ -0,0 +1,68 @@
+"""
+Persistent thread pools for running independent NumPy / LAPACK calls
+(e.g. the u- and v-momentum solves of a predictor step) concurrently.
+These calls release the GIL, so two of them on two threads overlap.
+
+To keep the threads from oversubscribing the cores, the BLAS / OpenMP
+pools are limited to cpu_count // n_threads threads each while the
+concurrent calls run, and restored afterwards. That needs the optional
+threadpoolctl package (pip install threadpoolctl); without it the BLAS
+threads are left alone, with a warning (set OMP_NUM_THREADS /
+OPENBLAS_NUM_THREADS / MKL_NUM_THREADS before starting Python instead).
+"""
+import os
+import warnings
+from contextlib import nullcontext
+from concurrent.futures import ThreadPoolExecutor
+
+try:
+    from threadpoolctl import ThreadpoolController
+except ImportError:
+    ThreadpoolController = None
+
+_pools = {}
+_controller = None
+
+
+def get_pool(n_threads):
+    """The process-wide pool that runs n_threads calls at once (created on first use)."""
+    if n_threads not in _pools:
+        # the caller runs one of the calls itself
+        _pools[n_threads] = ThreadPoolExecutor(max_workers=n_threads - 1,
+                                               thread_name_prefix='solve')
+    return _pools[n_threads]
+
+
+def limit_blas_threads(n):
+    """
+    Context manager that limits the BLAS / OpenMP thread pools to n
+    threads inside the with block; does nothing (and warns once) if
+    threadpoolctl is not installed.
+    """
+    global _controller
+    if ThreadpoolController is None:
+        if _controller is None:
+            _controller = False
+            # the chorin modules turn warnings into errors; this one is harmless
+            with warnings.catch_warnings():
+                warnings.simplefilter('always')
+                warnings.warn('threadpoolctl is not installed, the BLAS threads are not '
+                              'limited while solves run concurrently', RuntimeWarning)
+        return nullcontext()
+    if _controller is None:
+        # created on first use, so it finds the BLAS libraries loaded by then
+        _controller = ThreadpoolController()
+    return _controller.limit(limits=n)
+
+
+def concurrent_map(fn, args_list, n_threads=2):
+    """
+    [fn(*args) for args in args_list], with up to n_threads of the calls
+    running at once (n_threads <= 1 runs them in order on this thread).
+    """
+    if n_threads <= 1 or len(args_list) <= 1:
+        return [fn(*args) for args in args_list]
+    pool = get_pool(n_threads)
+    with limit_blas_threads(max(1, (os.cpu_count() or 1) // n_threads)):
+        futures = [pool.submit(fn, *args) for args in args_list[1:]]
+        return [fn(*args_list[0])] + [future.result() for future in futures]
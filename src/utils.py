@@ -1,6 +1,10 @@
 import os
+import queue
 import torch
 import shutil
+import tempfile
+import threading
+import time
 import numpy as np
 from tqdm import tqdm
 from glob import glob
@@ -78,13 +82,228 @@ class AverageMeter(object):
         self.avg = self.sum / self.count
 
 
+# choices for the --amp flag of the training scripts
+AMP_DTYPES = {'none': torch.float32, 'bf16': torch.bfloat16, 'fp16': torch.float16}
+
+
+def autocast(device, amp='none'):
+    """Autocast context for one of AMP_DTYPES; a no-op for 'none'."""
+    return torch.autocast(device.type, dtype=AMP_DTYPES[amp], enabled=amp != 'none')
+
+
+def grad_scaler(device, amp='none'):
+    """
+    Loss scaling is only needed for float16, whose narrow exponent
+    range underflows small gradients; bfloat16 shares the float32
+    exponent range. A disabled scaler passes everything through.
+    """
+    return torch.amp.GradScaler(device.type, enabled=amp == 'fp16')
+
+
 def save_checkpoint(state, is_best, folder='./', filename='checkpoint.pth.tar'):
     if not os.path.isdir(folder):
         os.mkdir(folder)
-    torch.save(state, os.path.join(folder, filename))
+    _atomic_save(state, os.path.join(folder, filename))
     if is_best:
-        shutil.copyfile(os.path.join(folder, filename),
-                        os.path.join(folder, 'model_best.pth.tar'))
+        _atomic_copy(os.path.join(folder, filename),
+                     os.path.join(folder, 'model_best.pth.tar'))
+
+
+# one fixed-width record per training iteration in the metrics log
+METRICS_DTYPE = np.dtype([
+    ('iteration', '<i8'),
+    ('loss', '<f8'),
+    ('penalty', '<f8'),
+    ('wall_time', '<f8'),    # seconds since the logger was opened
+    ('throughput', '<f8'),   # samples per second for this iteration
+])
+
+
+class MetricsLogger(object):
+    """
+    Binary log of training metrics. Each call to log() writes one
+    METRICS_DTYPE record, so the cost per iteration is constant no
+    matter how long the run is. Read it back with
+    load_metrics().
+
+    Args
+    ----
+    path := string
+            log file
+    flush_every := integer (default: 10)
+                   records to buffer before flushing to disk
+    append := boolean (default: False)
+              append to an existing log (e.g. when resuming a run)
+              instead of truncating it
+    """
+
+    def __init__(self, path, flush_every=10, append=False):
+        self.path = path
+        self.flush_every = flush_every
+        self._fp = open(path, 'ab' if append else 'wb')
+        self._n_unflushed = 0
+        self._start = self._last = time.time()
+
+    def log(self, iteration, loss, penalty=np.nan, n_samples=1):
+        now = time.time()
+        elapsed = now - self._last
+        throughput = n_samples / elapsed if elapsed > 0 else np.inf
+        self._last = now
+
+        record = np.array((iteration, loss, penalty, now - self._start, throughput),
+                          dtype=METRICS_DTYPE)
+        self._fp.write(record.tobytes())
+        self._n_unflushed += 1
+        if self._n_unflushed >= self.flush_every:
+            self.flush()
+
+    def flush(self):
+        self._fp.flush()
+        self._n_unflushed = 0
+
+    def close(self):
+        self.flush()
+        self._fp.close()
+
+
+def load_metrics(path):
+    """Memory-map a metrics log written by MetricsLogger. Returns a
+    structured array with the fields of METRICS_DTYPE, e.g.
+    load_metrics(path)['loss']. A partially written trailing record
+    (from a run that is still going) is ignored."""
+    n_records = os.path.getsize(path) // METRICS_DTYPE.itemsize
+    if n_records == 0:
+        return np.zeros(0, dtype=METRICS_DTYPE)
+    return np.memmap(path, dtype=METRICS_DTYPE, mode='r', shape=(n_records,))
+
+
+def _snapshot_to_cpu(obj):
+    # deep copy every tensor to host memory so training can keep
+    # mutating the live parameters while the copy is written out
+    if torch.is_tensor(obj):
+        return obj.detach().to('cpu', copy=True)
+    elif isinstance(obj, dict):
+        return type(obj)((k, _snapshot_to_cpu(v)) for k, v in obj.items())
+    elif isinstance(obj, (list, tuple)):
+        return type(obj)(_snapshot_to_cpu(v) for v in obj)
+    return obj
+
+
+def _umask():
+    # os.umask can only be read by setting it; do that once, before
+    # any writer thread exists
+    mask = os.umask(0)
+    os.umask(mask)
+    return mask
+
+
+_UMASK = _umask()
+
+
+def _replace(tmp_path, path):
+    # mkstemp files are owner-only; give the result the permissions a
+    # plain open() would have
+    os.chmod(tmp_path, 0o666 & ~_UMASK)
+    os.replace(tmp_path, path)
+
+
+def _atomic_save(state, path):
+    # write to a temp file in the same folder and rename over the
+    # target so a crash never leaves a half-written checkpoint behind
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'wb') as fp:
+            torch.save(state, fp)
+            fp.flush()
+            os.fsync(fp.fileno())
+        _replace(tmp_path, path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+
+def _atomic_copy(src, dst):
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(dst), suffix='.tmp')
+    os.close(fd)
+    try:
+        shutil.copyfile(src, tmp_path)
+        _replace(tmp_path, dst)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+
+class AsyncCheckpointWriter(object):
+    """
+    Writes checkpoints from a background thread so the training
+    loop only pays for copying state to CPU, never for disk I/O.
+
+    Every save is written to checkpoint_<itr>.pth.tar and mirrored
+    to checkpoint.pth.tar; only the newest keep_last numbered files
+    are kept. Saves flagged is_best are also copied to
+    model_best.pth.tar. All writes are atomic (temp file + rename).
+
+    Args
+    ----
+    folder := string
+              where to write checkpoints
+    keep_last := integer (default: 3)
+                 number of numbered checkpoints to keep on disk
+    max_pending := integer (default: 2)
+                   snapshots allowed to queue up before save() blocks
+    """
+
+    def __init__(self, folder, keep_last=3, max_pending=2):
+        if not os.path.isdir(folder):
+            os.makedirs(folder)
+        self.folder = folder
+        self.keep_last = keep_last
+        self._written = []
+        self._error = None
+        self._queue = queue.Queue(maxsize=max_pending)
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def save(self, state, itr, is_best=False):
+        self._raise_if_failed()
+        self._queue.put((_snapshot_to_cpu(state), itr, is_best))
+
+    def close(self):
+        """Block until every queued checkpoint is on disk."""
+        self._queue.put(None)
+        self._thread.join()
+        self._raise_if_failed()
+
+    def _raise_if_failed(self):
+        if self._error is not None:
+            raise RuntimeError('checkpoint writer failed') from self._error
+
+    def _run(self):
+        while True:
+            item = self._queue.get()
+            if item is None:
+                break
+            if self._error is not None:
+                continue  # drain the queue but stop touching disk
+            try:
+                self._write(*item)
+            except Exception as e:
+                self._error = e
+
+    def _write(self, state, itr, is_best):
+        filename = os.path.join(self.folder, 'checkpoint_{}.pth.tar'.format(itr))
+        _atomic_save(state, filename)
+        _atomic_copy(filename, os.path.join(self.folder, 'checkpoint.pth.tar'))
+        if is_best:
+            _atomic_copy(filename, os.path.join(self.folder, 'model_best.pth.tar'))
+
+        self._written.append(filename)
+        while len(self._written) > self.keep_last:
+            old = self._written.pop(0)
+            if os.path.exists(old):
+                os.remove(old)
 
 
 def mean_squared_error(pred, true):
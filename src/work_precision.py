@@ -0,0 +1,192 @@
+"""
+Work-precision curves for the simulators on the lid-driven cavity: run
+each solver over a ladder of grid sizes and time steps to a common end
+time, measure the error of the final velocity against a reference
+solution, and plot error against CPU seconds. The cheapest
+configuration meeting --tolerance is reported per solver.
+
+All fields are compared in physical coordinates (x, y) in [-1, 1]^2,
+interpolated onto a common uniform grid of interior points:
+
+    chorin_fd       arrays are [x, y], with x_i = -1 + 2 i / (N - 1)
+    chorin_spectral arrays are [x, y] on Gauss-Lobatto points,
+                    x_i = cos(pi i / (N - 1)), i.e. from +1 down to -1
+    direct_fd       arrays are [y, x] (row index is y), with the same
+                    uniform points as chorin_fd; they are transposed
+                    before comparing
+
+The cavity BCs of the scripts (src.cavity) set the 'right' side, which
+is x = +1 for the chorin solvers but y = +1 for direct_fd, so direct_fd
+solves a different flow than chorin_fd / chorin_spectral and should
+only be compared against itself. The default reference, 'self', is
+each solver on the --reference-grid and --reference-dt; naming a solver
+instead (e.g. chorin_spectral) uses that one run for every solver.
+
+    python -m src.work_precision --solvers direct_fd chorin_fd_explicit \
+        --grid 9 17 33 --dt 4e-3 2e-3 1e-3 --t-end 0.04 --plot work_precision.png
+"""
+import json
+import time
+import itertools
+
+import numpy as np
+from scipy.interpolate import RegularGridInterpolator
+
+from src.cavity import SOLVERS, cavity_system, initial_state, advance, is_direct
+
+
+def grid_points(system):
+    """Coordinates of the array indices along the first and second axis."""
+    if hasattr(system, 'x_i'):  # chorin_spectral
+        return system.x_i, system.y_i
+    return np.linspace(-1, 1, system.nx), np.linspace(-1, 1, system.ny)
+
+
+def to_xy(system, field):
+    """field as an [x, y] array with its (increasing) x and y coordinates."""
+    x, y = grid_points(system)
+    if is_direct(system):
+        field = field.T
+    if x[0] > x[-1]:
+        x, field = x[::-1], field[::-1]
+    if y[0] > y[-1]:
+        y, field = y[::-1], field[:, ::-1]
+    return x, y, field
+
+
+def sample(system, fields, points):
+    """Values of each [x, y] field at points (n x 2), interpolated linearly."""
+    samples = []
+    for field in fields:
+        x, y, field = to_xy(system, field)
+        samples.append(RegularGridInterpolator((x, y), field)(points))
+    return np.concatenate(samples)
+
+
+def common_points(n):
+    """n x n uniform interior points of the cavity, as (n * n) x 2 (x, y)."""
+    x = np.linspace(-1, 1, n + 2)[1:-1]
+    X, Y = np.meshgrid(x, x, indexing='ij')
+    return np.stack([X.ravel(), Y.ravel()], axis=1)
+
+
+def run(solver, nx, dt, t_end, blowup=1e3):
+    """
+    March the cavity to t_end. Returns the system, the final (u, v), the
+    CPU seconds spent (setup included) and whether the run diverged,
+    i.e. became non-finite or exceeded blowup times the lid velocity.
+    """
+    nt = int(round(t_end / dt))
+    start = time.process_time()
+    system = cavity_system(solver, nx=nx, ny=nx, nt=nt, dt=dt)
+    state = initial_state(system)
+    diverged = False
+    # the chorin modules turn numpy warnings into errors; an overflow
+    # here just means this configuration is unstable
+    with np.errstate(all='ignore'):
+        for _ in range(nt):
+            state = advance(system, state)
+            if not (np.isfinite(state[0]).all() and np.abs(state[0]).max() < blowup):
+                diverged = True
+                break
+    cpu_s = time.process_time() - start
+    return system, state[:2], cpu_s, diverged
+
+
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--solvers', type=str, nargs='+',
+                        default=['direct_fd', 'chorin_fd_explicit', 'chorin_fd'], choices=SOLVERS,
+                        help='default: direct_fd chorin_fd_explicit chorin_fd')
+    parser.add_argument('--grid', type=int, nargs='+', default=[9, 17, 33],
+                        help='grid sizes nx = ny [default: 9 17 33]')
+    parser.add_argument('--dt', type=float, nargs='+', default=[4e-3, 2e-3, 1e-3],
+                        help='default: 4e-3 2e-3 1e-3')
+    parser.add_argument('--t-end', type=float, default=0.04,
+                        help='time every run is compared at [default: 0.04]')
+    parser.add_argument('--reference', type=str, default='self', choices=['self'] + SOLVERS,
+                        help='solver of the reference solution [default: self]')
+    parser.add_argument('--reference-grid', type=int, default=65, help='default: 65')
+    parser.add_argument('--reference-dt', type=float, default=5e-4, help='default: 5e-4')
+    parser.add_argument('--n-points', type=int, default=15,
+                        help='compare on n x n interior points [default: 15]')
+    parser.add_argument('--tolerance', type=float, default=None,
+                        help='report the cheapest run per solver with a smaller error [default: None]')
+    parser.add_argument('--out', type=str, default='work_precision.json',
+                        help='default: work_precision.json')
+    parser.add_argument('--plot', type=str, default=None,
+                        help='save the error vs CPU seconds plot here (needs matplotlib)')
+    args = parser.parse_args()
+
+    points = common_points(args.n_points)
+    references = {}
+
+    def reference(solver):
+        name = solver if args.reference == 'self' else args.reference
+        if name not in references:
+            system, fields, cpu_s, diverged = run(
+                name, args.reference_grid, args.reference_dt, args.t_end)
+            if diverged:
+                raise SystemExit('the {} reference (nx={}, dt={}) diverged; try another '
+                                 '--reference or a smaller --reference-dt'.format(
+                                     name, args.reference_grid, args.reference_dt))
+            print('reference {} nx={} dt={}: {:.2f} cpu s'.format(
+                name, args.reference_grid, args.reference_dt, cpu_s))
+            references[name] = sample(system, fields, points)
+        return references[name]
+
+    results = []
+    for solver, nx, dt in itertools.product(args.solvers, args.grid, args.dt):
+        ref = reference(solver)
+        system, fields, cpu_s, diverged = run(solver, nx, dt, args.t_end)
+        error = None if diverged else \
+            float(np.linalg.norm(sample(system, fields, points) - ref) / np.linalg.norm(ref))
+        results.append({'solver': solver, 'nx': nx, 'dt': dt, 'nt': int(round(args.t_end / dt)),
+                        'cpu_s': cpu_s, 'error': error, 'diverged': diverged})
+        print('{:18s} nx={:<4d} dt={:<8g} {:8.3f} cpu s  {}'.format(
+            solver, nx, dt, cpu_s, 'diverged' if diverged else 'error {:.3e}'.format(error)))
+
+    if args.tolerance is not None:
+        for solver in args.solvers:
+            ok = [r for r in results if r['solver'] == solver and
+                  not r['diverged'] and r['error'] <= args.tolerance]
+            if ok:
+                best = min(ok, key=lambda r: r['cpu_s'])
+                print('{}: cheapest within {:g} is nx={} dt={:g} ({:.3f} cpu s, error {:.3e})'.format(
+                    solver, args.tolerance, best['nx'], best['dt'], best['cpu_s'], best['error']))
+            else:
+                print('{}: no run within {:g}'.format(solver, args.tolerance))
+
+    with open(args.out, 'w') as fp:
+        json.dump({
+            't_end': args.t_end, 'reference': args.reference,
+            'reference_grid': args.reference_grid, 'reference_dt': args.reference_dt,
+            'n_points': args.n_points, 'results': results,
+        }, fp, indent=2)
+    print('wrote {} results to {}'.format(len(results), args.out))
+
+    if args.plot is not None:
+        try:
+            import matplotlib
+            matplotlib.use('Agg')
+            import matplotlib.pyplot as plt
+        except ImportError:
+            raise SystemExit('--plot needs matplotlib')
+
+        fig, ax = plt.subplots(figsize=(6, 4.5))
+        for solver in args.solvers:
+            for nx in args.grid:
+                runs = [r for r in results if r['solver'] == solver and r['nx'] == nx
+                        and not r['diverged']]
+                if runs:
+                    ax.loglog([r['cpu_s'] for r in runs], [r['error'] for r in runs],
+                              'o-', label='{} nx={}'.format(solver, nx))
+        if args.tolerance is not None:
+            ax.axhline(args.tolerance, color='k', linestyle='--', linewidth=1)
+        ax.set_xlabel('CPU seconds')
+        ax.set_ylabel('relative velocity error at t = {:g}'.format(args.t_end))
+        ax.legend(fontsize=7)
+        fig.tight_layout()
+        fig.savefig(args.plot, dpi=150)
+        print('saved plot to {}'.format(args.plot))